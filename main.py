@@ -21,14 +21,23 @@ from telebot import apihelper
 apihelper.CONNECT_TIMEOUT = 30
 apihelper.READ_TIMEOUT = 60
 import random
+import heapq
+import contextlib
 import string
+import uuid
+import sys
 import threading
 from telebot import types
 from datetime import datetime, timedelta
+from collections import OrderedDict
 import time
 import traceback
+import queue
+from concurrent.futures import ThreadPoolExecutor
 import requests
+from urllib3.util.retry import Retry
 import pymongo
+from pymongo.errors import DuplicateKeyError, BulkWriteError
 import certifi
 import re
 from flask import Flask, request, jsonify
@@ -45,6 +54,14 @@ except:
 if not BOT_TOKEN or not MONGO_URI:
     raise ValueError("❌ Error: BOT_TOKEN or MONGO_URI missing!")
 
+# Update ingestion: "polling" (default) ya "webhook" (Flask app pe /telegram)
+BOT_MODE = os.getenv("BOT_MODE", "polling").lower()
+TG_WEBHOOK_URL = os.getenv("TG_WEBHOOK_URL", "").rstrip("/")  # Public base URL, e.g. https://bot.example.com
+UPDATE_WORKERS = int(os.getenv("UPDATE_WORKERS", "8"))       # Dispatcher lanes
+UPDATE_QUEUE_SIZE = int(os.getenv("UPDATE_QUEUE_SIZE", "1000")) # Saari lanes ka total
+if BOT_MODE == "webhook" and not TG_WEBHOOK_URL:
+    raise ValueError("❌ Error: TG_WEBHOOK_URL missing for webhook mode!")
+
 # ---------------- DATABASE CONNECTION ----------------
 try:
     client = pymongo.MongoClient(MONGO_URI, tlsCAFile=certifi.where())
@@ -58,28 +75,316 @@ try:
     pending_payments_col = db["pending_payments"] # New Collection for Email Verification
     unclaimed_payments_col = db["unclaimed_payments"]
     redeems_col = db["redeems"]
+    redeem_usage_col = db["redeem_usage"] # (user_id, code) pairs of used redeem codes
+    bonuses_col = db["bonuses"] # Active purchase bonus per user (_id = user_id)
+    sessions_col = db["sessions"] # Conversation state (STATE_BACKEND=mongo)
     auto_delete_col = db["auto_delete"] # New for Scheduler
     verification_tokens_col = db["verification_tokens"] # New for Secure Verification
-    
-    # Auto-delete code when expiry time is reached
-    redeems_col.create_index("expiry", expireAfterSeconds=0)
-    
-    # Auto-delete pending email requests after 48 hours
-    pending_payments_col.create_index("created_at", expireAfterSeconds=172800)
-    
-    # Auto-delete verification tokens after 20 minutes (1200 seconds)
-    verification_tokens_col.create_index("created_at", expireAfterSeconds=1200)
-    
-    # Auto-delete tickets at the end of the week
-    tickets_col.create_index("expire_at", expireAfterSeconds=0)
-    
+    short_link_pool_col = db["short_link_pool"] # Pre-shortened v_ tokens per shortener slot
+    wallet_ledger_col = db["wallet_ledger"] # Append-only credit movements (audit trail)
+    payment_events_col = db["payment_events"] # Raw gateway webhooks (_id = idempotency key)
+    outbox_col = db["outbox"] # Persistent user notifications (sent by outbox worker)
+    delivery_jobs_col = db["delivery_jobs"] # Background file delivery queue
+    broadcasts_col = db["broadcasts"] # Resumable broadcast jobs
+    broadcast_msgs_col = db["broadcast_msgs"] # Ledger of sent broadcast messages (for deletion)
+    batch_drafts_col = db["batch_drafts"] # In-progress uploads (promoted to batches on Done)
+    batch_chunks_col = db["batch_chunks"] # Batch files in pages ({batch, n, files}); batches_col = header
+
     print("✅ MongoDB Connected!")
 except Exception as e:
     print(f"❌ DB Error: {e}")
 
-bot = telebot.TeleBot(BOT_TOKEN, parse_mode="Markdown")
+# ---------------- INDEXES ----------------
+# Har collection ke saare indexes yahin declare hote hain; startup pe (ya --ensure-indexes) apply
+TICKET_ORDER = [("created_at", -1), ("_id", -1)] # Reports panel order (index + keyset pagination dono)
+
+INDEX_SPECS = {
+    "users": [
+        ("is_banned", {}),                                   # Banned count (stats reconcile)
+        ("premium_expiry", {}),                              # Active premium count (stats reconcile), 'prem' broadcast
+    ],
+    "tickets": [
+        ("expire_at", {"expireAfterSeconds": 0}),            # Auto-delete tickets at the end of the week
+        (TICKET_ORDER, {}),                                  # Reports panel keyset pages (newest-first)
+    ],
+    "pro_proofs": [
+        ("owner_id", {}),                                    # Seller ke pending proofs
+    ],
+    "pending_payments": [
+        ("email", {}),                                       # Webhook/payment worker lookup
+        ("created_at", {"expireAfterSeconds": 172800}),      # Auto-delete pending email requests after 48 hours
+    ],
+    "unclaimed_payments": [
+        ("email", {}),                                       # User email submit pe lookup
+    ],
+    "redeems": [
+        ("expiry", {"expireAfterSeconds": 0}),               # Auto-delete code when expiry time is reached
+    ],
+    "redeem_usage": [
+        ([("user_id", 1), ("code", 1)], {"unique": True}),  # Ek user ek code sirf ek baar
+        ("code", {}),
+        ("expire_at", {"expireAfterSeconds": 0}),            # Usage record code ke expiry pe khud delete
+    ],
+    "bonuses": [
+        ("expire_at", {"expireAfterSeconds": 0}),            # Reads bhi expiry check karte hain (TTL ~60s late)
+    ],
+    "sessions": [
+        ("expire_at", {"expireAfterSeconds": 0}),            # Timed states + delete tombstones khud expire (expire_at None wale nahi)
+    ],
+    "auto_delete": [
+        ("delete_at", {}),                                   # Scheduler due tasks delete_at order mein uthata hai
+    ],
+    "verification_tokens": [
+        ("created_at", {"expireAfterSeconds": 1200}),        # Auto-delete verification tokens after 20 minutes
+    ],
+    "short_link_pool": [
+        ([("slot", 1), ("created_at", 1)], {}),
+        ("created_at", {"expireAfterSeconds": 1200}),        # Pool links bhi token TTL ke andar hi use hon
+    ],
+    "delivery_jobs": [
+        ([("status", 1), ("next_run_at", 1)], {}),           # Workers claim by status/run time
+        ([("status", 1), ("locked_until", 1)], {}),
+        ("completed_at", {"expireAfterSeconds": 259200}),    # Finished jobs auto-delete after 3 days
+    ],
+    "broadcasts": [
+        ("status", {}),                                      # Restart pe running broadcasts
+    ],
+    "broadcast_msgs": [
+        ([("bc_id", 1), ("sent_at", 1)], {}),
+        ("sent_at", {"expireAfterSeconds": 172800}),         # Telegram 48h ke baad delete allow nahi karta
+    ],
+    "batch_chunks": [
+        ([("batch", 1), ("n", 1)], {}),                      # Delivery chunks n order mein stream karti hai
+    ],
+    "batch_drafts": [
+        ("updated_at", {"expireAfterSeconds": 86400}),       # Abandoned upload drafts 1 din baad
+    ],
+    "wallet_ledger": [
+        ([("user_id", 1), ("at", -1)], {}),                  # Wallet history per user
+        ("ref", {"unique": True, "partialFilterExpression": {"ref": {"$exists": True}}}),
+    ],
+    "payment_events": [
+        ([("status", 1), ("next_run_at", 1)], {}),
+        ([("status", 1), ("locked_until", 1)], {}),
+        ("completed_at", {"expireAfterSeconds": 604800}),    # Gateway retries ke liye 7 din dedupe
+    ],
+    "outbox": [
+        ([("status", 1), ("next_run_at", 1)], {}),
+        ([("status", 1), ("locked_until", 1)], {}),
+        ("completed_at", {"expireAfterSeconds": 86400}),
+    ],
+}
+
+RETIRED_INDEXES = {
+    "tickets": ["created_at_-1"],                            # TICKET_ORDER compound index ne replace kiya
+}
+
+def index_keys(keys):
+    return [(keys, 1)] if isinstance(keys, str) else keys
+
+def ensure_indexes():
+    # create_index same spec pe no-op hai; sirf TTL badla ho to collMod se update
+    for name, specs in INDEX_SPECS.items():
+        for keys, opts in specs:
+            try:
+                db[name].create_index(index_keys(keys), **opts)
+            except pymongo.errors.OperationFailure as e:
+                if e.code in (85, 86) and "expireAfterSeconds" in opts:
+                    db.command("collMod", name, index={"keyPattern": dict(index_keys(keys)), "expireAfterSeconds": opts["expireAfterSeconds"]})
+                    print(f"🔧 TTL Updated: {name} {keys} -> {opts['expireAfterSeconds']}s")
+                else:
+                    print(f"❌ Index Error ({name} {keys}): {e}")
+    for name, retired in RETIRED_INDEXES.items():
+        for index_name in retired:
+            try:
+                db[name].drop_index(index_name)
+                print(f"🗑️ Index Dropped: {name} {index_name}")
+            except pymongo.errors.OperationFailure: pass # Pehle hi drop ho chuka
+
+def query_plans():
+    # App ki asli hot queries: (naam, collection, filter, sort)
+    now = datetime.now()
+    return [
+        ("pending payment by email", pending_payments_col, {"email": "a@b.c"}, None),
+        ("unclaimed payment by email", unclaimed_payments_col, {"email": "a@b.c"}, None),
+        ("seller proofs", pro_proofs_col, {"owner_id": 0}, None),
+        ("reports page", tickets_col, {}, TICKET_ORDER),
+        ("report page number", tickets_col, {"created_at": {"$gt": now}}, [(k, -d) for k, d in TICKET_ORDER]),
+        ("due auto-deletes", auto_delete_col, {"delete_at": {"$lte": now}}, [("delete_at", 1)]),
+        ("banned users", users_col, {"is_banned": True}, None),
+        ("active premium", users_col, {"premium_expiry": {"$gt": now}}, None),
+        ("delivery claim", delivery_jobs_col, {"status": "queued", "next_run_at": {"$lte": now}}, [("next_run_at", 1)]),
+        ("payment claim", payment_events_col, {"status": "queued", "next_run_at": {"$lte": now}}, [("next_run_at", 1)]),
+        ("outbox claim", outbox_col, {"status": "queued", "next_run_at": {"$lte": now}}, [("next_run_at", 1)]),
+        ("running broadcasts", broadcasts_col, {"status": "running"}, None),
+        ("broadcast ledger", broadcast_msgs_col, {"bc_id": "x"}, [("sent_at", 1)]),
+        ("batch chunks", batch_chunks_col, {"batch": "x"}, [("n", 1)]),
+        ("wallet history", wallet_ledger_col, {"user_id": 0}, [("at", -1)]),
+        ("redeem usage by code", redeem_usage_col, {"code": "X"}, None),
+        ("link pool take", short_link_pool_col, {"slot": 0, "created_at": {"$gt": now}}, [("created_at", 1)]),
+    ]
+
+def plan_stages(plan):
+    # winningPlan tree ke saare stage names (classic + SBE 'queryPlan' dono)
+    if isinstance(plan, dict):
+        if "stage" in plan: yield plan["stage"]
+        for value in plan.values(): yield from plan_stages(value)
+    elif isinstance(plan, list):
+        for item in plan: yield from plan_stages(item)
+
+def verify_queries():
+    failures = []
+    for name, col, query, sort in query_plans():
+        cursor = col.find(query)
+        if sort: cursor = cursor.sort(sort)
+        stages = set(plan_stages(cursor.explain().get("queryPlanner", {}).get("winningPlan", {})))
+        ok = "COLLSCAN" not in stages
+        print(f"{'✅' if ok else '❌ COLLSCAN'} {name} ({col.name}): {', '.join(sorted(stages))}")
+        if not ok: failures.append(name)
+    return failures
+
+if "--ensure-indexes" in sys.argv or "--verify-queries" in sys.argv:
+    if "--ensure-indexes" in sys.argv: ensure_indexes()
+    if "--verify-queries" in sys.argv and verify_queries():
+        print("❌ Query plan check failed (COLLSCAN)")
+        sys.exit(1)
+    sys.exit(0)
+
+try: ensure_indexes()
+except Exception as e: print(f"❌ Index Error: {e}")
+
+# ---------------- OUTBOUND RATE LIMITER ----------------
+# Har bot.* call yahin se guzarta hai (apihelper.CUSTOM_REQUEST_SENDER)
+GLOBAL_RATE = float(os.getenv("GLOBAL_RATE", "30"))  # Telegram ~30 msg/s total
+CHAT_RATE = float(os.getenv("CHAT_RATE", "1"))       # msgs/sec per chat
+CHAT_BURST = int(os.getenv("CHAT_BURST", "20"))      # short burst allowed per chat
+BULK_RESERVE = 0.2                                    # Itna quota interactive replies ke liye bacha rahe
+MAX_429_RETRIES = 3
+LIMITED_METHODS = ("send", "copy", "forward", "edit", "delete")
+PER_CHAT_METHODS = ("send", "copy", "forward")
+
+class TokenBucket:
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.blocked_until = 0
+        self.lock = threading.Lock()
+
+    def pause(self, seconds):
+        with self.lock:
+            self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+
+    def acquire(self, tokens=1):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if now >= self.blocked_until and self.tokens >= tokens:
+                    self.tokens -= tokens
+                    return
+                wait = max(self.blocked_until - now, (tokens - self.tokens) / self.rate)
+            time.sleep(wait)
+
+class OutboundScheduler:
+    # Global bucket; bulk traffic tabhi chalega jab koi interactive reply wait na kar raha ho
+    def __init__(self, rate):
+        self.rate = rate
+        self.tokens = rate
+        self.updated = time.monotonic()
+        self.blocked_until = 0
+        self.interactive_waiting = 0
+        self.cond = threading.Condition()
+
+    def pause(self, seconds):
+        with self.cond:
+            self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+
+    def acquire(self, bulk=False):
+        need = 1 + (self.rate * BULK_RESERVE if bulk else 0)
+        with self.cond:
+            if not bulk: self.interactive_waiting += 1
+            try:
+                while True:
+                    now = time.monotonic()
+                    self.tokens = min(self.rate, self.tokens + (now - self.updated) * self.rate)
+                    self.updated = now
+                    ready = now >= self.blocked_until and self.tokens >= need
+                    if ready and not (bulk and self.interactive_waiting):
+                        self.tokens -= 1
+                        return
+                    self.cond.wait(max(self.blocked_until - now, (need - self.tokens) / self.rate, 0.01))
+            finally:
+                if not bulk:
+                    self.interactive_waiting -= 1
+                    self.cond.notify_all()
+
+outbound = OutboundScheduler(GLOBAL_RATE)
+outbound_ctx = threading.local()
+chat_buckets = {}
+chat_buckets_lock = threading.Lock()
+tg_session = requests.Session()
+tg_session.mount("https://", requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=64))
+
+def get_chat_bucket(chat_id):
+    with chat_buckets_lock:
+        b = chat_buckets.get(chat_id)
+        if not b:
+            if len(chat_buckets) > 20000:
+                # Idle buckets (full ho chuke) hata do taaki RAM na bhare
+                idle = time.monotonic() - CHAT_BURST / CHAT_RATE
+                for k in [k for k, v in chat_buckets.items() if v.updated < idle]: del chat_buckets[k]
+            b = chat_buckets[chat_id] = TokenBucket(CHAT_RATE, CHAT_BURST)
+        return b
+
+@contextlib.contextmanager
+def bulk_traffic():
+    # Broadcast/cleanup jaise kaam is block mein chalao, interactive replies ko priority milegi
+    prev = getattr(outbound_ctx, "bulk", False)
+    outbound_ctx.bulk = True
+    try: yield
+    finally: outbound_ctx.bulk = prev
+
+def get_retry_after(response):
+    try:
+        data = response.json()
+        retry = data.get("parameters", {}).get("retry_after")
+        if retry is None:
+            m = re.search(r'retry after (\d+)', data.get("description", ""))
+            retry = m and m.group(1)
+        return float(retry or 1)
+    except Exception:
+        return 1.0
+
+def limited_request_sender(method, url, **kwargs):
+    api_method = url.rsplit("/", 1)[-1].lower()
+    chat_id = (kwargs.get("params") or {}).get("chat_id")
+    bulk = getattr(outbound_ctx, "bulk", False)
+    limited = api_method.startswith(LIMITED_METHODS)
+    per_chat = chat_id is not None and api_method.startswith(PER_CHAT_METHODS)
+
+    for attempt in range(MAX_429_RETRIES + 1):
+        if per_chat: get_chat_bucket(chat_id).acquire()
+        if limited: outbound.acquire(bulk)
+        r = tg_session.request(method, url, **kwargs)
+        if r.status_code != 429 or attempt == MAX_429_RETRIES: return r
+
+        retry_after = get_retry_after(r)
+        print(f"⏳ 429 on {api_method} (chat {chat_id}), retry after {retry_after}s", flush=True)
+        if per_chat: get_chat_bucket(chat_id).pause(retry_after)
+        elif limited: outbound.pause(retry_after)
+        else: time.sleep(retry_after)
+    return r
+
+apihelper.CUSTOM_REQUEST_SENDER = limited_request_sender
+
+# Updates hamare per-user lane dispatcher pe chalte hain, telebot ka apna pool nahi chahiye
+bot = telebot.TeleBot(BOT_TOKEN, parse_mode="Markdown", threaded=False)
 BOT_USERNAME = bot.get_me().username
 WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "default_secret_123")
+TG_WEBHOOK_SECRET = os.getenv("TG_WEBHOOK_SECRET", WEBHOOK_SECRET) # Telegram ke secret-token header ke liye
 
 # ---------------- COMMAND MENU SETTINGS ----------------
 def set_bot_commands():
@@ -110,40 +415,74 @@ def set_bot_commands():
 # Set commands on startup
 set_bot_commands()
 
-# ---------------- AUTO-DELETE SCHEDULER (RAM OPTIMIZED) ----------------
-def deletion_worker():
+# ---------------- AUTO-DELETE SCHEDULER (EVENT DRIVEN) ----------------
+# RAM mein sirf agle due tasks ka min-heap, baaki DB mein (delete_at index)
+DELETE_PREFETCH = 500
+DELETE_WINDOW = timedelta(minutes=10)   # Itne aage tak ke tasks heap mein laao
+DELETE_BULK_MAX = 100                   # deleteMessages ek call mein max 100 ids
+delete_heap = []
+delete_heap_ids = set()
+delete_horizon = datetime.min           # Isse pehle ke saare tasks heap mein hain
+delete_cond = threading.Condition()
+delete_pool = ThreadPoolExecutor(max_workers=4, thread_name_prefix="autodelete")
+
+def push_delete_task(task):
+    with delete_cond:
+        if task['delete_at'] > delete_horizon or task['_id'] in delete_heap_ids: return
+        heapq.heappush(delete_heap, (task['delete_at'], task['_id'], task['chat_id'], task['message_ids']))
+        delete_heap_ids.add(task['_id'])
+        delete_cond.notify()
+
+def refill_delete_heap():
+    global delete_horizon
+    window_end = datetime.now() + DELETE_WINDOW
+    docs = list(auto_delete_col.find({"delete_at": {"$lte": window_end}}).sort("delete_at", 1).limit(DELETE_PREFETCH))
+    with delete_cond:
+        # Limit hit hua to horizon last doc tak (kam se kam abhi tak), warna poori window cover ho gayi
+        # Backlog overdue ho to last doc past mein hota hai; clamp na karo to worker sirf refill karta rahega
+        delete_horizon = max(docs[-1]['delete_at'], datetime.now()) if len(docs) == DELETE_PREFETCH else window_end
+    for d in docs: push_delete_task(d)
+
+def delete_chat_messages(chat_id, message_ids):
+    with bulk_traffic():
+        for i in range(0, len(message_ids), DELETE_BULK_MAX):
+            chunk = message_ids[i:i + DELETE_BULK_MAX]
+            try:
+                if hasattr(bot, "delete_messages"): bot.delete_messages(chat_id, chunk)
+                else:
+                    for mid in chunk: delete_quietly(chat_id, mid)
+            except Exception: pass # Messages pehle hi delete ho chuke / 48h se purane
+
+def pop_due_delete_tasks():
+    # Jab tak kuch due na ho ya refill ka time na aaye, wait karo
+    with delete_cond:
+        while True:
+            now = datetime.now()
+            if delete_heap and delete_heap[0][0] <= now: break # Due tasks pehle, horizon check baad mein
+            if now >= delete_horizon: return None
+            wake_at = min(delete_heap[0][0], delete_horizon) if delete_heap else delete_horizon
+            delete_cond.wait(max(0.05, (wake_at - now).total_seconds()))
+        due = []
+        while delete_heap and delete_heap[0][0] <= now:
+            task = heapq.heappop(delete_heap)
+            delete_heap_ids.discard(task[1])
+            due.append(task)
+        return due
+
+def auto_delete_worker():
     while True:
         try:
-            now = datetime.now()
-            # 1. Clean up Auto-Delete Messages
-            pending = list(auto_delete_col.find({"delete_at": {"$lte": now}}))
-            for task in pending:
-                chat_id = task['chat_id']
-                for mid in task['message_ids']:
-                    try: bot.delete_message(chat_id, mid)
-                    except: pass
-                auto_delete_col.delete_one({"_id": task['_id']})
-            
-            # 2. Clean up Expired User Bonuses
-            users_col.update_many(
-                {"bonus_expiry": {"$lte": now}},
-                {"$unset": {"bonus_percent": "", "bonus_expiry": ""}}
-            )
-
-            # 3. Clean up invalid Redeem IDs from users' used_redeems list
-            # Get list of all currently active redeem IDs
-            active_redeem_ids = [r['_id'] for r in redeems_col.find({}, {"_id": 1})]
-            # Remove any ID from users' list that is NOT in the active list
-            users_col.update_many(
-                {},
-                {"$pull": {"used_redeems": {"$nin": active_redeem_ids}}}
-            )
-            
+            due = pop_due_delete_tasks()
+            if due is None:
+                refill_delete_heap()
+                continue
+            by_chat = {}
+            for _, _, chat_id, mids in due: by_chat.setdefault(chat_id, []).extend(mids)
+            list(delete_pool.map(lambda item: delete_chat_messages(*item), by_chat.items()))
+            auto_delete_col.delete_many({"_id": {"$in": [t[1] for t in due]}})
         except Exception as e:
-            print(f"❌ Scheduler Error: {e}")
-        time.sleep(60) # Run every minute
-
-threading.Thread(target=deletion_worker, daemon=True).start()
+            print(f"❌ Auto-Delete Scheduler Error: {e}")
+            time.sleep(5)
 
 # ---------------- WEBHOOK SERVER (FLASK) ----------------
 app = Flask(__name__)
@@ -172,59 +511,256 @@ def webhook():
 
         print(f"🔔 Webhook: Email={email}, Amt={paid_amount}", flush=True)
 
-        # 1. Pehle check karo koi User wait kar raha hai kya?
-        pending = pending_payments_col.find_one({"email": email})
-
-        if pending:
-            # --- NAYA LOGIC (Store Rupees directly) ---
-            user_id = pending['user_id']
-            
-            # Check for Bonus Percentage
-            u_data = users_col.find_one({"_id": user_id})
-            bonus = u_data.get("bonus_percent", 0) if u_data else 0
-            
-            final_amount = paid_amount + (paid_amount * (bonus / 100))
-            
-            # paid_amount is already in Rupees (₹)
-            add_credits(user_id, final_amount)
-
-            credit_val = CREDIT_CONFIG.get("value", 1.0)
-            credits_added_display = final_amount / credit_val
-
-            bonus_str = f" (including {bonus}% bonus)" if bonus > 0 else ""
-            try: bot.send_message(user_id, f"✅ *Payment Confirmed!*\n₹{paid_amount} received. {credits_added_display} Credits added to your wallet{bonus_str}.")
-            except: pass
-                
-            pending_payments_col.delete_one({"_id": pending['_id']})
-            return jsonify({"status": "success"}), 200
-        
-        else:
-            # --- NAYA LOGIC (Agar User nahi mila to SAVE kar lo) ---
-            print(f"💾 Saving Unclaimed Payment for {email}", flush=True)
-            unclaimed_payments_col.insert_one({
-                "email": email,
-                "amount": paid_amount,
-                "timestamp": datetime.now()
-            })
-            return jsonify({"status": "saved", "message": "Payment stored for later claim"}), 200
+        # Sirf event save karke turant ACK; credit/notification background worker karega
+        if not enqueue_payment_event(payment_event_key(data), email, paid_amount, data):
+            return jsonify({"status": "duplicate"}), 200
+        return jsonify({"status": "accepted"}), 200
 
     except Exception as e:
         print(f"Error: {e}", flush=True)
         return jsonify({"status": "error"}), 500
+
+# ---------------- UPDATE DISPATCHER (PER-USER LANES) ----------------
+# Same user ke updates hamesha same lane pe (order safe), alag users parallel
+class UpdateDispatcher:
+    def __init__(self, lanes, queue_size):
+        self.lanes = [queue.Queue(maxsize=queue_size) for _ in range(lanes)]
+        self.stats = [{"processed": 0, "last_ms": 0.0, "avg_ms": 0.0, "max_ms": 0.0} for _ in range(lanes)]
+
+    def start(self):
+        for i in range(len(self.lanes)):
+            threading.Thread(target=self.run_lane, args=(i,), daemon=True, name=f"lane-{i}").start()
+
+    @staticmethod
+    def update_key(update):
+        for obj in (update.message, update.edited_message, update.callback_query):
+            if obj is not None and obj.from_user: return obj.from_user.id
+        return update.update_id
+
+    def submit(self, update, block=True):
+        # block=False: lane full ho to False (webhook 503 karega)
+        lane = self.lanes[self.update_key(update) % len(self.lanes)]
+        try: lane.put((update, time.monotonic()), block=block)
+        except queue.Full: return False
+        return True
+
+    def run_lane(self, i):
+        lane, stats = self.lanes[i], self.stats[i]
+        while True:
+            update, queued_at = lane.get()
+            try: bot.process_new_updates([update])
+            except Exception as e:
+                print(f"❌ Update Error (lane {i}): {e}")
+                traceback.print_exc()
+            ms = (time.monotonic() - queued_at) * 1000
+            stats["processed"] += 1
+            stats["last_ms"] = ms
+            stats["avg_ms"] = ms if stats["processed"] == 1 else stats["avg_ms"] * 0.9 + ms * 0.1
+            stats["max_ms"] = max(stats["max_ms"], ms)
+
+    def metrics(self):
+        return {
+            "queue_depth": sum(q.qsize() for q in self.lanes),
+            "lanes": [dict(s, depth=q.qsize()) for q, s in zip(self.lanes, self.stats)]
+        }
+
+dispatcher = UpdateDispatcher(UPDATE_WORKERS, max(1, UPDATE_QUEUE_SIZE // UPDATE_WORKERS))
+metrics_providers = {"dispatcher": dispatcher.metrics}
+
+@app.route('/metrics')
+def metrics():
+    if request.args.get('secret') != WEBHOOK_SECRET:
+        return jsonify({"status": "unauthorized"}), 403
+    return jsonify({name: provider() for name, provider in metrics_providers.items()})
+
+# ---------------- TELEGRAM WEBHOOK (UPDATE INGESTION) ----------------
+@app.route('/telegram', methods=['POST'])
+def telegram_webhook():
+    if request.headers.get('X-Telegram-Bot-Api-Secret-Token') != TG_WEBHOOK_SECRET:
+        return jsonify({"status": "unauthorized"}), 403
+    try:
+        update = types.Update.de_json(request.get_data(as_text=True))
+    except Exception:
+        return jsonify({"status": "error"}), 400
+    if not dispatcher.submit(update, block=False):
+        # Telegram khud retry karega, isliye 503 dena safe hai
+        return jsonify({"status": "busy"}), 503
+    return "", 200
+
+def start_webhook_mode():
+    bot.remove_webhook()
+    bot.set_webhook(url=f"{TG_WEBHOOK_URL}/telegram", secret_token=TG_WEBHOOK_SECRET, max_connections=100)
+    print(f"🌐 Webhook Set: {TG_WEBHOOK_URL}/telegram")
+
+def poll_updates():
+    # Long polling; lane full ho to yahin ruk jaate hain (backpressure)
+    bot.remove_webhook() # Webhook set ho to getUpdates 409 deta hai
+    offset = None
+    while True:
+        try:
+            updates = bot.get_updates(offset=offset, timeout=20, long_polling_timeout=10)
+            for update in updates:
+                offset = update.update_id + 1
+                dispatcher.submit(update)
+        except Exception as e:
+            print(f"⚠️ Polling Error: {e}")
+            time.sleep(3)
+
 def run_flask():
     app.run(host="0.0.0.0", port=int(os.environ.get("PORT", 8080)))
 
 # Start Flask in a separate thread
-threading.Thread(target=run_flask, daemon=True).start()
+flask_thread = threading.Thread(target=run_flask, daemon=True)
+flask_thread.start()
+
+
+# ---------------- STATE STORE ----------------
+# Conversation state memory ya Mongo mein; Mongo se multiple replicas + restart safe.
+# NOTE: get() se mila dict badalne ke baad wapas assign karna zaroori hai (Mongo copy deta hai).
+STATE_BACKEND = os.getenv("STATE_BACKEND", "memory").lower()
+STATE_TTL = int(os.getenv("STATE_TTL", "0"))  # Bina timeout wale states ka TTL; 0 = kabhi expire nahi (purana behaviour)
+
+def state_expiry(ttl):
+    # Explicit ttl > STATE_TTL > None (kabhi expire nahi)
+    ttl = ttl or STATE_TTL
+    return datetime.now() + timedelta(seconds=ttl) if ttl else None
+
+STATE_TOMBSTONE_SECS = 600  # Delete ke baad version itni der yaad (compare_and_set ABA se bachav)
+
+class MemoryStateStore:
+    SWEEP_SECS = 60
+
+    def __init__(self):
+        self.data = {}  # (ns, key) -> (value, version, expires); delete ke baad value None wala tombstone
+        self.stamp = 0  # Versions global counter se: delete + recreate pe purana version wapas nahi aata
+        self.swept = time.time()
+        self.lock = threading.Lock()
+
+    def put(self, ns, key, value, ttl):
+        # lock ke andar call karo
+        self.stamp += 1
+        ttl = ttl or STATE_TTL
+        self.data[(ns, key)] = (value, self.stamp, time.time() + ttl if ttl else float("inf"))
+        self.sweep()
+
+    def sweep(self):
+        # Expired entries/tombstones writes pe hi saaf (read pe hatane se map badhta hi rehta tha)
+        now = time.time()
+        if now - self.swept < self.SWEEP_SECS: return
+        self.swept = now
+        for k in [k for k, (_, _, expires) in self.data.items() if expires <= now]: del self.data[k]
+
+    def get(self, ns, key):
+        # Returns (value, version); expired value None milti hai par version wahi rehta hai
+        with self.lock:
+            item = self.data.get((ns, key))
+            if not item: return None, 0
+            value, version, expires = item
+            return (value if expires > time.time() else None), version
+
+    def set(self, ns, key, value, ttl=None):
+        with self.lock: self.put(ns, key, value, ttl)
+
+    def delete(self, ns, key):
+        with self.lock:
+            if (ns, key) in self.data: self.put(ns, key, None, STATE_TOMBSTONE_SECS)
+
+    def compare_and_set(self, ns, key, version, value, ttl=None):
+        # value None = delete
+        with self.lock:
+            current = self.data.get((ns, key), (None, 0, 0))[1]
+            if current != version: return False
+            if value is None and not current: return True
+            self.put(ns, key, value, STATE_TOMBSTONE_SECS if value is None else ttl)
+            return True
+
+class MongoStateStore:
+    def __init__(self, col):
+        self.col = col
+
+    def tombstone(self):
+        # Doc hatane ki jagah value None + version badhao; TTL index baad mein saaf karta hai
+        return {"$set": {"value": None, "expire_at": datetime.now() + timedelta(seconds=STATE_TOMBSTONE_SECS)}, "$inc": {"version": 1}}
+
+    def get(self, ns, key):
+        doc = self.col.find_one({"_id": f"{ns}:{key}"})
+        if not doc: return None, 0
+        expired = doc.get("expire_at") and doc["expire_at"] <= datetime.now()
+        return (None if expired else doc.get("value")), doc.get("version", 0)
+
+    def set(self, ns, key, value, ttl=None):
+        self.col.update_one(
+            {"_id": f"{ns}:{key}"},
+            {"$set": {"value": value, "expire_at": state_expiry(ttl)}, "$inc": {"version": 1}},
+            upsert=True
+        )
+
+    def delete(self, ns, key):
+        self.col.update_one({"_id": f"{ns}:{key}"}, self.tombstone())
+
+    def compare_and_set(self, ns, key, version, value, ttl=None):
+        _id = f"{ns}:{key}"
+        if value is None:
+            return self.col.update_one({"_id": _id, "version": version}, self.tombstone()).modified_count == 1
+        fields = {"value": value, "expire_at": state_expiry(ttl)}
+        if version == 0:
+            try: self.col.insert_one(dict(fields, _id=_id, version=1))
+            except DuplicateKeyError: return False
+            return True
+        return self.col.update_one({"_id": _id, "version": version}, {"$set": fields, "$inc": {"version": 1}}).modified_count == 1
+
+class StateMap:
+    # Purane dict jaisa interface (get / [] / pop / in / del), store ke upar
+    def __init__(self, store, ns, ttls=None):
+        self.store = store
+        self.ns = ns
+        self.ttls = ttls  # state name -> TTL (seconds), value['state'] se match hota hai
+
+    def ttl_for(self, value, ttl):
+        if ttl or not self.ttls or not isinstance(value, dict): return ttl
+        return self.ttls.get(value.get('state'))
+
+    def get(self, key, default=None):
+        value, _ = self.store.get(self.ns, key)
+        return default if value is None else value
 
+    def get_versioned(self, key):
+        return self.store.get(self.ns, key)
 
-# ---------------- IN-MEMORY STATE ----------------
-user_states = {}             
-user_support_state = {}      
-active_chats = {}            
-user_ticket_reply = {}       
-active_user_code = {}        
-last_broadcast_ids = []      
+    def compare_and_set(self, key, version, value, ttl=None):
+        return self.store.compare_and_set(self.ns, key, version, value, self.ttl_for(value, ttl))
+
+    def set(self, key, value, ttl=None):
+        if value is None: self.store.delete(self.ns, key)
+        else: self.store.set(self.ns, key, value, self.ttl_for(value, ttl))
+
+    def __getitem__(self, key):
+        value = self.get(key)
+        if value is None: raise KeyError(key)
+        return value
+
+    def __setitem__(self, key, value):
+        self.set(key, value)
+
+    def __delitem__(self, key):
+        self.store.delete(self.ns, key)
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+    def pop(self, key, default=None):
+        value = self.get(key)
+        if value is None: return default
+        self.store.delete(self.ns, key)
+        return value
+
+state_store = MongoStateStore(sessions_col) if STATE_BACKEND == "mongo" else MemoryStateStore()
+input_timeouts = {}  # INPUT HANDLERS mein input_state(timeout=...) se bharta hai
+user_states = StateMap(state_store, "user_states", ttls=input_timeouts)
+user_support_state = StateMap(state_store, "support")
+active_chats = StateMap(state_store, "active_chats")
+user_ticket_reply = StateMap(state_store, "ticket_reply")
+active_user_code = StateMap(state_store, "user_code")
 
 # ---------------- SETTINGS MANAGER ----------------
 def get_setting(key, default):
@@ -251,7 +787,281 @@ CREDIT_CONFIG = get_setting("credit", {"value": 1.0})
 
 PLAN_DAYS = {"7": 7, "15": 15, "1M": 30, "6M": 180}
 
+# ---------------- BACKGROUND TASKS ----------------
+# Jo kaam reply ke liye zaroori nahi (log messages waghera) wo yahan jaate hain
+background_tasks = queue.Queue(maxsize=10000)
+
+def run_in_background(func, *args):
+    try: background_tasks.put_nowait((func, args))
+    except queue.Full: print(f"⚠️ Background queue full, dropped {func.__name__}")
+
+def background_worker():
+    while True:
+        func, args = background_tasks.get()
+        try: func(*args)
+        except Exception as e: print(f"❌ Background Task Error ({func.__name__}): {e}")
+
+# ---------------- USER CACHE ----------------
+# Hot helpers (is_banned/is_premium/...) ek hi user doc baar baar padhte hain
+USER_CACHE_SIZE = int(os.getenv("USER_CACHE_SIZE", "50000"))
+USER_CACHE_TTL = int(os.getenv("USER_CACHE_TTL", "60"))  # seconds
+
+class UserCache:
+    MISSING = object()
+
+    def __init__(self, maxsize, ttl):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.data = OrderedDict()
+        # Per-key version: sirf usi user ka invalidate uska fill rokta hai (global counter pe har write sab fills gira deta tha)
+        # Stamp global counter se aata hai (kabhi repeat nahi); sirf latest maxsize keys yaad, purane fill itne lambe nahi chalte
+        self.versions = OrderedDict()
+        self.stamp = 0
+        self.lock = threading.Lock()
+
+    def version_of(self, key):
+        with self.lock: return self.versions.get(key, 0)
+
+    def get(self, key):
+        with self.lock:
+            item = self.data.get(key)
+            if item is None: return self.MISSING
+            expires, value = item
+            if expires < time.monotonic():
+                del self.data[key]
+                return self.MISSING
+            self.data.move_to_end(key)
+            return value
+
+    def set(self, key, value, version=None):
+        with self.lock:
+            if version is not None and version != self.versions.get(key, 0): return
+            self.data[key] = (time.monotonic() + self.ttl, value)
+            self.data.move_to_end(key)
+            while len(self.data) > self.maxsize: self.data.popitem(last=False)
+
+    def invalidate(self, key):
+        with self.lock:
+            self.stamp += 1
+            self.versions[key] = self.stamp
+            self.versions.move_to_end(key)
+            while len(self.versions) > self.maxsize: self.versions.popitem(last=False)
+            self.data.pop(key, None)
+
+user_cache = UserCache(USER_CACHE_SIZE, USER_CACHE_TTL)
+
+def get_user(user_id):
+    # Returned doc shared hai, isko mutate mat karna
+    u = user_cache.get(user_id)
+    if u is not UserCache.MISSING: return u
+    version = user_cache.version_of(user_id)
+    u = users_col.find_one({"_id": user_id})
+    user_cache.set(user_id, u, version)
+    return u
+
+def update_user(user_id, update, upsert=False):
+    # Write-through: DB update ke baad cache entry hatao
+    res = users_col.update_one({"_id": user_id}, update, upsert=upsert)
+    user_cache.invalidate(user_id)
+    return res
+
+# ---------------- WALLET ----------------
+# Har movement ek atomic find_one_and_update + ledger entry; updated doc seedha cache mein
+def cache_user_doc(user_id, doc):
+    user_cache.invalidate(user_id)
+    if doc: user_cache.set(user_id, doc, user_cache.version_of(user_id))
+
+def record_wallet_move(user_id, amount, balance, reason, ref=None):
+    entry = {"user_id": user_id, "amount": amount, "balance": balance, "reason": reason, "at": datetime.now()}
+    if ref: entry["ref"] = ref
+    try: wallet_ledger_col.insert_one(entry)
+    except Exception as e: print(f"⚠️ Ledger Write Failed ({user_id}, {reason}): {e}")
+
+def get_credits(user_id):
+    u = get_user(user_id)
+    return u.get("credits", 0) if u else 0
+
+WALLET_REFS_KEEP = 50 # User doc mein last itne applied refs (idempotent credits ke liye)
+
+def add_credits(user_id, amount, reason="credit", ref=None):
+    # ref ho to idempotent: wahi ref dobara aaye to credit nahi hota (None return)
+    query, update = {"_id": user_id}, {"$inc": {"credits": amount}}
+    if ref:
+        query["wallet_refs"] = {"$ne": ref}
+        update["$push"] = {"wallet_refs": {"$each": [ref], "$slice": -WALLET_REFS_KEEP}}
+    try:
+        doc = users_col.find_one_and_update(query, update, upsert=True, return_document=pymongo.ReturnDocument.AFTER)
+    except DuplicateKeyError:
+        return None # User hai aur ref already applied (upsert insert try karta hai)
+    cache_user_doc(user_id, doc)
+    record_wallet_move(user_id, amount, doc.get("credits", 0), reason, ref)
+    return doc.get("credits", 0)
+
+def debit_credits(user_id, amount, reason, ref=None):
+    # Balance check aur debit ek hi query mein: do taps ek saath double-spend nahi kar sakte
+    # Returns naya balance, ya None agar credits kam hain
+    doc = users_col.find_one_and_update(
+        {"_id": user_id, "credits": {"$gte": amount}}, {"$inc": {"credits": -amount}},
+        return_document=pymongo.ReturnDocument.AFTER
+    )
+    if not doc: return None
+    cache_user_doc(user_id, doc)
+    record_wallet_move(user_id, -amount, doc.get("credits", 0), reason, ref)
+    return doc.get("credits", 0)
+
+# ---------------- LIVE STATS ----------------
+# Status panel ek chhota doc padhta hai; har mutation pe $inc, background mein indexed counts se reconcile
+STATS_ID = "live_stats" # settings collection mein
+STATS_RECONCILE_SECS = int(os.getenv("STATS_RECONCILE_SECS", "300"))
+
+def bump_stats(**deltas):
+    try: settings_col.update_one({"_id": STATS_ID}, {"$inc": deltas}, upsert=True)
+    except Exception as e: print(f"⚠️ Stats Update Failed ({deltas}): {e}")
+
+def reconcile_stats():
+    # Premium expiry aur ticket TTL chupchap hote hain, unka drift yahin theek hota hai
+    stats = {
+        "users": users_col.estimated_document_count(),
+        "banned": users_col.count_documents({"is_banned": True}),
+        "premium": users_col.count_documents({"premium_expiry": {"$gt": datetime.now()}}),
+        "reports": tickets_col.count_documents({}),
+        "reconciled_at": datetime.now()
+    }
+    settings_col.update_one({"_id": STATS_ID}, {"$set": stats}, upsert=True)
+    return stats
+
+def get_live_stats():
+    doc = settings_col.find_one({"_id": STATS_ID})
+    if not doc or "reconciled_at" not in doc: doc = reconcile_stats() # Pehli baar (ya sirf $inc wala doc)
+    return doc
+
+def stats_worker():
+    while True:
+        try: reconcile_stats()
+        except Exception as e: print(f"❌ Stats Reconcile Error: {e}")
+        time.sleep(STATS_RECONCILE_SECS)
+
+# ---------------- SHORTENER CLIENT ----------------
+# Shared keep-alive session, strict timeouts, aur har shortener domain ka apna circuit breaker
+SHORTENER_TIMEOUT = (3, 5)   # (connect, read) seconds
+SHORTENER_RETRIES = 2
+BREAKER_FAILURES = 5         # Itni lagatar failures pe slot trip
+BREAKER_COOLDOWN = 60        # Trip ke baad itne sec skip, phir sirf ek trial request (baaki fail-fast)
+
+shortener_session = requests.Session()
+shortener_session.mount("https://", requests.adapters.HTTPAdapter(
+    pool_connections=8, pool_maxsize=16,
+    max_retries=Retry(total=SHORTENER_RETRIES, backoff_factor=0.3, status_forcelist=(500, 502, 503, 504))
+))
+
+class ShortenerHealth:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.failures = 0      # Lagatar failures (success pe reset)
+        self.open_until = 0    # 0 = closed; cooldown ke baad half-open
+        self.probing = False   # Half-open mein ek hi caller trial karta hai
+        self.stats = {"requests": 0, "errors": 0, "avg_ms": 0.0, "max_ms": 0.0, "last_error": None}
+
+    def allow(self):
+        # Sirf check (slot choose karne ke liye); trial claim acquire() karta hai
+        with self.lock: return not self.open_until or (time.time() >= self.open_until and not self.probing)
+
+    def acquire(self):
+        # Asli request se pehle: half-open mein pehla caller probe banta hai, baaki probe khatam hone tak fail-fast
+        with self.lock:
+            if not self.open_until: return True
+            if time.time() < self.open_until or self.probing: return False
+            self.probing = True
+            return True
+
+    def record(self, ok, ms, error=None):
+        with self.lock:
+            self.probing = False
+            stats = self.stats
+            stats["requests"] += 1
+            stats["avg_ms"] = ms if stats["requests"] == 1 else stats["avg_ms"] * 0.9 + ms * 0.1
+            stats["max_ms"] = max(stats["max_ms"], ms)
+            if ok:
+                self.failures = 0
+                self.open_until = 0
+                return
+            stats["errors"] += 1
+            stats["last_error"] = error
+            self.failures += 1
+            if self.failures >= BREAKER_FAILURES: self.open_until = time.time() + BREAKER_COOLDOWN
+
+    def metrics(self):
+        with self.lock:
+            return dict(self.stats,
+                        error_rate=round(self.stats["errors"] / max(1, self.stats["requests"]), 3),
+                        state="closed" if not self.open_until else "open" if time.time() < self.open_until else "half-open")
+
+shortener_health = {}  # domain -> ShortenerHealth
+shortener_health_lock = threading.Lock()
+
+def get_shortener_health(domain):
+    with shortener_health_lock:
+        health = shortener_health.get(domain)
+        if not health: health = shortener_health[domain] = ShortenerHealth()
+        return health
+
+def shortener_metrics():
+    with shortener_health_lock: items = list(shortener_health.items())
+    return {domain: health.metrics() for domain, health in items}
+
+metrics_providers["shorteners"] = shortener_metrics
+
+def is_shortener_usable(shortener):
+    if not shortener or not shortener.get("api") or not shortener.get("url"): return False
+    return get_shortener_health(shortener["url"]).allow()
+
+def pick_shortener_slot(shorteners, start):
+    # start se round-robin, par tripped slots skip (sab down hon to start hi)
+    for step in range(len(shorteners)):
+        idx = (start + step) % len(shorteners)
+        if is_shortener_usable(shorteners[idx]): return idx
+    return start
+
+def get_short_link(destination_url, shortener=None):
+    if not shortener or not shortener.get("api") or not shortener.get("url"): return destination_url
+    health = get_shortener_health(shortener["url"])
+    if not health.acquire(): return destination_url
+    started = time.monotonic()
+    try:
+        r = shortener_session.get(f"https://{shortener['url']}/api",
+                                  params={"api": shortener["api"], "url": destination_url},
+                                  timeout=SHORTENER_TIMEOUT).json()
+        short_link = r.get("shortenedUrl") if r.get("status") == "success" or "shortenedUrl" in r else None
+        health.record(bool(short_link), (time.monotonic() - started) * 1000,
+                      None if short_link else f"API: {r.get('message') or r.get('status')}")
+        return short_link or destination_url
+    except Exception as e:
+        health.record(False, (time.monotonic() - started) * 1000, str(e)[:200])
+        return destination_url
+
+# Shortener call (3 tries x (3s connect + 5s read) + backoff = worst case ~25s) dispatcher lane pe chale to us lane ke baaki users ruk jaate hain
+SHORTENER_WORKERS = int(os.getenv("SHORTENER_WORKERS", "8"))
+shortener_pool = ThreadPoolExecutor(max_workers=SHORTENER_WORKERS, thread_name_prefix="shortener")
+
+def run_off_lane(func, *args):
+    # Shortener wala kaam + uska reply yahan; lane turant free
+    def task():
+        try: func(*args)
+        except Exception as e: print(f"❌ Shortener Task Error ({func.__name__}): {e}")
+    shortener_pool.submit(task)
+
 # ---------------- HELPERS ----------------
+def run_later(delay, func, *args):
+    # Handler thread ko sleep karane ki jagah timer pe chalao
+    t = threading.Timer(delay, func, args=args)
+    t.daemon = True
+    t.start()
+    return t
+
+def delete_quietly(chat_id, message_id):
+    try: bot.delete_message(chat_id, message_id)
+    except: pass
+
 def smart_edit(chat_id, message_id, text, reply_markup=None, parse_mode="Markdown"):
     try:
         bot.edit_message_caption(text, chat_id, message_id, reply_markup=reply_markup, parse_mode=parse_mode)
@@ -283,44 +1093,66 @@ def smart_edit_report(chat_id, message_id, text, photo=None, reply_markup=None):
     smart_edit(chat_id, message_id, text, reply_markup)
 
 def save_user(user_id):
+    # Ek hi round trip: naya user ho to insert, purana ho to bas bc_blocked hatao.
+    # BEFORE doc None matlab abhi insert hua; dono cases mein cache bhi bhar jata hai.
     try:
-        if not users_col.find_one({"_id": user_id}):
-            users_col.insert_one({
-                "_id": user_id,
-                "joined_at": datetime.now(),
-                "is_banned": False,
-                "premium_expiry": None,
-                "verification_expiry": None,
-                "upi_id": None,
-                "credits": 0,
-                "last_shortener_index": -1,
-                "personal_shortener": {"api": None, "url": None},
-                "bonus_percent": 0,
-                "used_redeems": [],
-                "support_reports": {"date": None, "count": 0}
-            })
-            log_to_user_channel(f"🆕 *New User Joined*\nID: `{user_id}`")
-    except: pass
+        defaults = {
+            "joined_at": datetime.now(),
+            "is_banned": False,
+            "premium_expiry": None,
+            "verification_expiry": None,
+            "upi_id": None,
+            "credits": 0,
+            "last_shortener_index": -1,
+            "personal_shortener": {"api": None, "url": None},
+            "support_reports": {"date": None, "count": 0}
+        }
+        version = user_cache.version_of(user_id)
+        before = users_col.find_one_and_update(
+            {"_id": user_id},
+            {"$setOnInsert": defaults, "$unset": {"bc_blocked": ""}},
+            upsert=True,
+            return_document=pymongo.ReturnDocument.BEFORE
+        )
+        if before is None:
+            user_cache.set(user_id, dict(defaults, _id=user_id), version)
+            bump_stats(users=1)
+            run_in_background(log_to_user_channel, f"🆕 *New User Joined*\nID: `{user_id}`")
+            return True
+        before.pop("bc_blocked", None)
+        user_cache.set(user_id, before, version)
+    except Exception as e:
+        print(f"⚠️ save_user failed ({user_id}): {e}")
+    return False
 
-def get_credits(user_id):
-    u = users_col.find_one({"_id": user_id})
-    return u.get("credits", 0) if u else 0
+def get_active_bonus(user_id):
+    # TTL monitor ~60s late chalta hai, isliye expiry yahin bhi check karo
+    b = bonuses_col.find_one({"_id": user_id})
+    if b and b.get("expire_at") and b["expire_at"] > datetime.now(): return b.get("percent", 0)
+    return 0
 
-def add_credits(user_id, amount):
-    users_col.update_one({"_id": user_id}, {"$inc": {"credits": amount}}, upsert=True)
+def set_bonus(user_id, percent, expire_at):
+    bonuses_col.update_one({"_id": user_id}, {"$set": {"percent": percent, "expire_at": expire_at}}, upsert=True)
 
 def is_banned(user_id):
-    u = users_col.find_one({"_id": user_id})
+    u = get_user(user_id)
     return u.get("is_banned", False) if u else False
 
+def set_banned(user_id, banned):
+    # Sirf asli change pe counter hilao (dobara ban karne se double count nahi)
+    res = users_col.update_one({"_id": user_id, "is_banned": {"$ne": banned}}, {"$set": {"is_banned": banned}})
+    user_cache.invalidate(user_id)
+    if res.modified_count: bump_stats(banned=1 if banned else -1)
+    return res.modified_count
+
 def is_premium(user_id):
     if user_id == ADMIN_ID: return True
     try:
-        u = users_col.find_one({"_id": user_id})
+        u = get_user(user_id)
         if not u or not u.get("premium_expiry"): return False
         if isinstance(u["premium_expiry"], datetime):
             if datetime.now() > u["premium_expiry"]:
-                users_col.update_one({"_id": user_id}, {"$set": {"premium_expiry": None}})
+                update_user(user_id, {"$set": {"premium_expiry": None}})
                 return False
             return True
     except: pass
@@ -329,7 +1161,7 @@ def is_premium(user_id):
 def get_premium_expiry(user_id):
     if user_id == ADMIN_ID: return "Lifetime"
     try:
-        u = users_col.find_one({"_id": user_id})
+        u = get_user(user_id)
         if u and u.get("premium_expiry"):
             if isinstance(u["premium_expiry"], datetime):
                 return u["premium_expiry"].strftime("%d-%b-%Y %I:%M %p")
@@ -339,14 +1171,18 @@ def get_premium_expiry(user_id):
 
 def set_premium(user_id, days):
     expiry = datetime.now() + timedelta(days=days)
-    users_col.update_one({"_id": user_id}, {"$set": {"premium_expiry": expiry}})
+    before = users_col.find_one_and_update({"_id": user_id}, {"$set": {"premium_expiry": expiry}}, {"premium_expiry": 1})
+    user_cache.invalidate(user_id)
+    # Extend karne pe count same; expire hone wale reconcile pe ghatte hain
+    prev = before.get("premium_expiry") if before else None
+    if before and not (isinstance(prev, datetime) and prev > datetime.now()): bump_stats(premium=1)
 
 def is_verified(user_id):
     if user_id == ADMIN_ID: return True
     if is_premium(user_id): return True
     if not SHORTNER_CONFIG.get("active"): return True
     try:
-        u = users_col.find_one({"_id": user_id})
+        u = get_user(user_id)
         if u and u.get("verification_expiry"):
             if isinstance(u["verification_expiry"], datetime):
                 if datetime.now() < u["verification_expiry"]: return True
@@ -355,28 +1191,19 @@ def is_verified(user_id):
 
 def set_verification(user_id, hours):
     expiry = datetime.now() + timedelta(hours=hours)
-    users_col.update_one({"_id": user_id}, {"$set": {"verification_expiry": expiry}}, upsert=True)
+    update_user(user_id, {"$set": {"verification_expiry": expiry}}, upsert=True)
 
 def get_user_upi(user_id):
-    u = users_col.find_one({"_id": user_id})
+    u = get_user(user_id)
     return u.get("upi_id") if u else None
 
 def update_user_upi(user_id, upi):
-    users_col.update_one({"_id": user_id}, {"$set": {"upi_id": upi}}, upsert=True)
+    update_user(user_id, {"$set": {"upi_id": upi}}, upsert=True)
 
 def gen_code(length=6):
     while True:
         code = ''.join(random.choices(string.ascii_lowercase + string.digits, k=length))
-        if not batches_col.find_one({"_id": code}): return code
-
-def get_short_link(destination_url, shortener=None):
-    try:
-        if not shortener or not shortener.get("api") or not shortener.get("url"): return destination_url
-        api_url = f"https://{shortener['url']}/api?api={shortener['api']}&url={destination_url}"
-        r = requests.get(api_url).json()
-        if r.get("status") == "success" or "shortenedUrl" in r: return r.get("shortenedUrl")
-        return destination_url
-    except: return destination_url
+        if not batches_col.find_one({"_id": code}, {"_id": 1}): return code
 
 def check_force_join(user_id):
     if user_id == ADMIN_ID: return True, []
@@ -454,23 +1281,89 @@ def get_custom_markup():
     except: pass
     return markup
 
+# ---------------- TICKET PAGINATION ----------------
+# Sirf dikhaya ja raha page fetch hota hai: (created_at, _id) keyset + cached total/page anchors
+REPORTS_PER_PAGE = 10
+REPORTS_CACHE_SECS = 30  # TTL index tickets chupchap hataata hai, isliye cache bhi expire hota hai
+ticket_page_cache = {"total": None, "anchors": {}, "at": 0}  # anchors: page -> us page ka last (created_at, _id)
+ticket_page_lock = threading.Lock()
+
+def fresh_ticket_cache():
+    # ticket_page_lock ke andar call karo
+    if time.time() - ticket_page_cache["at"] > REPORTS_CACHE_SECS:
+        ticket_page_cache.update(total=None, anchors={}, at=time.time())
+    return ticket_page_cache
+
+def invalidate_ticket_pages():
+    # Ticket insert/delete pe pages shift hote hain
+    with ticket_page_lock: ticket_page_cache["at"] = 0
+
+def count_tickets():
+    with ticket_page_lock: total = fresh_ticket_cache()["total"]
+    if total is None:
+        total = tickets_col.count_documents({})
+        with ticket_page_lock: fresh_ticket_cache()["total"] = total
+    return total
+
+def older_than(created_at, tid):
+    return {"$or": [{"created_at": {"$lt": created_at}}, {"created_at": created_at, "_id": {"$lt": tid}}]}
+
+def newer_than(created_at, tid):
+    return {"$or": [{"created_at": {"$gt": created_at}}, {"created_at": created_at, "_id": {"$gt": tid}}]}
+
+def cache_ticket_anchor(page, ticket):
+    with ticket_page_lock: fresh_ticket_cache()["anchors"][page] = (ticket["created_at"], ticket["_id"])
+
+def seed_ticket_anchor(page):
+    # Page (page-1) ka last ticket ek index-only query se: jo end paas ho wahan se chhota skip
+    pos, total = (page - 1) * REPORTS_PER_PAGE - 1, count_tickets()
+    if pos >= total: return None
+    order, skip = TICKET_ORDER, pos
+    if pos > total // 2: order, skip = [(k, -d) for k, d in TICKET_ORDER], total - 1 - pos
+    found = list(tickets_col.find({}, {"created_at": 1}).sort(order).skip(skip).limit(1))
+    if not found: return None
+    cache_ticket_anchor(page - 1, found[0])
+    return (found[0]["created_at"], found[0]["_id"])
+
+def fetch_ticket_page(page):
+    # Cached anchor ho to seedha keyset; warna ek bounded seed query, phir keyset (beech ke pages walk nahi hote)
+    with ticket_page_lock: anchor = fresh_ticket_cache()["anchors"].get(page - 1)
+    if page > 1 and not anchor:
+        anchor = seed_ticket_anchor(page)
+        if not anchor: return []
+    query = older_than(*anchor) if anchor else {}
+    tickets = list(tickets_col.find(query, {"created_at": 1}).sort(TICKET_ORDER).limit(REPORTS_PER_PAGE))
+    if tickets: cache_ticket_anchor(page, tickets[-1])
+    return tickets
+
+def ticket_page_of(tid):
+    # Ticket se naye kitne hain -> page number (indexed count)
+    t = tickets_col.find_one({"_id": tid}, {"created_at": 1})
+    if not t or not t.get("created_at"): return 1
+    newer = tickets_col.count_documents(newer_than(t["created_at"], tid))
+    page = newer // REPORTS_PER_PAGE + 1
+    if page > 1:
+        # Pichhle page ka last ticket is ticket se sirf (newer % per_page + 1) upar hai: bounded query se anchor seed
+        up = list(tickets_col.find(newer_than(t["created_at"], tid), {"created_at": 1})
+                  .sort([(k, -d) for k, d in TICKET_ORDER]).limit(newer % REPORTS_PER_PAGE + 1))
+        if up: cache_ticket_anchor(page - 1, up[-1])
+    return page
+
 # ---------------- AUTO DELETE ----------------
 def render_panel_reports(chat_id, msg_id, page=1):
-    # Fetch from DB - Latest first
-    all_tickets = list(tickets_col.find().sort("created_at", -1))
-    count = len(all_tickets)
-
-    if count == 0:
+    # Fetch from DB - Latest first (sirf current page)
+    for attempt in range(2):
+        count = count_tickets()
+        total_pages = max(1, (count + REPORTS_PER_PAGE - 1) // REPORTS_PER_PAGE)
+        page = max(1, min(page, total_pages))
+        current_tickets = fetch_ticket_page(page) if count else []
+        if current_tickets or not count: break
+        invalidate_ticket_pages() # Cached total purana tha, fresh count se dobara
+
+    if not current_tickets:
         smart_edit(chat_id, msg_id, "✅ *No Active Reports Found.*", reply_markup=types.InlineKeyboardMarkup().add(types.InlineKeyboardButton("🔙 Back", callback_data="close_panel")))
         return
 
-    per_page = 10
-    total_pages = max(1, (count + per_page - 1) // per_page)
-    page = max(1, min(page, total_pages))
-
-    start_idx = (page - 1) * per_page
-    current_tickets = all_tickets[start_idx : start_idx + per_page]
-
     kb = types.InlineKeyboardMarkup()
     
     # 1. Reports Grid (2-2 per line)
@@ -517,36 +1410,467 @@ def render_panel_reports(chat_id, msg_id, page=1):
 def schedule_delete(chat_id, message_ids):
     delay_mins = DELETE_CONFIG.get("minutes", 30)
     delete_at = datetime.now() + timedelta(minutes=delay_mins)
-    auto_delete_col.insert_one({
+    task = {
         "chat_id": chat_id,
         "message_ids": message_ids,
         "delete_at": delete_at
-    })
+    }
+    auto_delete_col.insert_one(task)
+    push_delete_task(task)
+
+# ---------------- BATCH STORAGE (CHUNKED) ----------------
+# batches_col sirf header rakhta hai; files BATCH_CHUNK_SIZE ke pages mein batch_chunks_col mein
+BATCH_FORMAT = 2
+BATCH_CHUNK_SIZE = 50
+
+def chunk_legacy_batch(code):
+    # Purana format (poori 'files' array header mein) -> chunks; dobara chalana safe hai
+    legacy = batches_col.find_one({"_id": code, "files": {"$exists": True}}, {"files": 1})
+    if not legacy: return
+    files = legacy['files']
+    docs = [{"_id": f"{code}:{n}", "batch": code, "n": n, "files": files[i:i + BATCH_CHUNK_SIZE]}
+            for n, i in enumerate(range(0, len(files), BATCH_CHUNK_SIZE))]
+    if docs:
+        try: batch_chunks_col.insert_many(docs, ordered=False)
+        except BulkWriteError: pass # Dusre worker ne already likh diye
+    batches_col.update_one(
+        {"_id": code, "files": {"$exists": True}},
+        {"$set": {"format": BATCH_FORMAT, "file_count": len(files), "chunks": len(docs)}, "$unset": {"files": ""}}
+    )
 
-def send_batch_content(user_id, code):
-    batch = batches_col.find_one({"_id": code})
-    if not batch: return False
+def iter_batch_chunks(batch):
+    # Ek waqt mein ek chunk memory mein
+    if batch.get('format') != BATCH_FORMAT: chunk_legacy_batch(batch['_id'])
+    for chunk in batch_chunks_col.find({"batch": batch['_id']}).sort("n", 1).batch_size(1):
+        yield chunk['files']
+
+def iter_batch_files(batch, start=0):
+    # start = itni files skip (resumed delivery); poore chunks bina iterate kiye nikal jaate hain
+    for files in iter_batch_chunks(batch):
+        if start >= len(files):
+            start -= len(files)
+            continue
+        yield from files[start:]
+        start = 0
+
+# ---------------- DELIVERY ENGINE ----------------
+# Telegram albums: photo+video mix ho sakte hain, document/audio sirf apne type ke saath
+ALBUM_KIND = {"photo": "visual", "video": "visual", "document": "document", "audio": "audio"}
+ALBUM_MAX = 10
+
+def group_batch_files(files):
+    # Consecutive compatible files ko album (max 10) mein jodo, order same rahega
+    # Generator hai taaki chunk stream pe chale (album chunk boundary ke paar bhi ban sakta hai)
+    last_kind, group = None, []
+    for f in files:
+        kind = ALBUM_KIND.get(f['type'])
+        if kind and group and last_kind == kind and len(group) < ALBUM_MAX:
+            group.append(f)
+            continue
+        if group: yield last_kind, group
+        last_kind, group = kind, [f]
+    if group: yield last_kind, group
+
+def input_media(f):
+    ftype, fid = f['type'], f['id']
+    if ftype == "photo": return types.InputMediaPhoto(fid)
+    if ftype == "video": return types.InputMediaVideo(fid)
+    if ftype == "audio": return types.InputMediaAudio(fid)
+    return types.InputMediaDocument(fid)
+
+def send_single_file(user_id, f, reply_markup=None):
+    ftype, fid = f['type'], f['id']
+    if ftype == "photo": return bot.send_photo(user_id, fid, reply_markup=reply_markup)
+    if ftype == "video": return bot.send_video(user_id, fid, reply_markup=reply_markup)
+    if ftype == "audio": return bot.send_audio(user_id, fid, reply_markup=reply_markup)
+    if ftype == "text": return bot.send_message(user_id, fid, reply_markup=reply_markup)
+    return bot.send_document(user_id, fid, reply_markup=reply_markup)
+
+def deliver_files(user_id, files, reply_markup=None, start=0, on_progress=None):
+    # Pacing (per-chat + global) limited_request_sender karta hai
+    # on_progress(cursor, sent_ids, failed, albums) har album/file ke baad (sirf us step ka naya data)
+    report = {"sent_ids": [], "failed": [], "albums": 0}
+    index = start
+
+    def send_one(f, idx):
+        try:
+            m = send_single_file(user_id, f, reply_markup)
+            if m: report["sent_ids"].append(m.message_id)
+        except Exception as e:
+            report["failed"].append({"index": idx, "type": f['type'], "error": str(e)})
 
-    time_str = "30 Minutes" if DELETE_CONFIG["minutes"] == 30 else "2 Hours"
-    note_msg = bot.send_message(user_id, f"⚠️ *IMPORTANT NOTE*\n\nFiles will be *Auto-Deleted* in *{time_str}*.\nPlease Forward/Save them!")
-    sent_ids = [note_msg.message_id]
+    for kind, items in group_batch_files(files):
+        sent_before, failed_before, albums_before = len(report["sent_ids"]), len(report["failed"]), report["albums"]
+        if kind and len(items) > 1:
+            # Album ek hi request hai, isliye ek token
+            try:
+                msgs = bot.send_media_group(user_id, [input_media(f) for f in items])
+                report["sent_ids"].extend(m.message_id for m in msgs)
+                report["albums"] += 1
+            except Exception:
+                # Ek kharab file poora album fail karti hai, to ek-ek karke bhejo
+                for offset, f in enumerate(items): send_one(f, index + offset)
+        else:
+            send_one(items[0], index)
+        index += len(items)
+        if on_progress:
+            on_progress(index, report["sent_ids"][sent_before:], report["failed"][failed_before:], report["albums"] - albums_before)
+    return report
+
+def send_batch_content(user_id, code, cursor=None, on_progress=None):
+    # cursor None = nayi delivery (note bhi jaata hai); warna itni files ja chuki, wahin se resume
+    # Auto-delete ka schedule caller karega (delivery job completion se)
+    batch = batches_col.find_one({"_id": code}, {"files": 0})
+    if not batch: return None
+    save = on_progress or (lambda *args: None)
+
+    if cursor is None:
+        time_str = "30 Minutes" if DELETE_CONFIG["minutes"] == 30 else "2 Hours"
+        note_msg = bot.send_message(user_id, f"⚠️ *IMPORTANT NOTE*\n\nFiles will be *Auto-Deleted* in *{time_str}*.\nPlease Forward/Save them!")
+        save(0, [note_msg.message_id], [], 0)
+        cursor = 0
+
+    return deliver_files(user_id, iter_batch_files(batch, cursor), reply_markup=get_custom_markup(), start=cursor, on_progress=save)
+
+def finish_batch_delivery(user_id, albums, failed):
+    # Albums pe inline buttons nahi lagte, isliye custom buttons alag se bhejo
+    sent_ids = []
     custom_kb = get_custom_markup()
+    if custom_kb and albums:
+        try: sent_ids.append(bot.send_message(user_id, "🔗 *Useful Links*", reply_markup=custom_kb).message_id)
+        except Exception as e: print(f"⚠️ Delivery Buttons Failed ({user_id}): {e}")
 
-    for f in batch['files']:
-        ftype, fid = f['type'], f['id']
-        try:
-            m = None
-            if ftype == "photo": m = bot.send_photo(user_id, fid, reply_markup=custom_kb)
-            elif ftype == "video": m = bot.send_video(user_id, fid, reply_markup=custom_kb)
-            elif ftype == "audio": m = bot.send_audio(user_id, fid, reply_markup=custom_kb)
-            elif ftype == "text": m = bot.send_message(user_id, fid, reply_markup=custom_kb)
-            else: m = bot.send_document(user_id, fid, reply_markup=custom_kb)
-            if m: sent_ids.append(m.message_id)
-            time.sleep(0.2)
+    if failed:
+        try: sent_ids.append(bot.send_message(user_id, f"⚠️ {len(failed)} file(s) could not be delivered.").message_id)
         except: pass
-    schedule_delete(user_id, sent_ids)
+    return sent_ids
+
+# ---------------- DELIVERY QUEUE ----------------
+DELIVERY_WORKERS = int(os.getenv("DELIVERY_WORKERS", "4"))
+DELIVERY_MAX_ATTEMPTS = 5
+DELIVERY_LOCK_SECS = 600 # Har progress save pe lock aage badhta hai; itna der chup raha to job dobara claim hogi
+delivery_wakeup = threading.Event()
+
+class DeliveryLockLost(Exception):
+    pass
+
+def enqueue_delivery(user_id, code, key):
+    # key = idempotency key, same update dobara aaye to job dobara nahi banegi
+    now = datetime.now()
+    try:
+        delivery_jobs_col.insert_one({
+            "_id": key,
+            "user_id": user_id,
+            "code": code,
+            "status": "queued",
+            "attempts": 0,
+            "next_run_at": now,
+            "created_at": now
+        })
+    except DuplicateKeyError:
+        return False
+    delivery_wakeup.set()
+    return True
+
+def claim_queued(col, lock_secs):
+    # Due 'queued' ya lock expire hua 'running' doc atomically claim karo
+    now = datetime.now()
+    return col.find_one_and_update(
+        {"$or": [
+            {"status": "queued", "next_run_at": {"$lte": now}},
+            {"status": "running", "locked_until": {"$lte": now}}
+        ]},
+        {"$set": {"status": "running", "locked_until": now + timedelta(seconds=lock_secs)}, "$inc": {"attempts": 1}},
+        sort=[("next_run_at", 1)],
+        return_document=pymongo.ReturnDocument.AFTER
+    )
+
+def claim_delivery_job():
+    return claim_queued(delivery_jobs_col, DELIVERY_LOCK_SECS)
+
+def is_permanent_error(e):
+    # User ne bot block kiya / chat hi nahi hai -> retry bekaar hai
+    code = getattr(e, "error_code", None)
+    return code == 403 or (code == 400 and "chat not found" in str(e).lower())
+
+def owned_delivery(job):
+    # attempts har claim pe badhta hai, isliye (running + attempts) hi lock token hai
+    return {"_id": job["_id"], "status": "running", "attempts": job.get("attempts", 1)}
+
+def save_delivery_progress(job, cursor, sent_ids, failed, albums):
+    # Har step ke baad cursor + sent ids save, aur lock aage badhao
+    res = delivery_jobs_col.update_one(owned_delivery(job), {
+        "$set": {"cursor": cursor, "locked_until": datetime.now() + timedelta(seconds=DELIVERY_LOCK_SECS)},
+        "$push": {"sent_ids": {"$each": sent_ids}, "failed": {"$each": failed}},
+        "$inc": {"albums": albums}
+    })
+    if not res.matched_count:
+        # Job kisi aur worker ke paas hai; is step ke messages ka delete yahin schedule karo
+        if sent_ids: schedule_delete(job["user_id"], sent_ids)
+        raise DeliveryLockLost(job["_id"])
+
+def release_delivery_job(job, update):
+    # Lock chhodte waqt ab tak bheje messages ka auto-delete schedule (retry baaki ke khud schedule karega)
+    update.setdefault("$set", {})["sent_ids"] = []
+    update["$unset"] = {"locked_until": ""}
+    before = delivery_jobs_col.find_one_and_update(owned_delivery(job), update, return_document=pymongo.ReturnDocument.BEFORE)
+    if before and before.get("sent_ids"): schedule_delete(before["user_id"], before["sent_ids"])
+    return before
+
+def dead_letter_delivery(job, error):
+    release_delivery_job(job, {"$set": {"status": "dead", "error": error, "dead_at": datetime.now()}})
+    print(f"☠️ Delivery Dead-Lettered {job['_id']}: {error}", flush=True)
+
+def fail_delivery_job(job, e):
+    attempts = job.get("attempts", 1)
+    if is_permanent_error(e) or attempts >= DELIVERY_MAX_ATTEMPTS:
+        dead_letter_delivery(job, str(e))
+        if not is_permanent_error(e):
+            try: bot.send_message(job["user_id"], "❌ *Delivery Failed!*\nPlease open the link again or contact support.")
+            except: pass
+        return
+    backoff = min(600, 5 * (2 ** (attempts - 1)))
+    release_delivery_job(job, {"$set": {"status": "queued", "error": str(e), "next_run_at": datetime.now() + timedelta(seconds=backoff)}})
+    print(f"🔁 Delivery Retry {job['_id']} in {backoff}s: {e}", flush=True)
+
+def run_delivery_job(job):
+    # Retry pe cursor se resume hota hai, pehle bheji files dobara nahi jaati
+    progress = lambda cursor, sent_ids, failed, albums: save_delivery_progress(job, cursor, sent_ids, failed, albums)
+    try:
+        report = send_batch_content(job["user_id"], job["code"], job.get("cursor"), progress)
+    except DeliveryLockLost:
+        print(f"⚠️ Delivery {job['_id']} lock lost, dusra worker chala raha hai", flush=True)
+        return
+    except Exception as e:
+        fail_delivery_job(job, e)
+        return
+    if report is None:
+        dead_letter_delivery(job, "batch not found")
+        return
+
+    state = delivery_jobs_col.find_one(owned_delivery(job), {"albums": 1, "failed": 1})
+    if not state: return # Lock chala gaya, naya owner complete karega
+    if state.get("failed"):
+        print(f"⚠️ Delivery {job['code']} -> {job['user_id']}: {len(state['failed'])} failed {state['failed']}", flush=True)
+    tail_ids = finish_batch_delivery(job["user_id"], state.get("albums", 0), state.get("failed"))
+
+    # Completion record hi auto-delete ka source hai
+    done = delivery_jobs_col.find_one_and_update(
+        owned_delivery(job),
+        {"$set": {"status": "done", "completed_at": datetime.now()},
+         "$push": {"sent_ids": {"$each": tail_ids}}, "$unset": {"locked_until": ""}},
+        return_document=pymongo.ReturnDocument.AFTER
+    )
+    if done is None and tail_ids: schedule_delete(job["user_id"], tail_ids)
+    if done and done.get("sent_ids"):
+        schedule_delete(done["user_id"], done["sent_ids"])
+
+def delivery_worker():
+    while True:
+        try:
+            job = claim_delivery_job()
+        except Exception as e:
+            print(f"❌ Delivery Queue Error: {e}")
+            time.sleep(5)
+            continue
+        if not job:
+            delivery_wakeup.wait(5)
+            delivery_wakeup.clear()
+            continue
+        run_delivery_job(job)
+
+# ---------------- PAYMENT EVENTS & OUTBOX ----------------
+# Webhook sirf event save karta hai; credit payment worker lagata hai, user message outbox se jaata hai
+PAYMENT_MAX_ATTEMPTS = 5
+OUTBOX_WORKERS = 2
+OUTBOX_MAX_ATTEMPTS = 8
+QUEUE_LOCK_SECS = 120
+payment_wakeup = threading.Event()
+outbox_wakeup = threading.Event()
+
+def payment_event_key(data):
+    # Sirf gateway ka apna id dedupe karta hai; body hash nahi (same amount+email ke do asli payments ek ho jaate)
+    for field in ("payment_id", "transaction_id", "txn_id", "order_id", "id"):
+        if data.get(field): return f"{field}:{data[field]}"
+    print(f"⚠️ Payment webhook without idempotency key, dedupe off: {data}", flush=True)
+    return f"noid:{uuid.uuid4().hex}"
+
+def enqueue_payment_event(key, email, amount, raw):
+    now = datetime.now()
+    try:
+        payment_events_col.insert_one({
+            "_id": key,
+            "email": email,
+            "amount": amount,
+            "raw": raw,
+            "status": "queued",
+            "attempts": 0,
+            "next_run_at": now,
+            "created_at": now
+        })
+    except DuplicateKeyError:
+        return False
+    payment_wakeup.set()
+    return True
+
+def queue_notification(chat_id, text, key):
+    # key = idempotency key, retry pe same message dobara queue nahi hota
+    now = datetime.now()
+    try:
+        outbox_col.insert_one({
+            "_id": key,
+            "chat_id": chat_id,
+            "text": text,
+            "status": "queued",
+            "attempts": 0,
+            "next_run_at": now,
+            "created_at": now
+        })
+    except DuplicateKeyError:
+        return False
+    outbox_wakeup.set()
     return True
 
+def finish_queued(col, doc, status="done", error=None):
+    fields = {"status": status, "completed_at": datetime.now()}
+    if error: fields["error"] = error
+    col.update_one({"_id": doc["_id"]}, {"$set": fields, "$unset": {"locked_until": ""}})
+
+def retry_queued(col, doc, error):
+    backoff = min(600, 5 * (2 ** (doc.get("attempts", 1) - 1)))
+    col.update_one({"_id": doc["_id"]}, {
+        "$set": {"status": "queued", "error": error, "next_run_at": datetime.now() + timedelta(seconds=backoff)},
+        "$unset": {"locked_until": ""}
+    })
+
+def apply_payment_event(event):
+    email, paid_amount = event["email"], event["amount"]
+
+    # 1. Pehle check karo koi User wait kar raha hai kya?
+    pending = pending_payments_col.find_one({"email": email})
+    if not pending:
+        # Crash retry: credit lag chuka tha aur pending delete ho gaya -> unclaimed mat banao
+        if wallet_ledger_col.find_one({"ref": f"payment:{event['_id']}"}, {"_id": 1}): return
+        # --- Agar User nahi mila to SAVE kar lo (event id se, retry pe duplicate nahi) ---
+        print(f"💾 Saving Unclaimed Payment for {email}", flush=True)
+        try:
+            unclaimed_payments_col.insert_one({
+                "_id": f"pay_{event['_id']}",
+                "event_id": event["_id"],
+                "email": email,
+                "amount": paid_amount,
+                "timestamp": datetime.now()
+            })
+        except DuplicateKeyError: pass
+        return
+
+    # --- Store Rupees directly ---
+    user_id = pending['user_id']
+    bonus = get_active_bonus(user_id)
+    final_amount = paid_amount + (paid_amount * (bonus / 100))
+
+    # Event id hi wallet ref hai: worker crash ke baad retry pe double credit nahi
+    add_credits(user_id, final_amount, "payment", ref=f"payment:{event['_id']}")
+
+    credit_val = CREDIT_CONFIG.get("value", 1.0)
+    credits_added_display = final_amount / credit_val
+    bonus_str = f" (including {bonus}% bonus)" if bonus > 0 else ""
+    queue_notification(user_id, f"✅ *Payment Confirmed!*\n₹{paid_amount} received. {credits_added_display} Credits added to your wallet{bonus_str}.", f"payment:{event['_id']}")
+
+    pending_payments_col.delete_one({"_id": pending['_id']})
+
+def payment_worker():
+    while True:
+        try:
+            event = claim_queued(payment_events_col, QUEUE_LOCK_SECS)
+        except Exception as e:
+            print(f"❌ Payment Queue Error: {e}")
+            time.sleep(5)
+            continue
+        if not event:
+            payment_wakeup.wait(5)
+            payment_wakeup.clear()
+            continue
+        try:
+            apply_payment_event(event)
+            finish_queued(payment_events_col, event)
+        except Exception as e:
+            print(f"❌ Payment Event {event['_id']} Failed: {e}", flush=True)
+            if event.get("attempts", 1) >= PAYMENT_MAX_ATTEMPTS: finish_queued(payment_events_col, event, "dead", str(e))
+            else: retry_queued(payment_events_col, event, str(e))
+
+def outbox_worker():
+    while True:
+        try:
+            msg = claim_queued(outbox_col, QUEUE_LOCK_SECS)
+        except Exception as e:
+            print(f"❌ Outbox Error: {e}")
+            time.sleep(5)
+            continue
+        if not msg:
+            outbox_wakeup.wait(5)
+            outbox_wakeup.clear()
+            continue
+        try:
+            bot.send_message(msg["chat_id"], msg["text"])
+            finish_queued(outbox_col, msg)
+        except Exception as e:
+            if is_permanent_error(e) or msg.get("attempts", 1) >= OUTBOX_MAX_ATTEMPTS: finish_queued(outbox_col, msg, "dead", str(e))
+            else: retry_queued(outbox_col, msg, str(e))
+
+# ---------------- VERIFICATION LINK POOL ----------------
+# Har shortener slot ke liye N ready short links; user ko milte waqt shortener call nahi hoti
+LINK_POOL_SIZE = int(os.getenv("LINK_POOL_SIZE", "5"))
+LINK_POOL_FRESH = 900       # Isse purane pool links assign nahi hote (token TTL 1200s hai)
+LINK_POOL_REFILL_SECS = 60
+link_pool_wakeup = threading.Event()
+
+def fill_link_pool():
+    if not SHORTNER_CONFIG.get("active"): return
+    fresh_after = datetime.now() - timedelta(seconds=LINK_POOL_FRESH)
+    for idx, shortener in enumerate(SHORTNER_CONFIG.get("shorteners", [])):
+        if not is_shortener_usable(shortener): continue
+        have = short_link_pool_col.count_documents({"slot": idx, "created_at": {"$gt": fresh_after}})
+        for _ in range(LINK_POOL_SIZE - have):
+            token = f"v_{gen_code(8)}"
+            bot_url = f"https://t.me/{BOT_USERNAME}?start={token}"
+            short_link = get_short_link(bot_url, shortener)
+            if not short_link or short_link == bot_url: break # Shortener down, agle round mein
+            short_link_pool_col.insert_one({"_id": token, "slot": idx, "short_link": short_link, "created_at": datetime.now()})
+
+def link_pool_worker():
+    while True:
+        try: fill_link_pool()
+        except Exception as e: print(f"⚠️ Link Pool Error: {e}")
+        link_pool_wakeup.wait(LINK_POOL_REFILL_SECS)
+        link_pool_wakeup.clear()
+
+def reset_link_pool():
+    # Shortener slots badle to purane links galat slot/API ke ho sakte hain
+    short_link_pool_col.delete_many({})
+    link_pool_wakeup.set()
+
+def take_verification_link(user_id, slot, shortener):
+    # Pool se fresh link lo, khali ho to purane tareeke se abhi generate karo
+    entry = short_link_pool_col.find_one_and_delete(
+        {"slot": slot, "created_at": {"$gt": datetime.now() - timedelta(seconds=LINK_POOL_FRESH)}},
+        sort=[("created_at", 1)]
+    )
+    link_pool_wakeup.set()
+    if entry:
+        token, short_link = entry["_id"], entry["short_link"]
+    else:
+        token = f"v_{gen_code(8)}"
+        short_link = get_short_link(f"https://t.me/{BOT_USERNAME}?start={token}", shortener)
+
+    # Token ki 20 min validity assign hone ke waqt se
+    verification_tokens_col.insert_one({
+        "_id": token,
+        "user_id": user_id,
+        "created_at": datetime.now()
+    })
+    return short_link
+
 # ---------------- START LOGIC ----------------
 @bot.message_handler(commands=["start"])
 def start_command(message):
@@ -554,6 +1878,7 @@ def start_command(message):
     save_user(user_id)
     if is_banned(user_id): return
     args = message.text.split()
+    job_key = f"start:{user_id}:{message.message_id}"
 
     # --- NEW SECURE VERIFICATION HANDLER ---
     if len(args) > 1 and args[1].startswith("v_"):
@@ -584,12 +1909,12 @@ def start_command(message):
         hours = SHORTNER_CONFIG.get("validity", 12)
         set_verification(user_id, hours)
         bot.send_message(user_id, f"✅ *Verified for {hours} hours!*")
-        process_link(user_id, real_code)
+        process_link(user_id, real_code, key=job_key)
         return
 
     if len(args) > 1 and args[1].startswith("sl_"):
         real_code = args[1].replace("sl_", "")
-        process_link(user_id, real_code, bypass_verification=True)
+        process_link(user_id, real_code, bypass_verification=True, key=job_key)
         return
 
     if len(args) == 1:
@@ -607,7 +1932,7 @@ def start_command(message):
         bot.send_message(user_id, "⚠️ *Please join our channels to access the content!*", reply_markup=markup)
         return
 
-    process_link(user_id, args[1])
+    process_link(user_id, args[1], key=job_key)
 
 @bot.callback_query_handler(func=lambda c: c.data == "verify_join")
 def verify_join_cb(call):
@@ -618,7 +1943,7 @@ def verify_join_cb(call):
         bot.delete_message(uid, call.message.message_id)
         saved = active_user_code.get(uid, "")
         if saved.startswith("PENDING_START_"):
-            process_link(uid, saved.split("_")[-1])
+            process_link(uid, saved.split("_")[-1], key=f"cb:{call.id}")
         else:
             send_custom_welcome(uid)
     else:
@@ -639,8 +1964,35 @@ def send_custom_welcome(user_id):
         try: bot.send_message(user_id, "Welcome!", reply_markup=get_home_markup(), parse_mode=None)
         except: pass
 
-def process_link(user_id, code, bypass_verification=False):
-    batch = batches_col.find_one({"_id": code})
+def send_verification_prompt(user_id, code, slot, shortener):
+    # Pre-generated pool se secure v_ token link (Auto-deleted after 20 mins)
+    short_link = take_verification_link(user_id, slot, shortener)
+
+    # Professional Caption
+    caption = (
+        "🛡 *Access Token Expired*\n"
+        "Your Access Token has expired. Please renew it and try again.\n\n"
+        "⏳ *Token Validity:* 12 hours\n\n"
+        "ℹ️ _This is an ads-based access token. If you pass 1 access token, "
+        "you can access messages from sharable links for the next 12 hours._"
+    )
+
+    origin_url = f"https://t.me/{BOT_USERNAME}?start={code}"
+
+    kb = types.InlineKeyboardMarkup(row_width=1)
+    kb.add(
+        types.InlineKeyboardButton("Verify 🔓", url=short_link),
+        types.InlineKeyboardButton("Try Again 🔄", url=origin_url)
+    )
+    if SHORTNER_CONFIG.get("tutorial"):
+        kb.add(types.InlineKeyboardButton("How to Verify ❓", url=SHORTNER_CONFIG["tutorial"]))
+
+    bot.send_message(user_id, caption, reply_markup=kb, parse_mode="Markdown")
+
+def process_link(user_id, code, bypass_verification=False, key=None):
+    # key: delivery job ki idempotency key (update se banti hai)
+    key = key or f"link:{user_id}:{code}:{int(time.time())}"
+    batch = batches_col.find_one({"_id": code}, {"files": 0})
     if not batch:
         bot.send_message(user_id, "❌ *Link Expired or Invalid*")
         return
@@ -652,7 +2004,7 @@ def process_link(user_id, code, bypass_verification=False):
     if btype == 'premium':
         if is_premium(user_id):
             bot.send_message(user_id, "✅ *Premium Unlocked!*")
-            send_batch_content(user_id, code)
+            enqueue_delivery(user_id, code, key)
         else:
             bot.send_message(user_id, "🔒 *Premium Content*", reply_markup=get_plan_kb())
 
@@ -660,54 +2012,19 @@ def process_link(user_id, code, bypass_verification=False):
         if not bypass_verification and not is_verified(user_id):
             shorteners = SHORTNER_CONFIG.get("shorteners", [])
             if not shorteners:
-                send_batch_content(user_id, code)
+                enqueue_delivery(user_id, code, key)
                 return
             
-            u = users_col.find_one({"_id": user_id})
+            u = get_user(user_id)
             last_index = u.get("last_shortener_index", -1) if u else -1
-            next_index = (last_index + 1) % len(shorteners)
-            users_col.update_one({"_id": user_id}, {"$set": {"last_shortener_index": next_index}})
-            
-            selected_shortener = shorteners[next_index]
+            # Round-robin, par tripped shortener ho to agla healthy slot
+            next_index = pick_shortener_slot(shorteners, (last_index + 1) % len(shorteners))
+            update_user(user_id, {"$set": {"last_shortener_index": next_index}})
             
-            # --- 5-LINK POOL & RANDOMIZATION ---
-            # Generate a unique session token for this user
-            session_token = f"v_{gen_code(8)}"
-            
-            # Use the pool of links from the shortener slot (if we had pre-gen)
-            # For now, we generate one dynamically but secure it with session_token
-            bot_url = f"https://t.me/{BOT_USERNAME}?start={session_token}"
-            short_link = get_short_link(bot_url, selected_shortener)
-            
-            # Save session to DB (Auto-deleted after 20 mins)
-            verification_tokens_col.insert_one({
-                "_id": session_token,
-                "user_id": user_id,
-                "created_at": datetime.now()
-            })
-            
-            # Professional Caption
-            caption = (
-                "🛡 *Access Token Expired*\n"
-                "Your Access Token has expired. Please renew it and try again.\n\n"
-                "⏳ *Token Validity:* 12 hours\n\n"
-                "ℹ️ _This is an ads-based access token. If you pass 1 access token, "
-                "you can access messages from sharable links for the next 12 hours._"
-            )
-            
-            origin_url = f"https://t.me/{BOT_USERNAME}?start={code}"
-            
-            kb = types.InlineKeyboardMarkup(row_width=1)
-            kb.add(
-                types.InlineKeyboardButton("Verify 🔓", url=short_link),
-                types.InlineKeyboardButton("Try Again 🔄", url=origin_url)
-            )
-            if SHORTNER_CONFIG.get("tutorial"): 
-                kb.add(types.InlineKeyboardButton("How to Verify ❓", url=SHORTNER_CONFIG["tutorial"]))
-            
-            bot.send_message(user_id, caption, reply_markup=kb, parse_mode="Markdown")
+            # Pool khali ho to shortener call hoti hai, isliye prompt lane ke bahar banta hai
+            run_off_lane(send_verification_prompt, user_id, code, next_index, shorteners[next_index])
             return
-        send_batch_content(user_id, code)
+        enqueue_delivery(user_id, code, key)
 
     elif btype in ['sale', 'special']:
                         # LOGIC CHANGED FOR AUTO PAYMENT IF ADMIN
@@ -736,13 +2053,13 @@ def cmd_shortner(message):
     if is_banned(uid): return
     
     # Check if user has set their shortener
-    u = users_col.find_one({"_id": uid})
+    u = get_user(uid)
     s = u.get("personal_shortener", {})
     if not s.get("api") or not s.get("url"):
         bot.send_message(uid, "❌ *Shortener Not Set!*\nPehle Dashboard -> Shortener me apni API aur Domain set karein.")
         return
 
-    user_states[uid] = {'state': 'batch_collect', 'type': 'shortner_link', 'owner': uid, 'files': []}
+    start_batch_draft(uid, 'shortner_link', uid)
     bot.send_message(uid, "*🔗 Shortener Link Mode*\nSend files now. Click Done when finished.", reply_markup=done_kb())
 
 @bot.message_handler(commands=["redeem"])
@@ -774,9 +2091,10 @@ def cmd_redeem(message):
         bot.send_message(uid, "❌ *This code has expired!*")
         return
     
-    # Check if used
-    u = users_col.find_one({"_id": uid})
-    if code in u.get("used_redeems", []):
+    # Check if used: unique (user_id, code) index pe insert hi atomic check hai
+    try:
+        redeem_usage_col.insert_one({"user_id": uid, "code": code, "expire_at": redeem['expiry'], "used_at": datetime.now()})
+    except DuplicateKeyError:
         bot.send_message(uid, "❌ *You have already used this code!*")
         return
     
@@ -788,12 +2106,9 @@ def cmd_redeem(message):
     credit_val = CREDIT_CONFIG.get("value", 1.0)
     rs_to_add = credits_to_add * credit_val
     
-    add_credits(uid, rs_to_add)
+    add_credits(uid, rs_to_add, f"redeem:{code}")
     if bonus_to_set > 0:
-        users_col.update_one({"_id": uid}, {"$set": {"bonus_percent": bonus_to_set, "bonus_expiry": expiry_time}})
-    
-    # Mark as used
-    users_col.update_one({"_id": uid}, {"$push": {"used_redeems": code}})
+        set_bonus(uid, bonus_to_set, expiry_time)
     
     msg = "✅ *Redeem Successful!*\n\n"
     if credits_to_add > 0: msg += f"💰 Added: `{credits_to_add}` Credits\n"
@@ -821,10 +2136,10 @@ def cmd_genpublic(message):
     uid = message.from_user.id
     if is_banned(uid): return
     if uid == ADMIN_ID:
-        user_states[uid] = {'state': 'batch_collect', 'type': 'public', 'owner': ADMIN_ID, 'files': []}
+        start_batch_draft(uid, 'public', ADMIN_ID)
         bot.send_message(uid, "*🔓 Admin Public Mode*\nSend files now. Click Done.", reply_markup=done_kb())
     elif is_premium(uid):
-        user_states[uid] = {'state': 'batch_collect', 'type': 'normal', 'owner': uid, 'files': []}
+        start_batch_draft(uid, 'normal', uid)
         bot.send_message(uid, "*🔓 Pro Public Mode*\nSend files now. Click Done.", reply_markup=done_kb())
     else:
         bot.send_message(uid, "❌ *Premium Required!*", reply_markup=get_plan_kb())
@@ -834,7 +2149,7 @@ def cmd_prm(message):
     uid = message.from_user.id
     if is_banned(uid): return
     if uid == ADMIN_ID:
-        user_states[uid] = {'state': 'batch_collect', 'type': 'premium', 'owner': ADMIN_ID, 'files': []}
+        start_batch_draft(uid, 'premium', ADMIN_ID)
         bot.send_message(uid, "*👑 Admin Premium Mode*\nSend files now. Click Done.", reply_markup=done_kb())
     else:
         bot.send_message(uid, "❌ *Admin Only Command!*")
@@ -961,1621 +2276,1815 @@ def send_settings_panel(admin_id, msg_id_to_edit):
     )
     bot.edit_message_text("*⚙️ Settings Menu*", admin_id, msg_id_to_edit, reply_markup=kb)
 
-# ---------------- ROUTER ----------------
+# ---------------- CALLBACK ROUTER ----------------
+# Exact actions dict se, "buy_plan|..." jaise prefixed actions trie se (longest prefix match)
+callback_exact = {}
+callback_trie = [{}, None]  # [children, route]
+
+def callback_route(key, prefix=False, admin=False):
+    def register(func):
+        route = (func, admin)
+        if not prefix:
+            callback_exact[key] = route
+            return func
+        node = callback_trie
+        for ch in key: node = node[0].setdefault(ch, [{}, None])
+        node[1] = route
+        return func
+    return register
+
+def resolve_callback(action):
+    route = callback_exact.get(action)
+    if route: return route
+    node, found = callback_trie, None
+    for ch in action:
+        node = node[0].get(ch)
+        if node is None: break
+        if node[1]: found = node[1]
+    return found
+
 @bot.callback_query_handler(func=lambda c: True)
 def router_callback(call):
     # 1. Sabse Pehle Loading Band Karein
     try: bot.answer_callback_query(call.id)
     except: pass 
 
-    # 2. Variables Set Karein
-    action = call.data
-    uid = call.from_user.id
-    chat_id = call.message.chat.id
-    msg_id = call.message.message_id
-                # ==========================================
-    #  FINAL USER DASHBOARD & PAYMENT SYSTEM
-    # ==========================================
-
-    # --- 1. USER DASHBOARD (Smooth Edit) ---
-    if action == "user_dashboard":
-        user_states.pop(uid, None)
-        active_user_code.pop(uid, None)
-        
-        if is_premium(uid) or uid == ADMIN_ID:
-            text = "👤 *User Dashboard*\n\nSelect an option to manage your links and payments:"
-            kb = types.InlineKeyboardMarkup(row_width=1)
-            kb.add(
-                types.InlineKeyboardButton("🔗 Shortener", callback_data="user_short_menu"),
-                types.InlineKeyboardButton("💳 Set Payment", callback_data="pay_pro_menu"),
-                types.InlineKeyboardButton("🔙 Back", callback_data="user_main_back")
-            )
-            smart_edit(chat_id, msg_id, text, reply_markup=kb)
-        else:
-            # Non-Premium Logic
-            text = "❌ *Premium Required*\n\nDashboard access is only for Pro members. Select a plan to upgrade:"
-            smart_edit(chat_id, msg_id, text, reply_markup=get_plan_kb())
-        return
-
-    # --- 2. PREMIUM STATUS ---
-    if action == "user_menu_prem":
-        prem_active = is_premium(uid)
-        status = "✅ Active" if prem_active else "❌ Inactive"
-        exp = get_premium_expiry(uid)
-        text = f"👑 *Premium Status*\n\n🔹 Status: {status}\n⏳ Expires: {exp}"
-        
-        kb = types.InlineKeyboardMarkup()
-        if not prem_active:
-            kb.add(types.InlineKeyboardButton("💎 Buy Premium", callback_data="show_plans"))
-        kb.add(types.InlineKeyboardButton("🔙 Back", callback_data="user_main_back"))
-        
+    # 2. Handler dhoondo (admin routes sirf ADMIN_ID ke liye)
+    route = resolve_callback(call.data)
+    if not route: return
+    func, admin_only = route
+    if admin_only and call.from_user.id != ADMIN_ID: return
+    func(call, call.data, call.from_user.id, call.message.chat.id, call.message.message_id)
+
+def bench_callback_dispatch(rounds=20000):
+    # Har registered route ke liye ek sample action, phir per-dispatch lookup cost (ns)
+    samples = list(callback_exact)
+    stack = [(callback_trie, "")]
+    while stack:
+        node, path = stack.pop()
+        if node[1]: samples.append(path + "x|1")
+        for ch, child in node[0].items(): stack.append((child, path + ch))
+    # Purane if-chain jaisa linear scan (baseline)
+    chain = [(k, False) for k in callback_exact] + [(p[:-3], True) for p in samples if p.endswith("x|1")]
+    def linear(action):
+        for key, pre in chain:
+            if (action.startswith(key) if pre else action == key): return key
+
+    results = {}
+    for name, fn in (("table", resolve_callback), ("if-chain", linear)):
+        start = time.perf_counter_ns()
+        for _ in range(rounds // len(samples) + 1):
+            for action in samples: fn(action)
+        calls = (rounds // len(samples) + 1) * len(samples)
+        results[name] = (time.perf_counter_ns() - start) / calls
+    print(f"Callback routes: {len(samples)}")
+    for name, ns in results.items(): print(f"  {name:<9} {ns:8.0f} ns/dispatch")
+    return results
+
+# ---------------- USER CALLBACKS ----------------
+
+# --- 1. USER DASHBOARD (Smooth Edit) ---
+@callback_route("user_dashboard")
+def cb_user_dashboard(call, action, uid, chat_id, msg_id):
+    user_states.pop(uid, None)
+    active_user_code.pop(uid, None)
+
+    if is_premium(uid) or uid == ADMIN_ID:
+        text = "👤 *User Dashboard*\n\nSelect an option to manage your links and payments:"
+        kb = types.InlineKeyboardMarkup(row_width=1)
+        kb.add(
+            types.InlineKeyboardButton("🔗 Shortener", callback_data="user_short_menu"),
+            types.InlineKeyboardButton("💳 Set Payment", callback_data="pay_pro_menu"),
+            types.InlineKeyboardButton("🔙 Back", callback_data="user_main_back")
+        )
         smart_edit(chat_id, msg_id, text, reply_markup=kb)
-        return
-
-    # --- 3. SHOW PLANS ---
-    if action == "show_plans":
-        active_user_code.pop(uid, None)
-        text = "💎 *Select a Premium Plan:*"
+    else:
+        # Non-Premium Logic
+        text = "❌ *Premium Required*\n\nDashboard access is only for Pro members. Select a plan to upgrade:"
         smart_edit(chat_id, msg_id, text, reply_markup=get_plan_kb())
-        return
 
-    # --- 4. BACK BUTTON (Universal Logic) ---
-    if action == "user_main_back":
-        active_user_code.pop(uid, None)
-        user_states.pop(uid, None)
-        text_content = get_home_text(call.from_user)
-        markup = get_home_markup()
-        smart_edit(chat_id, msg_id, text_content, reply_markup=markup)
-        return
+# --- 2. PREMIUM STATUS ---
+@callback_route("user_menu_prem")
+def cb_user_menu_prem(call, action, uid, chat_id, msg_id):
+    prem_active = is_premium(uid)
+    status = "✅ Active" if prem_active else "❌ Inactive"
+    exp = get_premium_expiry(uid)
+    text = f"👑 *Premium Status*\n\n🔹 Status: {status}\n⏳ Expires: {exp}"
 
-    # --- 5. CONTACT SUPPORT ---
-    if action == "user_menu_supp":
-        user_support_state[uid] = True
-        kb = types.InlineKeyboardMarkup()
-        kb.add(types.InlineKeyboardButton("🔙 Back / Cancel", callback_data="cancel_input_process"))
-        text = "📝 *Describe Your Issue:*\n\nPlease write your message or send a screenshot. Our support team will get back to you soon."
-        smart_edit(chat_id, msg_id, text, reply_markup=kb)
-        return
+    kb = types.InlineKeyboardMarkup()
+    if not prem_active:
+        kb.add(types.InlineKeyboardButton("💎 Buy Premium", callback_data="show_plans"))
+    kb.add(types.InlineKeyboardButton("🔙 Back", callback_data="user_main_back"))
 
-    # --- 6. BUY PLAN INVOICE (With VIEWING State) ---
-    if action.startswith("buy_plan|"):
-        plan = action.split("|")[1]
-        price_rs = PLANS.get(plan, 0)
-        credit_val = CREDIT_CONFIG.get("value", 1.0)
-        req_credits = round(price_rs / credit_val, 2)
-        
-        text = (f"*💎 Buy Premium Plan: {plan} Days*\n"
-                f"💰 Cost: {req_credits} Credits\n\n"
-                f"Are you sure you want to buy this plan?")
-        
-        kb = types.InlineKeyboardMarkup(row_width=2)
-        kb.add(
-            types.InlineKeyboardButton("✅ Confirm", callback_data=f"confirm_plan|{plan}"),
-            types.InlineKeyboardButton("❌ Cancel", callback_data="show_plans")
-        )
-        
-        bot.edit_message_text(text, chat_id, msg_id, parse_mode="Markdown", reply_markup=kb)
-        return
+    smart_edit(chat_id, msg_id, text, reply_markup=kb)
+
+# --- 3. SHOW PLANS ---
+@callback_route("show_plans")
+def cb_show_plans(call, action, uid, chat_id, msg_id):
+    active_user_code.pop(uid, None)
+    text = "💎 *Select a Premium Plan:*"
+    smart_edit(chat_id, msg_id, text, reply_markup=get_plan_kb())
+
+# --- 4. BACK BUTTON (Universal Logic) ---
+@callback_route("user_main_back")
+def cb_user_main_back(call, action, uid, chat_id, msg_id):
+    active_user_code.pop(uid, None)
+    user_states.pop(uid, None)
+    text_content = get_home_text(call.from_user)
+    markup = get_home_markup()
+    smart_edit(chat_id, msg_id, text_content, reply_markup=markup)
+
+# --- 5. CONTACT SUPPORT ---
+@callback_route("user_menu_supp")
+def cb_user_menu_supp(call, action, uid, chat_id, msg_id):
+    user_support_state[uid] = True
+    user_states.pop(uid, None)
+    kb = types.InlineKeyboardMarkup()
+    kb.add(types.InlineKeyboardButton("🔙 Back / Cancel", callback_data="cancel_input_process"))
+    text = "📝 *Describe Your Issue:*\n\nPlease write your message or send a screenshot. Our support team will get back to you soon."
+    smart_edit(chat_id, msg_id, text, reply_markup=kb)
+
+# --- 6. BUY PLAN INVOICE (With VIEWING State) ---
+@callback_route("buy_plan|", prefix=True)
+def cb_buy_plan(call, action, uid, chat_id, msg_id):
+    plan = action.split("|")[1]
+    price_rs = PLANS.get(plan, 0)
+    credit_val = CREDIT_CONFIG.get("value", 1.0)
+    req_credits = round(price_rs / credit_val, 2)
 
-    if action.startswith("confirm_plan|"):
-        plan = action.split("|")[1]
-        req_rs = PLANS.get(plan, 0)
-        credit_val = CREDIT_CONFIG.get("value", 1.0)
-        
-        current_rs = get_credits(uid)
-        if current_rs >= req_rs:
-            add_credits(uid, -req_rs)
-            days = PLAN_DAYS.get(plan, 0)
-            set_premium(uid, days)
-            bot.answer_callback_query(call.id, "🎉 Plan Activated successfully!", show_alert=True)
-            try: bot.delete_message(chat_id, msg_id)
-            except: pass
-            send_custom_welcome(uid)
-        else:
-            req_credits = round(req_rs / credit_val, 2)
-            current_credits = round(current_rs / credit_val, 2)
-            bot.answer_callback_query(call.id, "❌ Insufficient Credits!", show_alert=True)
-            text = f"❌ *Insufficient Credits*\n\nYou need {req_credits} Credits but have {current_credits}."
-            kb = types.InlineKeyboardMarkup(row_width=1)
-            kb.add(types.InlineKeyboardButton("💰 Buy Credits", callback_data="buy_credits"))
-            kb.add(types.InlineKeyboardButton("🔙 Back", callback_data="show_plans"))
-            bot.edit_message_text(text, chat_id, msg_id, parse_mode="Markdown", reply_markup=kb)
-        return
-        
-    if action.startswith("confirm_sale|"):
-        code = action.split("|")[1]
-        batch = batches_col.find_one({"_id": code})
-        if not batch: return
-        req_rs = batch.get('price', 0)
-        credit_val = CREDIT_CONFIG.get("value", 1.0)
-        
-        current_rs = get_credits(uid)
-        if current_rs >= req_rs:
-            add_credits(uid, -req_rs)
-            send_batch_content(uid, code)
-            bot.answer_callback_query(call.id, "✅ File Delivered!", show_alert=True)
-            try: bot.delete_message(chat_id, msg_id)
-            except: pass
-        else:
-            req_credits = round(req_rs / credit_val, 2)
-            current_credits = round(current_rs / credit_val, 2)
-            bot.answer_callback_query(call.id, "❌ Insufficient Credits!", show_alert=True)
-            text = f"❌ *Insufficient Credits*\n\nYou need {req_credits} Credits but have {current_credits}."
-            kb = types.InlineKeyboardMarkup(row_width=1)
-            kb.add(types.InlineKeyboardButton("💰 Buy Credits", callback_data="buy_credits"))
-            kb.add(types.InlineKeyboardButton("🔙 Cancel", callback_data="user_main_back"))
-            bot.edit_message_text(text, chat_id, msg_id, parse_mode="Markdown", reply_markup=kb)
-        return
+    text = (f"*💎 Buy Premium Plan: {plan} Days*\n"
+            f"💰 Cost: {req_credits} Credits\n\n"
+            f"Are you sure you want to buy this plan?")
 
-    # --- 1A. MY CREDITS ---
-    if action == "user_menu_credits":
-        active_user_code.pop(uid, None)
-        balance_rs = get_credits(uid)
-        credit_val = CREDIT_CONFIG.get("value", 1.0)
-        credits_display = round(balance_rs / credit_val, 2)
-        text = f"💳 *My Wallet*\n\n💰 Balance: `{credits_display}` Credits"
-        kb = types.InlineKeyboardMarkup(row_width=1)
-        kb.add(types.InlineKeyboardButton("💰 Buy Credits", callback_data="buy_credits"))
-        kb.add(types.InlineKeyboardButton("🔙 Back", callback_data="user_main_back"))
-        
-        smart_edit(chat_id, msg_id, text, reply_markup=kb)
-        return
-
-    # --- HELP MENU (New) ---
-    if action == "user_help_menu":
-        help_text = (
-            "📖 *BOT GUIDE & HELP CENTER*\n\n"
-            "Welcome to our File Store Bot! Here is everything you need to know about using this bot efficiently.\n\n"
-            "🌟 *How it Works:*\n"
-            "This bot allows you to store and access files securely. Some files are free, while others require Credits or Premium access.\n\n"
-            "💰 *About Credits:*\n"
-            "Credits are the bot's internal currency. You can buy them using the 'My Credits' menu. 1 Credit value is set by the admin.\n"
-            "1. Click 'My Credits' -> 'Buy Credits'.\n"
-            "2. Complete the payment and provide your email.\n"
-            "3. Use credits to unlock paid files or buy Premium plans.\n\n"
-            "👑 *Premium Membership:*\n"
-            "Buying a Premium plan gives you instant access to all 'Premium' marked links without any extra cost.\n\n"
-            "📜 *Available Commands:*\n"
-            "• /start - Restart/Refresh the bot\n"
-            "• /genpaid - Create your own paid links (Pro)\n"
-            "• /genpublic - Create public links (Pro)\n"
-            "• /shortner - Create links with your ads (Pro)\n"
-            "• /redeem - Use a gift/promo code\n"
-            "• /proof - Check your sales history (Pro)\n\n"
-            "💡 _Tip: Tap any blue command above to execute it instantly!_"
-        )
-        kb = types.InlineKeyboardMarkup()
-        kb.add(types.InlineKeyboardButton("🏠 Home", callback_data="user_main_back"))
-        
-        smart_edit(chat_id, msg_id, help_text, reply_markup=kb)
-        return
+    kb = types.InlineKeyboardMarkup(row_width=2)
+    kb.add(
+        types.InlineKeyboardButton("✅ Confirm", callback_data=f"confirm_plan|{plan}"),
+        types.InlineKeyboardButton("❌ Cancel", callback_data="show_plans")
+    )
 
-    # --- 1B. BUY CREDITS INVOICE ---
-    if action == "buy_credits":
-        active_user_code[uid] = "CREDIT_VIEWING_0_0"
-        credit_val = CREDIT_CONFIG.get("value", 1.0)
-        text = (f"*💰 Buy Credits*\n\n"
-                f"1 Credit = ₹{credit_val}\n"
-                f"You can pay ANY amount. Credits will be added accordingly.\n\n"
-                f"1. Click 'Pay Now'.\n"
-                f"2. Come back & click 'I Have Paid'.")
-        
-        kb = types.InlineKeyboardMarkup(row_width=1)
-        kb.add(types.InlineKeyboardButton("💳 Pay Now", url=PAYMENT_LINK))
-        kb.add(types.InlineKeyboardButton("✅ I Have Paid", callback_data="i_have_paid"))
-        kb.add(types.InlineKeyboardButton("🔙 Back", callback_data="user_menu_credits"))
-        
-        smart_edit(chat_id, msg_id, text, reply_markup=kb)
-        return
+    bot.edit_message_text(text, chat_id, msg_id, parse_mode="Markdown", reply_markup=kb)
 
-    # --- 7. I HAVE PAID (Switch to PENDING State) ---
-    if action == "i_have_paid":
-        session = active_user_code.get(uid)
-        if not session:
-            # Agar restart ki wajah se session udd gaya
-            bot.answer_callback_query(call.id, "❌ Session Expired. Please Start Again.")
-            return
+@callback_route("confirm_plan|", prefix=True)
+def cb_confirm_plan(call, action, uid, chat_id, msg_id):
+    plan = action.split("|")[1]
+    req_rs = PLANS.get(plan, 0)
+    credit_val = CREDIT_CONFIG.get("value", 1.0)
 
-        # Magic: Switch VIEWING -> PENDING (Ab bot Email lega)
-        active_user_code[uid] = session.replace("VIEWING", "PENDING")
+    if debit_credits(uid, req_rs, f"plan:{plan}", ref=f"plan:{call.id}") is not None:
+        days = PLAN_DAYS.get(plan, 0)
+        set_premium(uid, days)
+        bot.answer_callback_query(call.id, "🎉 Plan Activated successfully!", show_alert=True)
+        try: bot.delete_message(chat_id, msg_id)
+        except: pass
+        send_custom_welcome(uid)
+    else:
+        req_credits = round(req_rs / credit_val, 2)
+        current_credits = round(get_credits(uid) / credit_val, 2)
+        bot.answer_callback_query(call.id, "❌ Insufficient Credits!", show_alert=True)
+        text = f"❌ *Insufficient Credits*\n\nYou need {req_credits} Credits but have {current_credits}."
+        kb = types.InlineKeyboardMarkup(row_width=1)
+        kb.add(types.InlineKeyboardButton("💰 Buy Credits", callback_data="buy_credits"))
+        kb.add(types.InlineKeyboardButton("🔙 Back", callback_data="show_plans"))
+        bot.edit_message_text(text, chat_id, msg_id, parse_mode="Markdown", reply_markup=kb)
 
-        kb = types.InlineKeyboardMarkup()
-        # Back button will go to 'step_back_to_invoice'
-        kb.add(types.InlineKeyboardButton("🔙 Back", callback_data="step_back_to_invoice"))
-        
-        text = "📧 *Enter Payment Email:*\n\nPlease provide the email address used during payment for verification."
-        smart_edit(chat_id, msg_id, text, reply_markup=kb)
-        return
+@callback_route("confirm_sale|", prefix=True)
+def cb_confirm_sale(call, action, uid, chat_id, msg_id):
+    code = action.split("|")[1]
+    batch = batches_col.find_one({"_id": code}, {"files": 0})
+    if not batch: return
+    req_rs = batch.get('price', 0)
+    credit_val = CREDIT_CONFIG.get("value", 1.0)
 
-    # --- 8. STEP BACK TO INVOICE (Switch back to VIEWING) ---
-    if action == "step_back_to_invoice":
-        session = active_user_code.get(uid)
-        if not session:
-            send_custom_welcome(uid)
+    if debit_credits(uid, req_rs, f"sale:{code}", ref=f"sale:{call.id}") is not None:
+        try: enqueue_delivery(uid, code, f"sale:{call.id}")
+        except Exception as e:
+            # Job nahi bani to paise wapas (ref se refund bhi ek hi baar lagega)
+            print(f"❌ Sale Enqueue Failed ({uid}, {code}): {e}", flush=True)
+            add_credits(uid, req_rs, f"refund:{code}", ref=f"refund:{call.id}")
+            bot.answer_callback_query(call.id, "❌ Could not start delivery. Credits refunded, please try again.", show_alert=True)
             return
-
-        # Magic: Switch PENDING -> VIEWING (Ab bot random text ignore karega)
-        active_user_code[uid] = session.replace("PENDING", "VIEWING")
-        
-        parts = session.split("_")
-        type_ = parts[0]
-        name = parts[2]
-        try: price = parts[3]
-        except: price = "0"
-        
-        # Reconstruct Invoice
-        if type_ == "CREDIT":
-            credit_val = CREDIT_CONFIG.get("value", 1.0)
-            text = (f"*💰 Buy Credits*\n\n"
-                    f"1 Credit = ₹{credit_val}\n"
-                    f"You can pay ANY amount.\n\n"
-                    f"1. Click 'Pay Now'.\n"
-                    f"2. Click 'I Have Paid'.")
-            back_cb = "user_menu_credits"
-        else:
-            text = "Process Cancelled"
-            back_cb = "user_main_back"
-
+        bot.answer_callback_query(call.id, "✅ Purchase Confirmed! Files are on the way.", show_alert=True)
+        try: bot.delete_message(chat_id, msg_id)
+        except: pass
+    else:
+        req_credits = round(req_rs / credit_val, 2)
+        current_credits = round(get_credits(uid) / credit_val, 2)
+        bot.answer_callback_query(call.id, "❌ Insufficient Credits!", show_alert=True)
+        text = f"❌ *Insufficient Credits*\n\nYou need {req_credits} Credits but have {current_credits}."
         kb = types.InlineKeyboardMarkup(row_width=1)
-        kb.add(types.InlineKeyboardButton("💳 Pay Now", url=PAYMENT_LINK))
-        kb.add(types.InlineKeyboardButton("✅ I Have Paid", callback_data="i_have_paid"))
-        kb.add(types.InlineKeyboardButton("🔙 Back", callback_data=back_cb))
+        kb.add(types.InlineKeyboardButton("💰 Buy Credits", callback_data="buy_credits"))
+        kb.add(types.InlineKeyboardButton("🔙 Cancel", callback_data="user_main_back"))
+        bot.edit_message_text(text, chat_id, msg_id, parse_mode="Markdown", reply_markup=kb)
 
-        smart_edit(chat_id, msg_id, text, reply_markup=kb)
-        return
+# --- 1A. MY CREDITS ---
+@callback_route("user_menu_credits")
+def cb_user_menu_credits(call, action, uid, chat_id, msg_id):
+    active_user_code.pop(uid, None)
+    balance_rs = get_credits(uid)
+    credit_val = CREDIT_CONFIG.get("value", 1.0)
+    credits_display = round(balance_rs / credit_val, 2)
+    text = f"💳 *My Wallet*\n\n💰 Balance: `{credits_display}` Credits"
+    kb = types.InlineKeyboardMarkup(row_width=1)
+    kb.add(types.InlineKeyboardButton("💰 Buy Credits", callback_data="buy_credits"))
+    kb.add(types.InlineKeyboardButton("🔙 Back", callback_data="user_main_back"))
 
-    # --- 9. CANCEL PROCESS (Cleanup) ---
-    if action == "cancel_gen_process":
-        user_states.pop(uid, None)
-        active_user_code.pop(uid, None)
-        
-        txt = "❌ *Process Cancelled*\nThe current file collection process has been stopped. You can start a new command anytime."
-        
-        smart_edit(chat_id, msg_id, txt, reply_markup=None)
-        return
+    smart_edit(chat_id, msg_id, text, reply_markup=kb)
+
+# --- HELP MENU (New) ---
+@callback_route("user_help_menu")
+def cb_user_help_menu(call, action, uid, chat_id, msg_id):
+    help_text = (
+        "📖 *BOT GUIDE & HELP CENTER*\n\n"
+        "Welcome to our File Store Bot! Here is everything you need to know about using this bot efficiently.\n\n"
+        "🌟 *How it Works:*\n"
+        "This bot allows you to store and access files securely. Some files are free, while others require Credits or Premium access.\n\n"
+        "💰 *About Credits:*\n"
+        "Credits are the bot's internal currency. You can buy them using the 'My Credits' menu. 1 Credit value is set by the admin.\n"
+        "1. Click 'My Credits' -> 'Buy Credits'.\n"
+        "2. Complete the payment and provide your email.\n"
+        "3. Use credits to unlock paid files or buy Premium plans.\n\n"
+        "👑 *Premium Membership:*\n"
+        "Buying a Premium plan gives you instant access to all 'Premium' marked links without any extra cost.\n\n"
+        "📜 *Available Commands:*\n"
+        "• /start - Restart/Refresh the bot\n"
+        "• /genpaid - Create your own paid links (Pro)\n"
+        "• /genpublic - Create public links (Pro)\n"
+        "• /shortner - Create links with your ads (Pro)\n"
+        "• /redeem - Use a gift/promo code\n"
+        "• /proof - Check your sales history (Pro)\n\n"
+        "💡 _Tip: Tap any blue command above to execute it instantly!_"
+    )
+    kb = types.InlineKeyboardMarkup()
+    kb.add(types.InlineKeyboardButton("🏠 Home", callback_data="user_main_back"))
 
-    if action == "cancel_input_process":
-        # 1. Clear States (Bot will no longer wait for message)
-        user_support_state.pop(uid, None)
-        active_user_code.pop(uid, None)
-        user_states.pop(uid, None)
-        
-        # 2. Setup Home Menu Content using helpers
-        text_content = get_home_text(call.from_user)
-        markup = get_home_markup()
+    smart_edit(chat_id, msg_id, help_text, reply_markup=kb)
 
-        # 3. Smooth Edit back to Home (Photo remains)
-        smart_edit(chat_id, msg_id, text_content, reply_markup=markup)
-        return
-    if action == "panel_payment_link":
-        bot.send_message(uid, f"🔗 *Current Payment Link:*\n`{PAYMENT_LINK}`\n\nSend new link to edit:", reply_markup=types.ForceReply())
-        user_states[uid] = "WAIT_PAYMENT_LINK"
-        return
+# --- 1B. BUY CREDITS INVOICE ---
+@callback_route("buy_credits")
+def cb_buy_credits(call, action, uid, chat_id, msg_id):
+    active_user_code[uid] = "CREDIT_VIEWING_0_0"
+    credit_val = CREDIT_CONFIG.get("value", 1.0)
+    text = (f"*💰 Buy Credits*\n\n"
+            f"1 Credit = ₹{credit_val}\n"
+            f"You can pay ANY amount. Credits will be added accordingly.\n\n"
+            f"1. Click 'Pay Now'.\n"
+            f"2. Come back & click 'I Have Paid'.")
 
-    # Pro User Handlers
-    if action == "pay_pro_menu":
-        kb = types.InlineKeyboardMarkup()
-        kb.add(types.InlineKeyboardButton("✏️ Set", callback_data="pay_pro_set"), types.InlineKeyboardButton("👀 See", callback_data="pay_pro_see"), types.InlineKeyboardButton("🗑 Delete", callback_data="pay_pro_del"), types.InlineKeyboardButton("🔙 Back", callback_data="user_dashboard"))
-        smart_edit(chat_id, msg_id, "*💳 Payment Settings*", reply_markup=kb)
-        return
-    if action == "pay_pro_set":
-        user_states[uid] = {'state': 'waiting_upi'}
-        kb = types.InlineKeyboardMarkup()
-        kb.add(types.InlineKeyboardButton("❌ Cancel", callback_data="pay_pro_menu"))
-        smart_edit(chat_id, msg_id, "Send your UPI ID:", reply_markup=kb)
-        return
-    if action == "pay_pro_see":
-        bot.send_message(uid, f"Info: {get_user_upi(uid) or 'Not Set'}")
-        return
-    if action == "pay_pro_del":
-        update_user_upi(uid, None)
-        bot.send_message(uid, "Deleted.")
-        return
+    kb = types.InlineKeyboardMarkup(row_width=1)
+    kb.add(types.InlineKeyboardButton("💳 Pay Now", url=PAYMENT_LINK))
+    kb.add(types.InlineKeyboardButton("✅ I Have Paid", callback_data="i_have_paid"))
+    kb.add(types.InlineKeyboardButton("🔙 Back", callback_data="user_menu_credits"))
 
-    # User Personal Shortener Menu
-    if action == "user_short_menu":
-        u = users_col.find_one({"_id": uid})
-        s = u.get("personal_shortener", {})
-        
-        if s.get("api"):
-            status = "✅ Active"
-            details = f"🔗 *Current Settings:*\n🌐 Domain: `{s.get('url')}`\n🔑 API: `{s.get('api')}`"
-        else:
-            status = "❌ Not Set"
-            details = "_No shortener configured yet._"
-            
-        kb = types.InlineKeyboardMarkup(row_width=2)
-        kb.add(
-            types.InlineKeyboardButton("✏️ Set API/Domain", callback_data="user_short_set"),
-            types.InlineKeyboardButton("🗑 Delete", callback_data="user_short_del")
-        )
-        kb.add(types.InlineKeyboardButton("🔙 Back", callback_data="user_dashboard"))
-        
-        txt = f"*🔗 Personal Shortener Settings*\n\nStatus: {status}\n\n{details}\n\nSet your own shortener to generate links with `/shortner`."
-        smart_edit(chat_id, msg_id, txt, reply_markup=kb)
-        return
+    smart_edit(chat_id, msg_id, text, reply_markup=kb)
 
-    if action == "user_short_set":
-        user_states[uid] = {'state': 'waiting_user_short_api'}
-        kb = types.InlineKeyboardMarkup()
-        kb.add(types.InlineKeyboardButton("❌ Cancel", callback_data="cancel_user_short"))
-        smart_edit(chat_id, msg_id, "Send your Shortener API Key:", reply_markup=kb)
+# --- 7. I HAVE PAID (Switch to PENDING State) ---
+@callback_route("i_have_paid")
+def cb_i_have_paid(call, action, uid, chat_id, msg_id):
+    session = active_user_code.get(uid)
+    if not session:
+        # Agar restart ki wajah se session udd gaya
+        bot.answer_callback_query(call.id, "❌ Session Expired. Please Start Again.")
         return
 
-    if action == "cancel_user_short":
-        user_states.pop(uid, None)
-        # Refresh the Personal Shortener Menu
-        u = users_col.find_one({"_id": uid})
-        s = u.get("personal_shortener", {})
-        if s.get("api"):
-            status = "✅ Active"
-            details = f"🔗 *Current Settings:*\n🌐 Domain: `{s.get('url')}`\n🔑 API: `{s.get('api')}`"
-        else:
-            status = "❌ Not Set"
-            details = "_No shortener configured yet._"
-        kb = types.InlineKeyboardMarkup(row_width=2)
-        kb.add(
-            types.InlineKeyboardButton("✏️ Set API/Domain", callback_data="user_short_set"),
-            types.InlineKeyboardButton("🗑 Delete", callback_data="user_short_del")
-        )
-        kb.add(types.InlineKeyboardButton("🔙 Back", callback_data="user_dashboard"))
-        txt = f"*🔗 Personal Shortener Settings*\n\nStatus: {status}\n\n{details}\n\nSet your own shortener to generate links with `/shortner`."
-        smart_edit(chat_id, msg_id, txt, reply_markup=kb)
-        return
+    # Magic: Switch VIEWING -> PENDING (Ab bot Email lega)
+    active_user_code[uid] = session.replace("VIEWING", "PENDING")
+    user_states.pop(uid, None)
 
-    if action == "user_short_see":
-        # Removed as requested
-        return
+    kb = types.InlineKeyboardMarkup()
+    # Back button will go to 'step_back_to_invoice'
+    kb.add(types.InlineKeyboardButton("🔙 Back", callback_data="step_back_to_invoice"))
 
-    if action == "user_short_del":
-        users_col.update_one({"_id": uid}, {"$set": {"personal_shortener": {"api": None, "url": None}}})
-        bot.answer_callback_query(call.id, "✅ Personal Shortener Deleted!", show_alert=True)
-        
-        # --- SMOOTH REFRESH (Manually rebuild the menu to avoid loop) ---
-        status = "❌ Not Set"
-        details = "_No shortener configured yet._"
-        kb = types.InlineKeyboardMarkup(row_width=2)
-        kb.add(
-            types.InlineKeyboardButton("✏️ Set API/Domain", callback_data="user_short_set"),
-            types.InlineKeyboardButton("🗑 Delete", callback_data="user_short_del")
-        )
-        kb.add(types.InlineKeyboardButton("🔙 Back", callback_data="user_dashboard"))
-        
-        txt = f"*🔗 Personal Shortener Settings*\n\nStatus: {status}\n\n{details}\n\nSet your own shortener to generate links with `/shortner`."
-        smart_edit(chat_id, msg_id, txt, reply_markup=kb)
+    text = "📧 *Enter Payment Email:*\n\nPlease provide the email address used during payment for verification."
+    smart_edit(chat_id, msg_id, text, reply_markup=kb)
+
+# --- 8. STEP BACK TO INVOICE (Switch back to VIEWING) ---
+@callback_route("step_back_to_invoice")
+def cb_step_back_to_invoice(call, action, uid, chat_id, msg_id):
+    session = active_user_code.get(uid)
+    if not session:
+        send_custom_welcome(uid)
         return
 
-    # Pro Proof Log (MANUAL PROOF MENU)
-    if action == "manual_proof_menu":
-        proofs = list(pro_proofs_col.find({"owner_id": uid}))
-        if not proofs:
-            bot.answer_callback_query(call.id, "❌ No pending proofs found!")
-            return
+    # Magic: Switch PENDING -> VIEWING (Ab bot random text ignore karega)
+    active_user_code[uid] = session.replace("PENDING", "VIEWING")
 
-        bot.answer_callback_query(call.id, "Fetching proofs...")
+    parts = session.split("_")
+    type_ = parts[0]
 
-        for data in proofs:
-            kb = types.InlineKeyboardMarkup()
-            kb.add(
-                types.InlineKeyboardButton("✅ Success", callback_data=f"proof_ok|{data['_id']}"),
-                types.InlineKeyboardButton("❌ Reject", callback_data=f"proof_no|{data['_id']}")
-            )
+    # Reconstruct Invoice
+    if type_ == "CREDIT":
+        credit_val = CREDIT_CONFIG.get("value", 1.0)
+        text = (f"*💰 Buy Credits*\n\n"
+                f"1 Credit = ₹{credit_val}\n"
+                f"You can pay ANY amount.\n\n"
+                f"1. Click 'Pay Now'.\n"
+                f"2. Click 'I Have Paid'.")
+        back_cb = "user_menu_credits"
+    else:
+        text = "Process Cancelled"
+        back_cb = "user_main_back"
 
-            cap = (f"📩 *Payment Proof*\n\n"
-                   f"👤 UserID: `{data['user_id']}`\n"
-                   f"💰 Price: ₹{data.get('price', 'N/A')}\n"
-                   f"📂 Code: `{data.get('code', 'N/A')}`")
+    kb = types.InlineKeyboardMarkup(row_width=1)
+    kb.add(types.InlineKeyboardButton("💳 Pay Now", url=PAYMENT_LINK))
+    kb.add(types.InlineKeyboardButton("✅ I Have Paid", callback_data="i_have_paid"))
+    kb.add(types.InlineKeyboardButton("🔙 Back", callback_data=back_cb))
 
-            try:
-                bot.send_photo(uid, data['photo'], caption=cap, reply_markup=kb)
-            except:
-                bot.send_message(uid, f"{cap}\n[Photo Failed]", reply_markup=kb)
-        return
+    smart_edit(chat_id, msg_id, text, reply_markup=kb)
 
-      # SUCCESS / REJECT BUTTONS
-    if action.startswith("proof_ok|") or action.startswith("proof_no|"):
-        act, pid = action.split("|")
-        proof = pro_proofs_col.find_one({"_id": pid})
+# --- 9. CANCEL PROCESS (Cleanup) ---
+@callback_route("cancel_gen_process")
+def cb_cancel_gen_process(call, action, uid, chat_id, msg_id):
+    discard_batch_draft(user_states.pop(uid, None))
+    clear_batch_status(uid)
+    active_user_code.pop(uid, None)
 
-        if not proof:
-            bot.answer_callback_query(call.id, "This process is already completed.")
-            try: bot.delete_message(chat_id, msg_id)
-            except: pass
-            return
+    txt = "❌ *Process Cancelled*\nThe current file collection process has been stopped. You can start a new command anytime."
 
-        buyer_id = proof['user_id']
+    smart_edit(chat_id, msg_id, txt, reply_markup=None)
 
-        if act == "proof_ok":
-            # 1. File bhejo
-            send_batch_content(buyer_id, proof['code'])
-            
-            # 2. Buyer ko batao
-            try: bot.send_message(buyer_id, "✅ *Payment Accepted!*\nThe requested files have been delivered.")
-            except: pass
-            
-            # 3. Seller Message Update (FIXED HERE)
-            try:
-                bot.edit_message_caption("✅ ACCEPTED & DELIVERED", chat_id, msg_id)
-            except:
-                # Agar Caption edit na ho (matlab ye text message hai), to Text edit karo
-                bot.edit_message_text("✅ ACCEPTED & DELIVERED", chat_id, msg_id)
-        
-        else: # Reject Logic
-            # 1. Buyer ko batao
-            try: bot.send_message(buyer_id, "❌ *Payment Rejected!*\nThe payment could not be verified. Please check your details and try again.")
-            except: pass
-            
-            # 2. Seller Message Update (FIXED HERE)
-            try:
-                bot.edit_message_caption("❌ REJECTED", chat_id, msg_id)
-            except:
-                bot.edit_message_text("❌ REJECTED", chat_id, msg_id)
+@callback_route("cancel_input_process")
+def cb_cancel_input_process(call, action, uid, chat_id, msg_id):
+    # 1. Clear States (Bot will no longer wait for message)
+    user_support_state.pop(uid, None)
+    active_user_code.pop(uid, None)
+    user_states.pop(uid, None)
 
-        # Database se delete aur cleanup
-        pro_proofs_col.delete_one({"_id": pid})
-        time.sleep(2)
-        try: bot.delete_message(chat_id, msg_id)
-        except: pass
-        return
+    # 2. Setup Home Menu Content using helpers
+    text_content = get_home_text(call.from_user)
+    markup = get_home_markup()
 
+    # 3. Smooth Edit back to Home (Photo remains)
+    smart_edit(chat_id, msg_id, text_content, reply_markup=markup)
 
-        # --- BATCH SAVE (DONE BUTTON) WITH CLEANUP ---
-    if action == "batch_save":
-        state = user_states.get(uid)
+@callback_route("panel_payment_link", admin=True)
+def cb_panel_payment_link(call, action, uid, chat_id, msg_id):
+    bot.send_message(uid, f"🔗 *Current Payment Link:*\n`{PAYMENT_LINK}`\n\nSend new link to edit:", reply_markup=types.ForceReply())
+    user_states[uid] = "WAIT_PAYMENT_LINK"
 
-        # 1. Session Check
-        if not state or not state.get('files'):
-            bot.answer_callback_query(call.id, "❌ Session Expired!", show_alert=True)
-            try: bot.delete_message(chat_id, msg_id)
-            except: pass
-            return
+# Pro User Handlers
+@callback_route("pay_pro_menu")
+def cb_pay_pro_menu(call, action, uid, chat_id, msg_id):
+    kb = types.InlineKeyboardMarkup()
+    kb.add(types.InlineKeyboardButton("✏️ Set", callback_data="pay_pro_set"), types.InlineKeyboardButton("👀 See", callback_data="pay_pro_see"), types.InlineKeyboardButton("🗑 Delete", callback_data="pay_pro_del"), types.InlineKeyboardButton("🔙 Back", callback_data="user_dashboard"))
+    smart_edit(chat_id, msg_id, "*💳 Payment Settings*", reply_markup=kb)
 
-        bot.answer_callback_query(call.id, "Generating Link...")
+@callback_route("pay_pro_set")
+def cb_pay_pro_set(call, action, uid, chat_id, msg_id):
+    user_states[uid] = {'state': 'waiting_upi'}
+    kb = types.InlineKeyboardMarkup()
+    kb.add(types.InlineKeyboardButton("❌ Cancel", callback_data="pay_pro_menu"))
+    smart_edit(chat_id, msg_id, "Send your UPI ID:", reply_markup=kb)
+
+@callback_route("pay_pro_see")
+def cb_pay_pro_see(call, action, uid, chat_id, msg_id):
+    bot.send_message(uid, f"Info: {get_user_upi(uid) or 'Not Set'}")
+
+@callback_route("pay_pro_del")
+def cb_pay_pro_del(call, action, uid, chat_id, msg_id):
+    update_user_upi(uid, None)
+    bot.send_message(uid, "Deleted.")
+
+# User Personal Shortener Menu
+@callback_route("user_short_menu")
+def cb_user_short_menu(call, action, uid, chat_id, msg_id):
+    u = get_user(uid)
+    s = u.get("personal_shortener", {})
 
-        # 2. Data Collect
-        code = gen_code()
-        batch_type = state.get('type', 'normal')
-        price = state.get('price', 0)
-        owner_id = state.get('owner', uid)
-        files = state['files']
-        
-        # --- CLEANUP START (Ye naya magic hai) ---
-        # Jo buttons delete hone se reh gaye, unhe ab uda do
-        btn_ids = state.get('btn_ids', [])
-        
-        def clean_old_buttons(c_id, ids, current_msg_id):
-            for mid in ids:
-                if mid == current_msg_id: continue # Done button ko mat udana
-                try: 
-                    bot.delete_message(c_id, mid)
-                    time.sleep(0.05) # Thoda sa gap taaki Telegram block na kare
-                except: pass
-        
-        # Background mein delete karo
-        threading.Thread(target=clean_old_buttons, args=(chat_id, btn_ids, msg_id)).start()
-        # --- CLEANUP END ---
+    if s.get("api"):
+        status = "✅ Active"
+        details = f"🔗 *Current Settings:*\n🌐 Domain: `{s.get('url')}`\n🔑 API: `{s.get('api')}`"
+    else:
+        status = "❌ Not Set"
+        details = "_No shortener configured yet._"
 
-        # 3. Database Save
-        batches_col.insert_one({
-            '_id': code,
-            'type': batch_type,
-            'price': price,
-            'owner_id': owner_id,
-            'files': files,
-            'created_at': datetime.now()
-        })
+    kb = types.InlineKeyboardMarkup(row_width=2)
+    kb.add(
+        types.InlineKeyboardButton("✏️ Set API/Domain", callback_data="user_short_set"),
+        types.InlineKeyboardButton("🗑 Delete", callback_data="user_short_del")
+    )
+    kb.add(types.InlineKeyboardButton("🔙 Back", callback_data="user_dashboard"))
 
-        # 4. Response Message
-        if batch_type == "shortner_link":
-            # Generate shortened link using USER'S personal shortener
-            u = users_col.find_one({"_id": uid})
-            s = u.get("personal_shortener", {})
-            bot_start_link = f"https://t.me/{BOT_USERNAME}?start=sl_{code}"
-            final_link = get_short_link(bot_start_link, s)
-            msg = (f"✅ *Shortener Link Generated!*\n\n"
-                   f"🔗 `{final_link}`\n"
-                   f"📂 Files: {len(files)}\n"
-                   f"⚠️ *Note:* This link will bypass bot's global verification.")
-        else:
-            link = f"https://t.me/{BOT_USERNAME}?start={code}"
-            warning = ""
-            if batch_type == 'special' and not get_user_upi(owner_id):
-                warning = "\n⚠️ *Warning:* UPI ID missing!"
+    txt = f"*🔗 Personal Shortener Settings*\n\nStatus: {status}\n\n{details}\n\nSet your own shortener to generate links with `/shortner`."
+    smart_edit(chat_id, msg_id, txt, reply_markup=kb)
 
-            msg = (f"✅ *Link Generated!*\n"
-                   f"🔗 `{link}`\n"
-                   f"📂 Files: {len(files)}\n"
-                   f"💰 Price: ₹{price}"
-                   f"{warning}")
+@callback_route("user_short_set")
+def cb_user_short_set(call, action, uid, chat_id, msg_id):
+    user_states[uid] = {'state': 'waiting_user_short_api'}
+    kb = types.InlineKeyboardMarkup()
+    kb.add(types.InlineKeyboardButton("❌ Cancel", callback_data="cancel_user_short"))
+    smart_edit(chat_id, msg_id, "Send your Shortener API Key:", reply_markup=kb)
+
+@callback_route("cancel_user_short")
+def cb_cancel_user_short(call, action, uid, chat_id, msg_id):
+    user_states.pop(uid, None)
+    # Refresh the Personal Shortener Menu
+    u = get_user(uid)
+    s = u.get("personal_shortener", {})
+    if s.get("api"):
+        status = "✅ Active"
+        details = f"🔗 *Current Settings:*\n🌐 Domain: `{s.get('url')}`\n🔑 API: `{s.get('api')}`"
+    else:
+        status = "❌ Not Set"
+        details = "_No shortener configured yet._"
+    kb = types.InlineKeyboardMarkup(row_width=2)
+    kb.add(
+        types.InlineKeyboardButton("✏️ Set API/Domain", callback_data="user_short_set"),
+        types.InlineKeyboardButton("🗑 Delete", callback_data="user_short_del")
+    )
+    kb.add(types.InlineKeyboardButton("🔙 Back", callback_data="user_dashboard"))
+    txt = f"*🔗 Personal Shortener Settings*\n\nStatus: {status}\n\n{details}\n\nSet your own shortener to generate links with `/shortner`."
+    smart_edit(chat_id, msg_id, txt, reply_markup=kb)
+
+@callback_route("user_short_see")
+def cb_user_short_see(call, action, uid, chat_id, msg_id):
+    # Removed as requested
+    pass
+
+@callback_route("user_short_del")
+def cb_user_short_del(call, action, uid, chat_id, msg_id):
+    update_user(uid, {"$set": {"personal_shortener": {"api": None, "url": None}}})
+    bot.answer_callback_query(call.id, "✅ Personal Shortener Deleted!", show_alert=True)
+
+    # --- SMOOTH REFRESH (Manually rebuild the menu to avoid loop) ---
+    status = "❌ Not Set"
+    details = "_No shortener configured yet._"
+    kb = types.InlineKeyboardMarkup(row_width=2)
+    kb.add(
+        types.InlineKeyboardButton("✏️ Set API/Domain", callback_data="user_short_set"),
+        types.InlineKeyboardButton("🗑 Delete", callback_data="user_short_del")
+    )
+    kb.add(types.InlineKeyboardButton("🔙 Back", callback_data="user_dashboard"))
 
-        # Current message ko edit karke Link dikha do
-        smart_edit(chat_id, msg_id, msg)
+    txt = f"*🔗 Personal Shortener Settings*\n\nStatus: {status}\n\n{details}\n\nSet your own shortener to generate links with `/shortner`."
+    smart_edit(chat_id, msg_id, txt, reply_markup=kb)
 
-        # 5. Clear Memory
-        user_states.pop(uid, None)
+# Pro Proof Log (MANUAL PROOF MENU)
+@callback_route("manual_proof_menu")
+def cb_manual_proof_menu(call, action, uid, chat_id, msg_id):
+    proofs = list(pro_proofs_col.find({"owner_id": uid}))
+    if not proofs:
+        bot.answer_callback_query(call.id, "❌ No pending proofs found!")
         return
-    # --- ADMIN CHECK (Iske neeche sirf Admin logic rahega) ---
-    if uid != ADMIN_ID: return 
 
-    if action == "panel_settings":
-        send_settings_panel(uid, msg_id)
-        return
-    if action == "close_panel":
-        send_admin_panel(uid, msg_id)
-        return
+    bot.answer_callback_query(call.id, "Fetching proofs...")
 
-    # Custom Button
-    if action == "panel_custom_btn":
+    for data in proofs:
         kb = types.InlineKeyboardMarkup()
-        btn = CUSTOM_BTN_CONFIG.get("text")
-        if not btn:
-            kb.add(types.InlineKeyboardButton("➕ Add Button", callback_data="cb_add"))
-        else:
-            kb.add(types.InlineKeyboardButton("👀 See", callback_data="cb_see"), types.InlineKeyboardButton("🗑 Remove", callback_data="cb_rem"))
-        kb.add(types.InlineKeyboardButton("🔙 Back", callback_data="panel_settings"))
-
-        msg = (
-            "🔘 *Custom Button Settings*\n\n"
-            "Format to Copy & Send:\n"
-            "`[Button Name][buttonurl:https://link.com]`\n\n"
-            "Double Button:\n"
-            "`[Btn 1][buttonurl:link][Btn 2][buttonurl:link]`"
+        kb.add(
+            types.InlineKeyboardButton("✅ Success", callback_data=f"proof_ok|{data['_id']}"),
+            types.InlineKeyboardButton("❌ Reject", callback_data=f"proof_no|{data['_id']}")
         )
-        smart_edit(chat_id, msg_id, msg, reply_markup=kb)
-        return
 
-    if action == "cb_add":
-        user_states[uid] = {'state': 'waiting_custom_btn'}
-        bot.send_message(uid, "Send your button text format:")
-        return
+        cap = (f"📩 *Payment Proof*\n\n"
+               f"👤 UserID: `{data['user_id']}`\n"
+               f"💰 Price: ₹{data.get('price', 'N/A')}\n"
+               f"📂 Code: `{data.get('code', 'N/A')}`")
 
-    if action == "cb_see":
-        markup = get_custom_markup()
-        bot.send_message(uid, f"Current Button Text:\n`{CUSTOM_BTN_CONFIG.get('text')}`\n\nPreview Below:", reply_markup=markup)
-        return
+        try:
+            bot.send_photo(uid, data['photo'], caption=cap, reply_markup=kb)
+        except:
+            bot.send_message(uid, f"{cap}\n[Photo Failed]", reply_markup=kb)
 
-    if action == "cb_rem":
-        CUSTOM_BTN_CONFIG["text"] = None
-        save_setting("custom_btn", CUSTOM_BTN_CONFIG)
-        bot.send_message(uid, "✅ Custom button removed.")
-        kb = types.InlineKeyboardMarkup()
-        kb.add(types.InlineKeyboardButton("➕ Add Button", callback_data="cb_add"))
-        kb.add(types.InlineKeyboardButton("🔙 Back", callback_data="panel_settings"))
-        bot.send_message(uid, "Refreshed Panel:", reply_markup=kb)
-        return
+# SUCCESS / REJECT BUTTONS
+@callback_route("proof_ok|", prefix=True)
+@callback_route("proof_no|", prefix=True)
+def cb_proof_decision(call, action, uid, chat_id, msg_id):
+    act, pid = action.split("|")
+    proof = pro_proofs_col.find_one({"_id": pid})
 
-    # Force Join
-    if action == "panel_force":
-        status = "✅ Active" if CHANNEL_CONFIG.get("active") else "❌ Inactive"
-        kb = types.InlineKeyboardMarkup(row_width=1)
-        for idx, ch in enumerate(CHANNEL_CONFIG.get("channels", [])):
-            kb.add(types.InlineKeyboardButton(f"📺 {ch['title']}", callback_data=f"fj_view_{idx}"))
-        kb.add(types.InlineKeyboardButton("+ Add Channel +", callback_data="fj_add"))
-        kb.add(types.InlineKeyboardButton(f"Force Join: {status}", callback_data="fj_toggle"))
-        kb.add(types.InlineKeyboardButton("🔙 Back", callback_data="panel_settings"))
-        smart_edit(chat_id, msg_id, "*❪ SET CHANNEL ❫*", reply_markup=kb)
-        return
-    if action == "fj_toggle":
-        CHANNEL_CONFIG["active"] = not CHANNEL_CONFIG.get("active", False)
-        save_setting("channel", CHANNEL_CONFIG)
-        status = "✅ Active" if CHANNEL_CONFIG.get("active") else "❌ Inactive"
-        kb = types.InlineKeyboardMarkup(row_width=1)
-        for idx, ch in enumerate(CHANNEL_CONFIG.get("channels", [])):
-            kb.add(types.InlineKeyboardButton(f"📺 {ch['title']}", callback_data=f"fj_view_{idx}"))
-        kb.add(types.InlineKeyboardButton("+ Add Channel +", callback_data="fj_add"))
-        kb.add(types.InlineKeyboardButton(f"Force Join: {status}", callback_data="fj_toggle"))
-        kb.add(types.InlineKeyboardButton("🔙 Back", callback_data="panel_settings"))
-        smart_edit(chat_id, msg_id, "*❪ SET CHANNEL ❫*", reply_markup=kb)
-        return
-    if action == "fj_add":
-        user_states[uid] = {'state': 'waiting_fj_forward'}
-        bot.send_message(uid, "Forward a message from your channel:")
+    if not proof:
+        bot.answer_callback_query(call.id, "This process is already completed.")
+        try: bot.delete_message(chat_id, msg_id)
+        except: pass
         return
-    if action.startswith("fj_view_"):
-        idx = int(action.split("_")[2])
+
+    buyer_id = proof['user_id']
+
+    if act == "proof_ok":
+        # 1. File bhejo (queue se, proof id hi idempotency key hai)
+        enqueue_delivery(buyer_id, proof['code'], f"proof:{pid}")
+
+        # 2. Buyer ko batao
+        try: bot.send_message(buyer_id, "✅ *Payment Accepted!*\nThe requested files are being delivered.")
+        except: pass
+
+        # 3. Seller Message Update (FIXED HERE)
         try:
-            ch = CHANNEL_CONFIG["channels"][idx]
-            kb = types.InlineKeyboardMarkup()
-            kb.add(types.InlineKeyboardButton("🗑 Remove Channel", callback_data=f"fj_rem_{idx}"))
-            kb.add(types.InlineKeyboardButton("🔙 Back", callback_data="panel_force"))
-            txt = f"Title: {ch['title']}\nID: `{ch['id']}`"
-            smart_edit(chat_id, msg_id, txt, reply_markup=kb)
+            bot.edit_message_caption("✅ ACCEPTED & DELIVERED", chat_id, msg_id)
+        except:
+            # Agar Caption edit na ho (matlab ye text message hai), to Text edit karo
+            bot.edit_message_text("✅ ACCEPTED & DELIVERED", chat_id, msg_id)
+
+    else: # Reject Logic
+        # 1. Buyer ko batao
+        try: bot.send_message(buyer_id, "❌ *Payment Rejected!*\nThe payment could not be verified. Please check your details and try again.")
         except: pass
-        return
-    if action.startswith("fj_rem_"):
-        idx = int(action.split("_")[2])
+
+        # 2. Seller Message Update (FIXED HERE)
         try:
-            del CHANNEL_CONFIG["channels"][idx]
-            save_setting("channel", CHANNEL_CONFIG)
-            bot.send_message(uid, "Removed.")
+            bot.edit_message_caption("❌ REJECTED", chat_id, msg_id)
+        except:
+            bot.edit_message_text("❌ REJECTED", chat_id, msg_id)
+
+    # Database se delete aur cleanup
+    pro_proofs_col.delete_one({"_id": pid})
+    run_later(2, delete_quietly, chat_id, msg_id)
+    return
+
+
+    # --- BATCH SAVE (DONE BUTTON) ---
+
+def send_shortener_batch_link(uid, chat_id, msg_id, code, file_count):
+    # Generate shortened link using USER'S personal shortener
+    u = get_user(uid)
+    s = u.get("personal_shortener", {}) if u else {}
+    bot_start_link = f"https://t.me/{BOT_USERNAME}?start=sl_{code}"
+    final_link = get_short_link(bot_start_link, s)
+    msg = (f"✅ *Shortener Link Generated!*\n\n"
+           f"🔗 `{final_link}`\n"
+           f"📂 Files: {file_count}\n"
+           f"⚠️ *Note:* This link will bypass bot's global verification.")
+    smart_edit(chat_id, msg_id, msg)
+
+@callback_route("batch_save")
+def cb_batch_save(call, action, uid, chat_id, msg_id):
+    state, version = user_states.get_versioned(uid)
+    draft = None
+    if isinstance(state, dict) and state.get('draft_id'):
+        draft = batch_drafts_col.find_one({"_id": state['draft_id']}, {"files": 0})
+
+    # 1. Session Check
+    if not draft or not draft.get('count'):
+        bot.answer_callback_query(call.id, "❌ Session Expired!", show_alert=True)
+        try: bot.delete_message(chat_id, msg_id)
         except: pass
         return
 
-    # REDEEM SYSTEM
-    if action == "panel_redeem":
-        kb = types.InlineKeyboardMarkup(row_width=2)
-        kb.add(
-            types.InlineKeyboardButton("➕ Create Code", callback_data="redeem_create"),
-            types.InlineKeyboardButton("🗑 Delete Code", callback_data="redeem_delete"),
-            types.InlineKeyboardButton("📜 List All", callback_data="redeem_list"),
-            types.InlineKeyboardButton("🔙 Back", callback_data="close_panel")
-        )
-        smart_edit(chat_id, msg_id, "*🎁 Redeem System Menu*", reply_markup=kb)
+    # Session atomically claim karo, double "Done" tap se do batches na banein
+    if not user_states.compare_and_set(uid, version, None):
+        bot.answer_callback_query(call.id, "⏳ Already processing...")
         return
 
-    if action == "redeem_create":
-        user_states[uid] = {'state': 'waiting_redeem_name', 'msg_id': msg_id}
-        kb = types.InlineKeyboardMarkup()
-        kb.add(types.InlineKeyboardButton("❌ Cancel", callback_data="cancel_admin_redeem"))
-        smart_edit(chat_id, msg_id, "⌨️ *Step 1:* Enter Code Name (e.g. WELCOME50):", reply_markup=kb)
-        return
+    bot.answer_callback_query(call.id, "Generating Link...")
 
-    if action == "redeem_delete":
-        user_states[uid] = {'state': 'waiting_redeem_del'}
-        kb = types.InlineKeyboardMarkup()
-        kb.add(types.InlineKeyboardButton("❌ Cancel", callback_data="cancel_admin_redeem"))
-        smart_edit(chat_id, msg_id, "🗑 Enter Code Name to Delete:", reply_markup=kb)
-        return
+    # 2. Data Collect
+    code = gen_code()
+    batch_type = draft.get('type', 'normal')
+    price = draft.get('price', 0)
+    owner_id = draft.get('owner_id', uid)
+    file_count = draft['count']
 
-    if action == "cancel_admin_redeem":
-        user_states.pop(uid, None)
-        # Go back to Redeem System menu
-        kb = types.InlineKeyboardMarkup(row_width=2)
-        kb.add(
-            types.InlineKeyboardButton("➕ Create Code", callback_data="redeem_create"),
-            types.InlineKeyboardButton("🗑 Delete Code", callback_data="redeem_delete"),
-            types.InlineKeyboardButton("📜 List All", callback_data="redeem_list"),
-            types.InlineKeyboardButton("🔙 Back", callback_data="close_panel")
-        )
-        smart_edit(chat_id, msg_id, "*🎁 Redeem System Menu*", reply_markup=kb)
+    # Pending status edit roko; Done kisi aur message se dabaya ho to status message hata do
+    clear_batch_status(uid)
+    status_mid = state.get('status_msg_id')
+    if status_mid and status_mid != msg_id: delete_quietly(chat_id, status_mid)
+
+    # 3. Database Save (draft -> batch)
+    promote_batch_draft(draft, code)
+
+    # 4. Response Message
+    if batch_type == "shortner_link":
+        # User ke personal shortener ki call lane ke bahar; reply bhi wahi edit karega
+        run_off_lane(send_shortener_batch_link, uid, chat_id, msg_id, code, file_count)
         return
+    else:
+        link = f"https://t.me/{BOT_USERNAME}?start={code}"
+        warning = ""
+        if batch_type == 'special' and not get_user_upi(owner_id):
+            warning = "\n⚠️ *Warning:* UPI ID missing!"
 
-    if action == "redeem_list":
-        redeems = list(redeems_col.find())
-        if not redeems:
-            bot.answer_callback_query(call.id, "❌ No active codes!")
-            return
-        
-        txt = "📜 *Active Redeem Codes:*\n\n"
-        for r in redeems:
-            exp = r['expiry'].strftime("%d-%b %I:%M %p")
-            txt += f"🔹 `{r['_id']}`\n   💰 {r.get('credits', 0)} Cr | 🎁 {r.get('bonus', 0)}%\n   ⌛ Exp: {exp}\n\n"
-        
+        msg = (f"✅ *Link Generated!*\n"
+               f"🔗 `{link}`\n"
+               f"📂 Files: {file_count}\n"
+               f"💰 Price: ₹{price}"
+               f"{warning}")
+
+    # Current message ko edit karke Link dikha do
+    smart_edit(chat_id, msg_id, msg)
+
+# ---------------- ADMIN CALLBACKS ----------------
+
+@callback_route("panel_settings", admin=True)
+def cb_panel_settings(call, action, uid, chat_id, msg_id):
+    send_settings_panel(uid, msg_id)
+
+@callback_route("close_panel", admin=True)
+def cb_close_panel(call, action, uid, chat_id, msg_id):
+    send_admin_panel(uid, msg_id)
+
+# Custom Button
+@callback_route("panel_custom_btn", admin=True)
+def cb_panel_custom_btn(call, action, uid, chat_id, msg_id):
+    kb = types.InlineKeyboardMarkup()
+    btn = CUSTOM_BTN_CONFIG.get("text")
+    if not btn:
+        kb.add(types.InlineKeyboardButton("➕ Add Button", callback_data="cb_add"))
+    else:
+        kb.add(types.InlineKeyboardButton("👀 See", callback_data="cb_see"), types.InlineKeyboardButton("🗑 Remove", callback_data="cb_rem"))
+    kb.add(types.InlineKeyboardButton("🔙 Back", callback_data="panel_settings"))
+
+    msg = (
+        "🔘 *Custom Button Settings*\n\n"
+        "Format to Copy & Send:\n"
+        "`[Button Name][buttonurl:https://link.com]`\n\n"
+        "Double Button:\n"
+        "`[Btn 1][buttonurl:link][Btn 2][buttonurl:link]`"
+    )
+    smart_edit(chat_id, msg_id, msg, reply_markup=kb)
+
+@callback_route("cb_add", admin=True)
+def cb_custom_btn_add(call, action, uid, chat_id, msg_id):
+    user_states[uid] = {'state': 'waiting_custom_btn'}
+    bot.send_message(uid, "Send your button text format:")
+
+@callback_route("cb_see", admin=True)
+def cb_custom_btn_see(call, action, uid, chat_id, msg_id):
+    markup = get_custom_markup()
+    bot.send_message(uid, f"Current Button Text:\n`{CUSTOM_BTN_CONFIG.get('text')}`\n\nPreview Below:", reply_markup=markup)
+
+@callback_route("cb_rem", admin=True)
+def cb_custom_btn_rem(call, action, uid, chat_id, msg_id):
+    CUSTOM_BTN_CONFIG["text"] = None
+    save_setting("custom_btn", CUSTOM_BTN_CONFIG)
+    bot.send_message(uid, "✅ Custom button removed.")
+    kb = types.InlineKeyboardMarkup()
+    kb.add(types.InlineKeyboardButton("➕ Add Button", callback_data="cb_add"))
+    kb.add(types.InlineKeyboardButton("🔙 Back", callback_data="panel_settings"))
+    bot.send_message(uid, "Refreshed Panel:", reply_markup=kb)
+
+# Force Join
+@callback_route("panel_force", admin=True)
+def cb_panel_force(call, action, uid, chat_id, msg_id):
+    status = "✅ Active" if CHANNEL_CONFIG.get("active") else "❌ Inactive"
+    kb = types.InlineKeyboardMarkup(row_width=1)
+    for idx, ch in enumerate(CHANNEL_CONFIG.get("channels", [])):
+        kb.add(types.InlineKeyboardButton(f"📺 {ch['title']}", callback_data=f"fj_view_{idx}"))
+    kb.add(types.InlineKeyboardButton("+ Add Channel +", callback_data="fj_add"))
+    kb.add(types.InlineKeyboardButton(f"Force Join: {status}", callback_data="fj_toggle"))
+    kb.add(types.InlineKeyboardButton("🔙 Back", callback_data="panel_settings"))
+    smart_edit(chat_id, msg_id, "*❪ SET CHANNEL ❫*", reply_markup=kb)
+
+@callback_route("fj_toggle", admin=True)
+def cb_fj_toggle(call, action, uid, chat_id, msg_id):
+    CHANNEL_CONFIG["active"] = not CHANNEL_CONFIG.get("active", False)
+    save_setting("channel", CHANNEL_CONFIG)
+    status = "✅ Active" if CHANNEL_CONFIG.get("active") else "❌ Inactive"
+    kb = types.InlineKeyboardMarkup(row_width=1)
+    for idx, ch in enumerate(CHANNEL_CONFIG.get("channels", [])):
+        kb.add(types.InlineKeyboardButton(f"📺 {ch['title']}", callback_data=f"fj_view_{idx}"))
+    kb.add(types.InlineKeyboardButton("+ Add Channel +", callback_data="fj_add"))
+    kb.add(types.InlineKeyboardButton(f"Force Join: {status}", callback_data="fj_toggle"))
+    kb.add(types.InlineKeyboardButton("🔙 Back", callback_data="panel_settings"))
+    smart_edit(chat_id, msg_id, "*❪ SET CHANNEL ❫*", reply_markup=kb)
+
+@callback_route("fj_add", admin=True)
+def cb_fj_add(call, action, uid, chat_id, msg_id):
+    user_states[uid] = {'state': 'waiting_fj_forward'}
+    bot.send_message(uid, "Forward a message from your channel:")
+
+@callback_route("fj_view_", prefix=True, admin=True)
+def cb_fj_view(call, action, uid, chat_id, msg_id):
+    idx = int(action.split("_")[2])
+    try:
+        ch = CHANNEL_CONFIG["channels"][idx]
         kb = types.InlineKeyboardMarkup()
-        kb.add(types.InlineKeyboardButton("🔙 Back", callback_data="panel_redeem"))
+        kb.add(types.InlineKeyboardButton("🗑 Remove Channel", callback_data=f"fj_rem_{idx}"))
+        kb.add(types.InlineKeyboardButton("🔙 Back", callback_data="panel_force"))
+        txt = f"Title: {ch['title']}\nID: `{ch['id']}`"
         smart_edit(chat_id, msg_id, txt, reply_markup=kb)
-        return
+    except: pass
 
-    # BAN SYSTEM
-    if action == "panel_ban":
-        kb = types.InlineKeyboardMarkup(row_width=2)
-        kb.add(types.InlineKeyboardButton("🚫 Ban User", callback_data="ban_add"),
-               types.InlineKeyboardButton("✅ Unban User", callback_data="ban_remove"))
-        kb.add(types.InlineKeyboardButton("🔙 Back", callback_data="panel_settings"))
-        banned_count = users_col.count_documents({"is_banned": True})
-        smart_edit(chat_id, msg_id, f"*🚫 User Ban System*\nBanned: {banned_count}", reply_markup=kb)
-    elif action == "ban_add":
-        user_states[uid] = {'state': 'waiting_ban_id'}
-        bot.send_message(uid, "Send User ID to BAN:")
-    elif action == "ban_remove":
-        user_states[uid] = {'state': 'waiting_unban_id'}
-        bot.send_message(uid, "Send User ID to UNBAN:")
-
-    # CREDIT SYSTEM
-    if action == "panel_credits":
-        credit_val = CREDIT_CONFIG.get("value", 1.0)
-        kb = types.InlineKeyboardMarkup(row_width=1)
-        kb.add(
-            types.InlineKeyboardButton(f"💲 Set Credit Value (₹{credit_val})", callback_data="credit_set_val"),
-            types.InlineKeyboardButton("➕ Add Credit Manually", callback_data="credit_add_manual"),
-            types.InlineKeyboardButton("🔙 Back", callback_data="panel_settings")
-        )
-        smart_edit(chat_id, msg_id, "*💳 Credit System Configuration*", reply_markup=kb)
-        return
-        
-    if action == "credit_set_val":
-        user_states[uid] = {'state': 'waiting_credit_val'}
-        kb = types.InlineKeyboardMarkup()
-        kb.add(types.InlineKeyboardButton("❌ Cancel", callback_data="cancel_admin_credit"))
-        smart_edit(chat_id, msg_id, "Send new value for 1 Credit (in ₹):", reply_markup=kb)
-        return
-        
-    if action == "credit_add_manual":
-        user_states[uid] = {'state': 'waiting_credit_user'}
-        kb = types.InlineKeyboardMarkup()
-        kb.add(types.InlineKeyboardButton("❌ Cancel", callback_data="cancel_admin_credit"))
-        smart_edit(chat_id, msg_id, "Send User ID to add credits:", reply_markup=kb)
-        return
+@callback_route("fj_rem_", prefix=True, admin=True)
+def cb_fj_rem(call, action, uid, chat_id, msg_id):
+    idx = int(action.split("_")[2])
+    try:
+        del CHANNEL_CONFIG["channels"][idx]
+        save_setting("channel", CHANNEL_CONFIG)
+        bot.send_message(uid, "Removed.")
+    except: pass
 
-    if action == "cancel_admin_credit":
-        user_states.pop(uid, None)
-        # Go back to Credit System menu
-        credit_val = CREDIT_CONFIG.get("value", 1.0)
-        kb = types.InlineKeyboardMarkup(row_width=1)
-        kb.add(
-            types.InlineKeyboardButton(f"💲 Set Credit Value (₹{credit_val})", callback_data="credit_set_val"),
-            types.InlineKeyboardButton("➕ Add Credit Manually", callback_data="credit_add_manual"),
-            types.InlineKeyboardButton("🔙 Back", callback_data="panel_settings")
-        )
-        smart_edit(chat_id, msg_id, "*💳 Credit System Configuration*", reply_markup=kb)
-        return
+# REDEEM SYSTEM
+@callback_route("panel_redeem", admin=True)
+def cb_panel_redeem(call, action, uid, chat_id, msg_id):
+    kb = types.InlineKeyboardMarkup(row_width=2)
+    kb.add(
+        types.InlineKeyboardButton("➕ Create Code", callback_data="redeem_create"),
+        types.InlineKeyboardButton("🗑 Delete Code", callback_data="redeem_delete"),
+        types.InlineKeyboardButton("📜 List All", callback_data="redeem_list"),
+        types.InlineKeyboardButton("🔙 Back", callback_data="close_panel")
+    )
+    smart_edit(chat_id, msg_id, "*🎁 Redeem System Menu*", reply_markup=kb)
 
-    # TOKEN
-    if action == "panel_token":
-        status = "✅ On" if SHORTNER_CONFIG.get("active") else "❌ Off"
-        validity = SHORTNER_CONFIG.get("validity", 12)
-        kb = types.InlineKeyboardMarkup(row_width=1)
-        kb.add(
-            types.InlineKeyboardButton("Manage Shorteners", callback_data="tok_short_list"),
-            types.InlineKeyboardButton(f"Verify Time ({validity}h)", callback_data="tok_time"),
-            types.InlineKeyboardButton(f"Status ({status})", callback_data="tok_onoff"),
-            types.InlineKeyboardButton("Verify Tutorial", callback_data="tok_tut"),
-            types.InlineKeyboardButton("🔙 Back", callback_data="panel_settings")
-        )
-        smart_edit(chat_id, msg_id, "*🔐 Token Verification Settings*", reply_markup=kb)
-        return
+@callback_route("redeem_create", admin=True)
+def cb_redeem_create(call, action, uid, chat_id, msg_id):
+    user_states[uid] = {'state': 'waiting_redeem_name', 'msg_id': msg_id}
+    kb = types.InlineKeyboardMarkup()
+    kb.add(types.InlineKeyboardButton("❌ Cancel", callback_data="cancel_admin_redeem"))
+    smart_edit(chat_id, msg_id, "⌨️ *Step 1:* Enter Code Name (e.g. WELCOME50):", reply_markup=kb)
 
-    if action == "tok_short_list":
-        shorteners = SHORTNER_CONFIG.get("shorteners", [])
-        kb = types.InlineKeyboardMarkup(row_width=1)
-        for i in range(4):
-            # Check if this slot exists
-            if i < len(shorteners):
-                s = shorteners[i]
-                btn_txt = f"S{i+1}: {s['url'][:15]}... (Edit)"
-            else:
-                btn_txt = f"S{i+1}: Not Set (Add)"
-            kb.add(types.InlineKeyboardButton(btn_txt, callback_data=f"tok_edit_{i}"))
-        kb.add(types.InlineKeyboardButton("🔙 Back", callback_data="panel_token"))
-        
-        # Show list in caption
-        list_txt = "🔗 *Shorteners List:*\n\n"
-        for i in range(4):
-            if i < len(shorteners):
-                s = shorteners[i]
-                list_txt += f"{i+1}. `{s['url']}`\n   API: `{s['api'][:10]}...`\n"
-            else:
-                list_txt += f"{i+1}. Not Set\n"
-        
-        smart_edit(chat_id, msg_id, list_txt, reply_markup=kb)
+@callback_route("redeem_delete", admin=True)
+def cb_redeem_delete(call, action, uid, chat_id, msg_id):
+    user_states[uid] = {'state': 'waiting_redeem_del'}
+    kb = types.InlineKeyboardMarkup()
+    kb.add(types.InlineKeyboardButton("❌ Cancel", callback_data="cancel_admin_redeem"))
+    smart_edit(chat_id, msg_id, "🗑 Enter Code Name to Delete:", reply_markup=kb)
+
+@callback_route("cancel_admin_redeem", admin=True)
+def cb_cancel_admin_redeem(call, action, uid, chat_id, msg_id):
+    user_states.pop(uid, None)
+    # Go back to Redeem System menu
+    cb_panel_redeem(call, action, uid, chat_id, msg_id)
+
+@callback_route("redeem_list", admin=True)
+def cb_redeem_list(call, action, uid, chat_id, msg_id):
+    redeems = list(redeems_col.find())
+    if not redeems:
+        bot.answer_callback_query(call.id, "❌ No active codes!")
         return
 
-    if action.startswith("tok_edit_"):
-        idx = int(action.split("_")[-1])
-        kb = types.InlineKeyboardMarkup()
-        kb.add(types.InlineKeyboardButton("✏️ Set", callback_data=f"tok_set_{idx}"), 
-               types.InlineKeyboardButton("🗑 Delete", callback_data=f"tok_del_{idx}"))
-        kb.add(types.InlineKeyboardButton("🔙 Back", callback_data="tok_short_list"))
-        smart_edit(chat_id, msg_id, f"Manage Shortener Slot {idx+1}:", reply_markup=kb)
-        return
+    txt = "📜 *Active Redeem Codes:*\n\n"
+    for r in redeems:
+        exp = r['expiry'].strftime("%d-%b %I:%M %p")
+        txt += f"🔹 `{r['_id']}`\n   💰 {r.get('credits', 0)} Cr | 🎁 {r.get('bonus', 0)}%\n   ⌛ Exp: {exp}\n\n"
 
-    if action.startswith("tok_set_"):
-        idx = int(action.split("_")[-1])
-        user_states[uid] = {'state': 'waiting_tok_api_multi', 'idx': idx}
-        bot.send_message(uid, f"Send API Key for Slot {idx+1}:")
-        return
+    kb = types.InlineKeyboardMarkup()
+    kb.add(types.InlineKeyboardButton("🔙 Back", callback_data="panel_redeem"))
+    smart_edit(chat_id, msg_id, txt, reply_markup=kb)
 
-    if action.startswith("tok_del_"):
-        idx = int(action.split("_")[-1])
-        shorteners = SHORTNER_CONFIG.get("shorteners", [])
-        if idx < len(shorteners):
-            del shorteners[idx]
-            SHORTNER_CONFIG["shorteners"] = shorteners
-            save_setting("shortner", SHORTNER_CONFIG)
-            bot.send_message(uid, f"Shortener {idx+1} removed.")
-        return
-    
-    if action == "tok_time":
-        current = SHORTNER_CONFIG.get("validity", 12)
-        # Cycle 3 -> 6 -> 12 -> 24 -> 3
-        nxt = 6 if current == 3 else 12 if current == 6 else 24 if current == 12 else 3
-        SHORTNER_CONFIG["validity"] = nxt
-        save_setting("shortner", SHORTNER_CONFIG)
-        
-        status = "✅ On" if SHORTNER_CONFIG.get("active") else "❌ Off"
-        kb = types.InlineKeyboardMarkup(row_width=1)
-        kb.add(
-            types.InlineKeyboardButton("Manage Shorteners", callback_data="tok_short_list"),
-            types.InlineKeyboardButton(f"Verify Time ({nxt}h)", callback_data="tok_time"),
-            types.InlineKeyboardButton(f"Status ({status})", callback_data="tok_onoff"),
-            types.InlineKeyboardButton("Verify Tutorial", callback_data="tok_tut"),
-            types.InlineKeyboardButton("🔙 Back", callback_data="panel_settings")
-        )
-        smart_edit(chat_id, msg_id, "*🔐 Token Verification Settings*", reply_markup=kb)
-        return
+# BAN SYSTEM
+@callback_route("panel_ban", admin=True)
+def cb_panel_ban(call, action, uid, chat_id, msg_id):
+    kb = types.InlineKeyboardMarkup(row_width=2)
+    kb.add(types.InlineKeyboardButton("🚫 Ban User", callback_data="ban_add"),
+           types.InlineKeyboardButton("✅ Unban User", callback_data="ban_remove"))
+    kb.add(types.InlineKeyboardButton("🔙 Back", callback_data="panel_settings"))
+    banned_count = get_live_stats().get("banned", 0)
+    smart_edit(chat_id, msg_id, f"*🚫 User Ban System*\nBanned: {banned_count}", reply_markup=kb)
+
+@callback_route("ban_add", admin=True)
+def cb_ban_add(call, action, uid, chat_id, msg_id):
+    user_states[uid] = {'state': 'waiting_ban_id'}
+    bot.send_message(uid, "Send User ID to BAN:")
+
+@callback_route("ban_remove", admin=True)
+def cb_ban_remove(call, action, uid, chat_id, msg_id):
+    user_states[uid] = {'state': 'waiting_unban_id'}
+    bot.send_message(uid, "Send User ID to UNBAN:")
+
+# CREDIT SYSTEM
+@callback_route("panel_credits", admin=True)
+def cb_panel_credits(call, action, uid, chat_id, msg_id):
+    credit_val = CREDIT_CONFIG.get("value", 1.0)
+    kb = types.InlineKeyboardMarkup(row_width=1)
+    kb.add(
+        types.InlineKeyboardButton(f"💲 Set Credit Value (₹{credit_val})", callback_data="credit_set_val"),
+        types.InlineKeyboardButton("➕ Add Credit Manually", callback_data="credit_add_manual"),
+        types.InlineKeyboardButton("🔙 Back", callback_data="panel_settings")
+    )
+    smart_edit(chat_id, msg_id, "*💳 Credit System Configuration*", reply_markup=kb)
+
+@callback_route("credit_set_val", admin=True)
+def cb_credit_set_val(call, action, uid, chat_id, msg_id):
+    user_states[uid] = {'state': 'waiting_credit_val'}
+    kb = types.InlineKeyboardMarkup()
+    kb.add(types.InlineKeyboardButton("❌ Cancel", callback_data="cancel_admin_credit"))
+    smart_edit(chat_id, msg_id, "Send new value for 1 Credit (in ₹):", reply_markup=kb)
+
+@callback_route("credit_add_manual", admin=True)
+def cb_credit_add_manual(call, action, uid, chat_id, msg_id):
+    user_states[uid] = {'state': 'waiting_credit_user'}
+    kb = types.InlineKeyboardMarkup()
+    kb.add(types.InlineKeyboardButton("❌ Cancel", callback_data="cancel_admin_credit"))
+    smart_edit(chat_id, msg_id, "Send User ID to add credits:", reply_markup=kb)
+
+@callback_route("cancel_admin_credit", admin=True)
+def cb_cancel_admin_credit(call, action, uid, chat_id, msg_id):
+    user_states.pop(uid, None)
+    # Go back to Credit System menu
+    cb_panel_credits(call, action, uid, chat_id, msg_id)
+
+# TOKEN
+@callback_route("panel_token", admin=True)
+def cb_panel_token(call, action, uid, chat_id, msg_id):
+    status = "✅ On" if SHORTNER_CONFIG.get("active") else "❌ Off"
+    validity = SHORTNER_CONFIG.get("validity", 12)
+    kb = types.InlineKeyboardMarkup(row_width=1)
+    kb.add(
+        types.InlineKeyboardButton("Manage Shorteners", callback_data="tok_short_list"),
+        types.InlineKeyboardButton(f"Verify Time ({validity}h)", callback_data="tok_time"),
+        types.InlineKeyboardButton(f"Status ({status})", callback_data="tok_onoff"),
+        types.InlineKeyboardButton("Verify Tutorial", callback_data="tok_tut"),
+        types.InlineKeyboardButton("🔙 Back", callback_data="panel_settings")
+    )
+    smart_edit(chat_id, msg_id, "*🔐 Token Verification Settings*", reply_markup=kb)
+
+@callback_route("tok_short_list", admin=True)
+def cb_tok_short_list(call, action, uid, chat_id, msg_id):
+    shorteners = SHORTNER_CONFIG.get("shorteners", [])
+    kb = types.InlineKeyboardMarkup(row_width=1)
+    for i in range(4):
+        # Check if this slot exists
+        if i < len(shorteners):
+            s = shorteners[i]
+            btn_txt = f"S{i+1}: {s['url'][:15]}... (Edit)"
+        else:
+            btn_txt = f"S{i+1}: Not Set (Add)"
+        kb.add(types.InlineKeyboardButton(btn_txt, callback_data=f"tok_edit_{i}"))
+    kb.add(types.InlineKeyboardButton("🔙 Back", callback_data="panel_token"))
+
+    # Show list in caption
+    list_txt = "🔗 *Shorteners List:*\n\n"
+    for i in range(4):
+        if i < len(shorteners):
+            s = shorteners[i]
+            list_txt += f"{i+1}. `{s['url']}`\n   API: `{s['api'][:10]}...`\n"
+        else:
+            list_txt += f"{i+1}. Not Set\n"
+
+    smart_edit(chat_id, msg_id, list_txt, reply_markup=kb)
 
-    if action == "tok_onoff":
-        SHORTNER_CONFIG["active"] = not SHORTNER_CONFIG.get("active", False)
+@callback_route("tok_edit_", prefix=True, admin=True)
+def cb_tok_edit(call, action, uid, chat_id, msg_id):
+    idx = int(action.split("_")[-1])
+    kb = types.InlineKeyboardMarkup()
+    kb.add(types.InlineKeyboardButton("✏️ Set", callback_data=f"tok_set_{idx}"), 
+           types.InlineKeyboardButton("🗑 Delete", callback_data=f"tok_del_{idx}"))
+    kb.add(types.InlineKeyboardButton("🔙 Back", callback_data="tok_short_list"))
+    smart_edit(chat_id, msg_id, f"Manage Shortener Slot {idx+1}:", reply_markup=kb)
+
+@callback_route("tok_set_", prefix=True, admin=True)
+def cb_tok_set(call, action, uid, chat_id, msg_id):
+    idx = int(action.split("_")[-1])
+    user_states[uid] = {'state': 'waiting_tok_api_multi', 'idx': idx}
+    bot.send_message(uid, f"Send API Key for Slot {idx+1}:")
+
+@callback_route("tok_del_", prefix=True, admin=True)
+def cb_tok_del(call, action, uid, chat_id, msg_id):
+    idx = int(action.split("_")[-1])
+    shorteners = SHORTNER_CONFIG.get("shorteners", [])
+    if idx < len(shorteners):
+        del shorteners[idx]
+        SHORTNER_CONFIG["shorteners"] = shorteners
         save_setting("shortner", SHORTNER_CONFIG)
-        
-        status = "✅ On" if SHORTNER_CONFIG.get("active") else "❌ Off"
-        validity = SHORTNER_CONFIG.get("validity", 12)
-        kb = types.InlineKeyboardMarkup(row_width=1)
-        kb.add(
-            types.InlineKeyboardButton("Manage Shorteners", callback_data="tok_short_list"),
-            types.InlineKeyboardButton(f"Verify Time ({validity}h)", callback_data="tok_time"),
-            types.InlineKeyboardButton(f"Status ({status})", callback_data="tok_onoff"),
-            types.InlineKeyboardButton("Verify Tutorial", callback_data="tok_tut"),
-            types.InlineKeyboardButton("🔙 Back", callback_data="panel_settings")
-        )
-        smart_edit(chat_id, msg_id, "*🔐 Token Verification Settings*", reply_markup=kb)
+        reset_link_pool()
+        bot.send_message(uid, f"Shortener {idx+1} removed.")
+
+@callback_route("tok_time", admin=True)
+def cb_tok_time(call, action, uid, chat_id, msg_id):
+    current = SHORTNER_CONFIG.get("validity", 12)
+    # Cycle 3 -> 6 -> 12 -> 24 -> 3
+    nxt = 6 if current == 3 else 12 if current == 6 else 24 if current == 12 else 3
+    SHORTNER_CONFIG["validity"] = nxt
+    save_setting("shortner", SHORTNER_CONFIG)
+
+    status = "✅ On" if SHORTNER_CONFIG.get("active") else "❌ Off"
+    kb = types.InlineKeyboardMarkup(row_width=1)
+    kb.add(
+        types.InlineKeyboardButton("Manage Shorteners", callback_data="tok_short_list"),
+        types.InlineKeyboardButton(f"Verify Time ({nxt}h)", callback_data="tok_time"),
+        types.InlineKeyboardButton(f"Status ({status})", callback_data="tok_onoff"),
+        types.InlineKeyboardButton("Verify Tutorial", callback_data="tok_tut"),
+        types.InlineKeyboardButton("🔙 Back", callback_data="panel_settings")
+    )
+    smart_edit(chat_id, msg_id, "*🔐 Token Verification Settings*", reply_markup=kb)
+
+@callback_route("tok_onoff", admin=True)
+def cb_tok_onoff(call, action, uid, chat_id, msg_id):
+    SHORTNER_CONFIG["active"] = not SHORTNER_CONFIG.get("active", False)
+    save_setting("shortner", SHORTNER_CONFIG)
+    link_pool_wakeup.set()
+
+    status = "✅ On" if SHORTNER_CONFIG.get("active") else "❌ Off"
+    validity = SHORTNER_CONFIG.get("validity", 12)
+    kb = types.InlineKeyboardMarkup(row_width=1)
+    kb.add(
+        types.InlineKeyboardButton("Manage Shorteners", callback_data="tok_short_list"),
+        types.InlineKeyboardButton(f"Verify Time ({validity}h)", callback_data="tok_time"),
+        types.InlineKeyboardButton(f"Status ({status})", callback_data="tok_onoff"),
+        types.InlineKeyboardButton("Verify Tutorial", callback_data="tok_tut"),
+        types.InlineKeyboardButton("🔙 Back", callback_data="panel_settings")
+    )
+    smart_edit(chat_id, msg_id, "*🔐 Token Verification Settings*", reply_markup=kb)
+
+@callback_route("tok_tut", admin=True)
+def cb_tok_tut(call, action, uid, chat_id, msg_id):
+    user_states[uid] = {'state': 'waiting_tok_tut'}
+    kb = types.InlineKeyboardMarkup()
+    kb.add(types.InlineKeyboardButton("❌ Cancel", callback_data="panel_token"))
+    smart_edit(chat_id, msg_id, "Send Tutorial Link:", reply_markup=kb)
+
+# LOGS
+@callback_route("panel_logs", admin=True)
+def cb_panel_logs(call, action, uid, chat_id, msg_id):
+    d_status = "✅ Set" if LOG_CHANNELS["data"] else "❌ Not Set"
+    u_status = "✅ Set" if LOG_CHANNELS["user"] else "❌ Not Set"
+    kb = types.InlineKeyboardMarkup(row_width=1)
+    kb.add(
+        types.InlineKeyboardButton(f"📝 Set Data Log ({d_status})", callback_data="log_set_data"),
+        types.InlineKeyboardButton(f"👤 Set User Log ({u_status})", callback_data="log_set_user"),
+        types.InlineKeyboardButton("🔙 Back", callback_data="close_panel")
+    )
+    smart_edit(chat_id, msg_id, "*📝 Log Channels Settings*", reply_markup=kb)
+
+@callback_route("log_set_data", admin=True)
+def cb_log_set_data(call, action, uid, chat_id, msg_id):
+    user_states[uid] = {'state': 'waiting_log_data'}
+    bot.send_message(uid, "Forward message from Data Log Channel:")
+
+@callback_route("log_set_user", admin=True)
+def cb_log_set_user(call, action, uid, chat_id, msg_id):
+    user_states[uid] = {'state': 'waiting_log_user'}
+    bot.send_message(uid, "Forward message from User Log Channel:")
+
+# Reports
+@callback_route("panel_reports", admin=True)
+@callback_route("panel_reports|", prefix=True, admin=True)
+def cb_panel_reports(call, action, uid, chat_id, msg_id):
+    parts = action.split("|")
+    page = int(parts[1]) if len(parts) > 1 else 1
+    bot.answer_callback_query(call.id)
+    render_panel_reports(chat_id, msg_id, page)
+
+@callback_route("rep_page_list|", prefix=True, admin=True)
+def cb_rep_page_list(call, action, uid, chat_id, msg_id):
+    page = int(action.split("|")[1])
+    count = count_tickets()
+    total_pages = max(1, (count + REPORTS_PER_PAGE - 1) // REPORTS_PER_PAGE)
+
+    kb = types.InlineKeyboardMarkup()
+    row = []
+    for p in range(1, total_pages + 1):
+        row.append(types.InlineKeyboardButton(str(p), callback_data=f"panel_reports|{p}"))
+        if len(row) == 5:
+            kb.row(*row)
+            row = []
+    if row: kb.row(*row)
+    kb.add(types.InlineKeyboardButton("❌ Close", callback_data=f"panel_reports|{page}"))
+    smart_edit(chat_id, msg_id, f"📑 *Select a Page (Total: {total_pages})*", reply_markup=kb)
+
+@callback_route("view_rep|", prefix=True, admin=True)
+def cb_view_rep(call, action, uid, chat_id, msg_id):
+    parts = action.split("|")
+    tid = parts[1]
+    page = parts[2] if len(parts) > 2 else "1"
+
+    t = tickets_col.find_one({"_id": tid})
+    if not t:
+        bot.answer_callback_query(call.id, "❌ Report not found or already fixed.", show_alert=True)
+        render_panel_reports(chat_id, msg_id, int(page))
         return
 
-    if action == "tok_tut":
-        user_states[uid] = {'state': 'waiting_tok_tut'}
-        kb = types.InlineKeyboardMarkup()
-        kb.add(types.InlineKeyboardButton("❌ Cancel", callback_data="panel_token"))
-        smart_edit(chat_id, msg_id, "Send Tutorial Link:", reply_markup=kb)
-        return
+    kb = types.InlineKeyboardMarkup()
+    kb.add(
+        types.InlineKeyboardButton("✅ Fix", callback_data=f"fix|{tid}|{page}"),
+        types.InlineKeyboardButton("↩️ Reply", callback_data=f"reply|{tid}|{page}")
+    )
+    kb.add(types.InlineKeyboardButton("🔙 Back to Reports", callback_data=f"panel_reports|{page}"))
+
+    user_id = t.get('user_id', 'Unknown')
+    report_text = t.get('text', 'No Description Provided')
+
+    # --- THREADING LOGIC ---
+    thread_content = ""
+    thread = t.get('thread', [])
+    for m in thread:
+        role = "👤 User" if m['role'] == 'user' else "🤖 Admin"
+        thread_content += f"\n\n━━━━━━━━━━━━━━━\n*{role}:*\n{m['msg']}"
+
+    txt = (f"🆔 *Report ID:* `#{tid}`\n"
+           f"👤 *UserID:* `{user_id}`\n\n"
+           f"📝 *Original Message:* \n{report_text}"
+           f"{thread_content}")
+
+    # Smooth Transition: No more delete and resend
+    smart_edit_report(chat_id, msg_id, txt, photo=t.get('photo'), reply_markup=kb)
+
+# Broadcast
+@callback_route("panel_broadcast", admin=True)
+def cb_panel_broadcast(call, action, uid, chat_id, msg_id):
+    kb = types.InlineKeyboardMarkup(row_width=2)
+    kb.add(types.InlineKeyboardButton("All Users", callback_data="bc_all"), types.InlineKeyboardButton("P+ (Premium)", callback_data="bc_prem"), types.InlineKeyboardButton("🗑 Del 1h", callback_data="bc_del_1h"), types.InlineKeyboardButton("🗑 Del 12h", callback_data="bc_del_12h"), types.InlineKeyboardButton("🗑 Del All", callback_data="bc_del_all"), types.InlineKeyboardButton("🔙 Back", callback_data="close_panel"))
+    smart_edit(chat_id, msg_id, "*📢 Broadcast Menu*", reply_markup=kb)
+
+@callback_route("bc_all", admin=True)
+def cb_bc_all(call, action, uid, chat_id, msg_id):
+    user_states[uid] = {'state': 'broadcast_input', 'target': 'all'}
+    bot.send_message(uid, "📢 Send Msg for *ALL*:")
+
+@callback_route("bc_prem", admin=True)
+def cb_bc_prem(call, action, uid, chat_id, msg_id):
+    user_states[uid] = {'state': 'broadcast_input', 'target': 'prem'}
+    bot.send_message(uid, "📢 Send Msg for *P+*:")
+
+@callback_route("bc_del_", prefix=True, admin=True)
+def cb_bc_del(call, action, uid, chat_id, msg_id):
+    threading.Thread(target=perform_broadcast_delete, args=(uid, action)).start()
+    bot.answer_callback_query(call.id, "Deletion Started in Background.")
+
+@callback_route("bcj|", prefix=True, admin=True)
+def cb_bcj(call, action, uid, chat_id, msg_id):
+    _, op, bc_id = action.split("|")
+    control_broadcast(op, bc_id)
+
+# Settings
+@callback_route("panel_start_msg", admin=True)
+def cb_panel_start_msg(call, action, uid, chat_id, msg_id):
+    kb = types.InlineKeyboardMarkup()
+    kb.add(types.InlineKeyboardButton("📝 Text", callback_data="st_text_menu"), types.InlineKeyboardButton("🖼 Pic", callback_data="st_pic_menu"), types.InlineKeyboardButton("🔙 Back", callback_data="panel_settings"))
+    smart_edit(chat_id, msg_id, "Customize Start Message:", reply_markup=kb)
+
+@callback_route("st_text_menu", admin=True)
+def cb_st_text_menu(call, action, uid, chat_id, msg_id):
+    kb = types.InlineKeyboardMarkup()
+    kb.add(types.InlineKeyboardButton("✏️ Edit", callback_data="st_text_edit"), types.InlineKeyboardButton("👀 See", callback_data="st_text_see"), types.InlineKeyboardButton("🔙 Back", callback_data="panel_start_msg"))
+    smart_edit(chat_id, msg_id, "Manage Start Text:", reply_markup=kb)
 
-    # LOGS
-    if action == "panel_logs":
-        d_status = "✅ Set" if LOG_CHANNELS["data"] else "❌ Not Set"
-        u_status = "✅ Set" if LOG_CHANNELS["user"] else "❌ Not Set"
-        kb = types.InlineKeyboardMarkup(row_width=1)
-        kb.add(
-            types.InlineKeyboardButton(f"📝 Set Data Log ({d_status})", callback_data="log_set_data"),
-            types.InlineKeyboardButton(f"👤 Set User Log ({u_status})", callback_data="log_set_user"),
-            types.InlineKeyboardButton("🔙 Back", callback_data="close_panel")
-        )
-        smart_edit(chat_id, msg_id, "*📝 Log Channels Settings*", reply_markup=kb)
-    elif action == "log_set_data":
-        user_states[uid] = {'state': 'waiting_log_data'}
-        bot.send_message(uid, "Forward message from Data Log Channel:")
-    elif action == "log_set_user":
-        user_states[uid] = {'state': 'waiting_log_user'}
-        bot.send_message(uid, "Forward message from User Log Channel:")
-
-    # Reports
-    elif action.startswith("panel_reports"):
-        parts = action.split("|")
-        page = int(parts[1]) if len(parts) > 1 else 1
-        bot.answer_callback_query(call.id)
-        render_panel_reports(chat_id, msg_id, page)
-        return
+@callback_route("st_text_edit", admin=True)
+def cb_st_text_edit(call, action, uid, chat_id, msg_id):
+    user_states[uid] = {'state': 'waiting_start_text'}
+    kb = types.InlineKeyboardMarkup()
+    kb.add(types.InlineKeyboardButton("❌ Cancel", callback_data="panel_start_msg"))
+    bot.send_message(uid, "Send new text:", reply_markup=kb)
 
-    elif action.startswith("rep_page_list|"):
-        page = int(action.split("|")[1])
-        count = tickets_col.count_documents({})
-        total_pages = max(1, (count + 9) // 10)
+@callback_route("st_text_see", admin=True)
+def cb_st_text_see(call, action, uid, chat_id, msg_id):
+    bot.send_message(uid, f"Current:\n{START_CONFIG['text']}")
 
-        kb = types.InlineKeyboardMarkup()
-        row = []
-        for p in range(1, total_pages + 1):
-            row.append(types.InlineKeyboardButton(str(p), callback_data=f"panel_reports|{p}"))
-            if len(row) == 5:
-                kb.row(*row)
-                row = []
-        if row: kb.row(*row)
-        kb.add(types.InlineKeyboardButton("❌ Close", callback_data=f"panel_reports|{page}"))
-        smart_edit(chat_id, msg_id, f"📑 *Select a Page (Total: {total_pages})*", reply_markup=kb)
-        return
+@callback_route("st_pic_menu", admin=True)
+def cb_st_pic_menu(call, action, uid, chat_id, msg_id):
+    kb = types.InlineKeyboardMarkup()
+    kb.add(types.InlineKeyboardButton("🖼 Set", callback_data="st_pic_set"), types.InlineKeyboardButton("🗑 Delete", callback_data="st_pic_del"), types.InlineKeyboardButton("🔙 Back", callback_data="panel_start_msg"))
+    smart_edit(chat_id, msg_id, "Manage Start Picture:", reply_markup=kb)
 
-    elif action.startswith("view_rep|"):
-        parts = action.split("|")
-        tid = parts[1]
-        page = parts[2] if len(parts) > 2 else "1"
+@callback_route("st_pic_set", admin=True)
+def cb_st_pic_set(call, action, uid, chat_id, msg_id):
+    user_states[uid] = {'state': 'waiting_start_pic'}
+    kb = types.InlineKeyboardMarkup()
+    kb.add(types.InlineKeyboardButton("❌ Cancel", callback_data="panel_start_msg"))
+    bot.send_message(uid, "Send new photo:", reply_markup=kb)
 
-        t = tickets_col.find_one({"_id": tid})
-        if not t:
-            bot.answer_callback_query(call.id, "❌ Report not found or already fixed.", show_alert=True)
-            render_panel_reports(chat_id, msg_id, int(page))
-            return
+@callback_route("st_pic_del", admin=True)
+def cb_st_pic_del(call, action, uid, chat_id, msg_id):
+    START_CONFIG["pic"] = None
+    save_setting("start", START_CONFIG)
+    bot.send_message(uid, "Pic Deleted!")
 
-        kb = types.InlineKeyboardMarkup()
-        kb.add(
-            types.InlineKeyboardButton("✅ Fix", callback_data=f"fix|{tid}|{page}"),
-            types.InlineKeyboardButton("↩️ Reply", callback_data=f"reply|{tid}|{page}")
-        )
-        kb.add(types.InlineKeyboardButton("🔙 Back to Reports", callback_data=f"panel_reports|{page}"))
+@callback_route("panel_plans", admin=True)
+def cb_panel_plans(call, action, uid, chat_id, msg_id):
+    credit_val = CREDIT_CONFIG.get("value", 1.0)
+    kb = types.InlineKeyboardMarkup()
+    for p in PLANS: 
+        credits_display = round(PLANS[p] / credit_val, 2)
+        kb.add(types.InlineKeyboardButton(f"{p} - {credits_display} Credits", callback_data=f"ep|{p}"))
+    bot.send_message(uid, "Select Plan to Edit:", reply_markup=kb)
+
+@callback_route("panel_timer", admin=True)
+def cb_panel_timer(call, action, uid, chat_id, msg_id):
+    DELETE_CONFIG["minutes"] = 120 if DELETE_CONFIG["minutes"] == 30 else 30
+    save_setting("delete", DELETE_CONFIG)
+    t_str = "30 Minutes" if DELETE_CONFIG["minutes"] == 30 else "2 Hours"
+    kb = types.InlineKeyboardMarkup()
+    kb.add(types.InlineKeyboardButton("🔄 Change", callback_data="panel_timer"), types.InlineKeyboardButton("🔙 Back", callback_data="panel_settings"))
+    smart_edit(chat_id, msg_id, f"Auto Delete Time: *{t_str}*", reply_markup=kb)
+
+@callback_route("panel_stats", admin=True)
+def cb_panel_stats(call, action, uid, chat_id, msg_id):
+    stats = get_live_stats()
+    user_count, reports_count = stats.get("users", 0), stats.get("reports", 0)
+    banned_count, prem_count = stats.get("banned", 0), stats.get("premium", 0)
+    synced = stats["reconciled_at"].strftime("%I:%M %p")
+
+    msg = f"📊 *Bot Status*\n\n👥 Total Users: `{user_count}`\n📨 Reports: `{reports_count}`\n🚫 Banned: `{banned_count}`\n👑 Active Pro: `{prem_count}`\n\n🕒 Synced: `{synced}`"
+    bot.send_message(uid, msg)
+
+# Actions
+@callback_route("fix|", prefix=True, admin=True)
+def cb_fix(call, action, uid, chat_id, msg_id):
+    parts = action.split("|")
+    tid = parts[1]
+    page = int(parts[2]) if len(parts) > 2 else 1
+    t = tickets_col.find_one({"_id": tid})
+    if t:
+        # 1. Notify User
+        try: bot.send_message(t['user_id'], f"✅ *Issue Resolved (Report #{tid})*\nYour report has been marked as fixed by our team. Thank you!", parse_mode="Markdown")
+        except: pass
 
-        user_id = t.get('user_id', 'Unknown')
-        report_text = t.get('text', 'No Description Provided')
-        
-        # --- THREADING LOGIC ---
-        thread_content = ""
-        thread = t.get('thread', [])
-        for m in thread:
-            role = "👤 User" if m['role'] == 'user' else "🤖 Admin"
-            thread_content += f"\n\n━━━━━━━━━━━━━━━\n*{role}:*\n{m['msg']}"
-
-        txt = (f"🆔 *Report ID:* `#{tid}`\n"
-               f"👤 *UserID:* `{user_id}`\n\n"
-               f"📝 *Original Message:* \n{report_text}"
-               f"{thread_content}")
-
-        # Smooth Transition: No more delete and resend
-        smart_edit_report(chat_id, msg_id, txt, photo=t.get('photo'), reply_markup=kb)
-        return
+        # 2. Cleanup DB (No garbage left)
+        if tickets_col.delete_one({"_id": tid}).deleted_count: bump_stats(reports=-1)
+        invalidate_ticket_pages()
 
-    # Broadcast
-    elif action == "panel_broadcast":
-        kb = types.InlineKeyboardMarkup(row_width=2)
-        kb.add(types.InlineKeyboardButton("All Users", callback_data="bc_all"), types.InlineKeyboardButton("P+ (Premium)", callback_data="bc_prem"), types.InlineKeyboardButton("🗑 Del 1h", callback_data="bc_del_1h"), types.InlineKeyboardButton("🗑 Del 12h", callback_data="bc_del_12h"), types.InlineKeyboardButton("🗑 Del All", callback_data="bc_del_all"), types.InlineKeyboardButton("🔙 Back", callback_data="close_panel"))
-        smart_edit(chat_id, msg_id, "*📢 Broadcast Menu*", reply_markup=kb)
-    elif action == "bc_all":
-        user_states[uid] = {'state': 'broadcast_input', 'target': 'all'}
-        bot.send_message(uid, "📢 Send Msg for *ALL*:")
-    elif action == "bc_prem":
-        user_states[uid] = {'state': 'broadcast_input', 'target': 'prem'}
-        bot.send_message(uid, "📢 Send Msg for *P+*:")
-    elif action.startswith("bc_del_"):
-        threading.Thread(target=perform_broadcast_delete, args=(uid, action)).start()
-        bot.answer_callback_query(call.id, "Deletion Started in Background.")
-
-    # Settings
-    elif action == "panel_start_msg":
-        kb = types.InlineKeyboardMarkup()
-        kb.add(types.InlineKeyboardButton("📝 Text", callback_data="st_text_menu"), types.InlineKeyboardButton("🖼 Pic", callback_data="st_pic_menu"), types.InlineKeyboardButton("🔙 Back", callback_data="panel_settings"))
-        smart_edit(chat_id, msg_id, "Customize Start Message:", reply_markup=kb)
-    elif action == "st_text_menu":
-        kb = types.InlineKeyboardMarkup()
-        kb.add(types.InlineKeyboardButton("✏️ Edit", callback_data="st_text_edit"), types.InlineKeyboardButton("👀 See", callback_data="st_text_see"), types.InlineKeyboardButton("🔙 Back", callback_data="panel_start_msg"))
-        smart_edit(chat_id, msg_id, "Manage Start Text:", reply_markup=kb)
-    elif action == "st_text_edit":
-        user_states[uid] = {'state': 'waiting_start_text'}
-        kb = types.InlineKeyboardMarkup()
-        kb.add(types.InlineKeyboardButton("❌ Cancel", callback_data="panel_start_msg"))
-        bot.send_message(uid, "Send new text:", reply_markup=kb)
-    elif action == "st_text_see":
-        bot.send_message(uid, f"Current:\n{START_CONFIG['text']}")
-    elif action == "st_pic_menu":
-        kb = types.InlineKeyboardMarkup()
-        kb.add(types.InlineKeyboardButton("🖼 Set", callback_data="st_pic_set"), types.InlineKeyboardButton("🗑 Delete", callback_data="st_pic_del"), types.InlineKeyboardButton("🔙 Back", callback_data="panel_start_msg"))
-        smart_edit(chat_id, msg_id, "Manage Start Picture:", reply_markup=kb)
-    elif action == "st_pic_set":
-        user_states[uid] = {'state': 'waiting_start_pic'}
-        kb = types.InlineKeyboardMarkup()
-        kb.add(types.InlineKeyboardButton("❌ Cancel", callback_data="panel_start_msg"))
-        bot.send_message(uid, "Send new photo:", reply_markup=kb)
-    elif action == "st_pic_del":
-        START_CONFIG["pic"] = None
-        save_setting("start", START_CONFIG)
-        bot.send_message(uid, "Pic Deleted!")
-    elif action == "panel_force":
-        # Handled in new block
-        pass
-    elif action == "panel_plans":
-        credit_val = CREDIT_CONFIG.get("value", 1.0)
-        kb = types.InlineKeyboardMarkup()
-        for p in PLANS: 
-            credits_display = round(PLANS[p] / credit_val, 2)
-            kb.add(types.InlineKeyboardButton(f"{p} - {credits_display} Credits", callback_data=f"ep|{p}"))
-        bot.send_message(uid, "Select Plan to Edit:", reply_markup=kb)
-    elif action == "panel_timer":
-        DELETE_CONFIG["minutes"] = 120 if DELETE_CONFIG["minutes"] == 30 else 30
-        save_setting("delete", DELETE_CONFIG)
-        t_str = "30 Minutes" if DELETE_CONFIG["minutes"] == 30 else "2 Hours"
-        kb = types.InlineKeyboardMarkup()
-        kb.add(types.InlineKeyboardButton("🔄 Change", callback_data="panel_timer"), types.InlineKeyboardButton("🔙 Back", callback_data="panel_settings"))
-        smart_edit(chat_id, msg_id, f"Auto Delete Time: *{t_str}*", reply_markup=kb)
-    elif action == "panel_stats":
-        user_count = users_col.count_documents({})
-        reports_count = tickets_col.count_documents({})
-        banned_count = users_col.count_documents({"is_banned": True})
-        prem_count = users_col.count_documents({"premium_expiry": {"$gt": datetime.now()}})
-        
-        msg = f"📊 *Bot Status*\n\n👥 Total Users: `{user_count}`\n📨 Reports: `{reports_count}`\n🚫 Banned: `{banned_count}`\n👑 Active Pro: `{prem_count}`"
-        bot.send_message(uid, msg)
-
-    # Actions
-    if action.startswith("fix|"):
-        parts = action.split("|")
-        tid = parts[1]
-        page = int(parts[2]) if len(parts) > 2 else 1
-        t = tickets_col.find_one({"_id": tid})
-        if t:
-            # 1. Notify User
-            try: bot.send_message(t['user_id'], f"✅ *Issue Resolved (Report #{tid})*\nYour report has been marked as fixed by our team. Thank you!", parse_mode="Markdown")
-            except: pass
-            
-            # 2. Cleanup DB (No garbage left)
-            tickets_col.delete_one({"_id": tid})
-            
-        bot.answer_callback_query(call.id, "✅ Ticket Fixed & Cleaned from DB!")
-        render_panel_reports(chat_id, msg_id, page)
-        return
+    bot.answer_callback_query(call.id, "✅ Ticket Fixed & Cleaned from DB!")
+    render_panel_reports(chat_id, msg_id, page)
 
-    if action.startswith("reply|"):
-        parts = action.split("|")
-        tid = parts[1]
-        page = parts[2] if len(parts) > 2 else "1"
-        t = tickets_col.find_one({"_id": tid})
-        
-        if t:
-            user_states[ADMIN_ID] = {'state': 'reply_ticket', 'uid': t['user_id'], 'tid': tid, 'page': page, 'msg_id': msg_id, 'chat_id': chat_id, 'time': datetime.now()}
-            kb = types.InlineKeyboardMarkup()
-            kb.add(types.InlineKeyboardButton("❌ Cancel Reply", callback_data=f"cancel_reply_ticket|{tid}|{page}"))
-            smart_edit(chat_id, msg_id, f"✍️ *Reply to Report #{tid}:*\nType your message below (Auto-cancels in 3 mins):", reply_markup=kb)
-        return
+@callback_route("reply|", prefix=True, admin=True)
+def cb_reply(call, action, uid, chat_id, msg_id):
+    parts = action.split("|")
+    tid = parts[1]
+    page = parts[2] if len(parts) > 2 else "1"
+    t = tickets_col.find_one({"_id": tid})
 
-    # User Reply to Admin
-    if action.startswith("usr_reply|"):
-        tid = action.split("|")[1]
-        # Store original message content to restore it on cancel
-        orig_text = call.message.text or call.message.caption or f"📩 *Admin Response (Report #{tid})*"
-        
-        user_states[uid] = {
-            'state': 'waiting_user_reply', 
-            'tid': tid, 
-            'msg_id': msg_id, 
-            'chat_id': chat_id, 
-            'time': datetime.now(),
-            'orig_text': orig_text
-        }
+    if t:
+        user_states[ADMIN_ID] = {'state': 'reply_ticket', 'uid': t['user_id'], 'tid': tid, 'page': page, 'msg_id': msg_id, 'chat_id': chat_id}
         kb = types.InlineKeyboardMarkup()
-        kb.add(types.InlineKeyboardButton("❌ Cancel Reply", callback_data=f"cancel_user_reply_ticket|{tid}"))
-        smart_edit(chat_id, msg_id, "✍️ *Type your reply to Admin:*\n(Auto-cancels in 3 mins)", reply_markup=kb)
-        return
+        kb.add(types.InlineKeyboardButton("❌ Cancel Reply", callback_data=f"cancel_reply_ticket|{tid}|{page}"))
+        smart_edit(chat_id, msg_id, f"✍️ *Reply to Report #{tid}:*\nType your message below (Auto-cancels in 3 mins):", reply_markup=kb)
+
+# User Reply to Admin
+@callback_route("usr_reply|", prefix=True)
+def cb_usr_reply(call, action, uid, chat_id, msg_id):
+    tid = action.split("|")[1]
+    # Store original message content to restore it on cancel
+    orig_text = call.message.text or call.message.caption or f"📩 *Admin Response (Report #{tid})*"
+
+    user_states[uid] = {
+        'state': 'waiting_user_reply', 
+        'tid': tid, 
+        'msg_id': msg_id, 
+        'chat_id': chat_id, 
+        'orig_text': orig_text
+    }
+    kb = types.InlineKeyboardMarkup()
+    kb.add(types.InlineKeyboardButton("❌ Cancel Reply", callback_data=f"cancel_user_reply_ticket|{tid}"))
+    smart_edit(chat_id, msg_id, "✍️ *Type your reply to Admin:*\n(Auto-cancels in 3 mins)", reply_markup=kb)
+
+@callback_route("cancel_reply_ticket|", prefix=True, admin=True)
+def cb_cancel_reply_ticket(call, action, uid, chat_id, msg_id):
+    bot.answer_callback_query(call.id, "❌ Reply Cancelled", show_alert=False)
+    parts = action.split("|")
+    tid = parts[1]
+    page = parts[2] if len(parts) > 2 else "1"
+
+    if uid in user_states: del user_states[uid]
+    # view_rep handler se hi wapas ticket view render karo
+    cb_view_rep(call, f"view_rep|{tid}|{page}", uid, chat_id, msg_id)
+
+@callback_route("cancel_user_reply_ticket|", prefix=True)
+def cb_cancel_user_reply_ticket(call, action, uid, chat_id, msg_id):
+    bot.answer_callback_query(call.id, "❌ Reply Cancelled", show_alert=False)
+    tid = action.split("|")[1]
+
+    # Restore original menu and stop waiting
+    state = user_states.get(uid)
+    orig_text = state.get('orig_text') if state else f"📩 *Admin Response (Report #{tid})*"
 
-    if action.startswith("cancel_reply_ticket|"):
-        bot.answer_callback_query(call.id, "❌ Reply Cancelled", show_alert=False)
-        parts = action.split("|")
-        tid = parts[1]
-        page = parts[2] if len(parts) > 2 else "1"
-        
-        if uid in user_states: del user_states[uid]
-        # Fake callback to restore view_rep perfectly via smooth logic 
-        call.data = f"view_rep|{tid}|{page}"
-        router_callback(call)
-        return
-        
-    if action.startswith("cancel_user_reply_ticket|"):
-        bot.answer_callback_query(call.id, "❌ Reply Cancelled", show_alert=False)
-        tid = action.split("|")[1]
-        
-        # Restore original menu and stop waiting
-        state = user_states.get(uid)
-        orig_text = state.get('orig_text') if state else f"📩 *Admin Response (Report #{tid})*"
-        
-        if uid in user_states: del user_states[uid]
-        
-        kb = types.InlineKeyboardMarkup()
-        kb.add(types.InlineKeyboardButton("↩️ Reply to Admin", callback_data=f"usr_reply|{tid}"))
-        smart_edit(chat_id, msg_id, orig_text, reply_markup=kb)
-        return
+    if uid in user_states: del user_states[uid]
+
+    kb = types.InlineKeyboardMarkup()
+    kb.add(types.InlineKeyboardButton("↩️ Reply to Admin", callback_data=f"usr_reply|{tid}"))
+    smart_edit(chat_id, msg_id, orig_text, reply_markup=kb)
+
+
+# ---------------- BATCH DRAFTS ----------------
+# Upload ke dauran files Mongo draft mein jaati hain (state/RAM mein nahi), Done pe batch ban jata hai
+DRAFT_TTL = 86400  # batch_drafts updated_at TTL index ke barabar
+
+def start_batch_draft(uid, batch_type, owner_id, price=0):
+    draft_id = f"{uid}_{int(time.time() * 1000)}"
+    batch_drafts_col.insert_one({
+        '_id': draft_id,
+        'type': batch_type,
+        'price': price,
+        'owner_id': owner_id,
+        'files': [],
+        'count': 0,
+        'updated_at': datetime.now()
+    })
+    user_states[uid] = {'state': 'batch_collect', 'draft_id': draft_id}
+    return draft_id
+
+def add_draft_file(draft_id, item):
+    # Naya file count return karta hai (None = draft expire/delete ho chuka)
+    doc = batch_drafts_col.find_one_and_update(
+        {"_id": draft_id},
+        {"$push": {"files": item}, "$inc": {"count": 1}, "$set": {"updated_at": datetime.now()}},
+        projection={"count": 1},
+        return_document=pymongo.ReturnDocument.AFTER
+    )
+    return doc['count'] if doc else None
+
+def promote_batch_draft(draft, code):
+    # Server-side: draft files -> batch_chunks pages (files app mein load nahi hoti)
+    batch_drafts_col.aggregate([
+        {"$match": {"_id": draft['_id']}},
+        {"$unwind": {"path": "$files", "includeArrayIndex": "i"}},
+        {"$sort": {"i": 1}},
+        {"$group": {"_id": {"$toInt": {"$floor": {"$divide": ["$i", BATCH_CHUNK_SIZE]}}}, "files": {"$push": "$files"}}},
+        {"$project": {"_id": {"$concat": [code, ":", {"$toString": "$_id"}]}, "batch": {"$literal": code}, "n": "$_id", "files": 1}},
+        {"$merge": {"into": batch_chunks_col.name, "whenMatched": "replace", "whenNotMatched": "insert"}}
+    ])
+    # Header insert hi commit point hai: iske baad hi link valid hota hai
+    batches_col.insert_one({
+        '_id': code,
+        'type': draft.get('type', 'normal'),
+        'price': draft.get('price', 0),
+        'owner_id': draft.get('owner_id'),
+        'format': BATCH_FORMAT,
+        'file_count': draft['count'],
+        'chunks': -(-draft['count'] // BATCH_CHUNK_SIZE),
+        'created_at': datetime.now()
+    })
+    batch_drafts_col.delete_one({"_id": draft['_id']})
+
+def discard_batch_draft(state):
+    if isinstance(state, dict) and state.get('draft_id'):
+        batch_drafts_col.delete_one({"_id": state['draft_id']})
+
+# ---------------- BATCH UPLOAD STATUS ----------------
+# Har file pe naya "Added (N)" message bhejne ki jagah ek hi status message, max har X sec mein edit
+BATCH_STATUS_SECS = float(os.getenv("BATCH_STATUS_SECS", "3"))
+batch_status = {}  # uid -> {'at', 'timer', 'lock', 'chat_id', 'msg_id', 'count'}
+batch_status_lock = threading.Lock()
+
+def batch_status_text(count):
+    return f"✅ Added ({count}) files."
+
+def begin_batch_status(uid, chat_id, count):
+    msg = bot.send_message(chat_id, batch_status_text(count), reply_markup=done_kb())
+    with batch_status_lock:
+        batch_status[uid] = {'at': time.time(), 'timer': None, 'lock': threading.Lock(), 'chat_id': chat_id, 'msg_id': msg.message_id, 'count': count}
+    return msg.message_id
+
+def push_batch_status(uid, chat_id, msg_id, count):
+    with batch_status_lock:
+        st = batch_status.setdefault(uid, {'at': 0, 'timer': None, 'lock': threading.Lock()})
+        st.update(chat_id=chat_id, msg_id=msg_id, count=count)
+        wait = st['at'] + BATCH_STATUS_SECS - time.time()
+        if wait > 0 or st['timer']:
+            # Window ke andar: trailing flush latest count dikhayega
+            if not st['timer']: st['timer'] = run_later(max(wait, 0), flush_batch_status, uid)
+            return
+        st['at'] = time.time()
+    edit_batch_status(st)
+
+def flush_batch_status(uid):
+    with batch_status_lock:
+        st = batch_status.get(uid)
+        if not st: return
+        st['timer'] = None
+        st['at'] = time.time()
+    edit_batch_status(st)
+
+def edit_batch_status(st):
+    # Edit ke waqt ka latest count padho, purana count naye ke baad na likha jaye
+    with st['lock']:
+        try: bot.edit_message_text(batch_status_text(st['count']), st['chat_id'], st['msg_id'], reply_markup=done_kb())
+        except Exception: pass
+
+def clear_batch_status(uid):
+    with batch_status_lock: st = batch_status.pop(uid, None)
+    if not st: return
+    if st['timer']: st['timer'].cancel()
+    with st['lock']: pass # Chal raha edit khatam hone do
 
 # ---------------- INPUT HANDLERS ----------------
+# State name -> (handler, admin_only). Timeout wale states store mein usi TTL se save hote hain
+input_handlers = {}
+
+def input_state(*names, timeout=None, admin=False):
+    def register(func):
+        for name in names:
+            input_handlers[name] = (func, admin)
+            if timeout: input_timeouts[name] = timeout
+        return func
+    return register
+
 @bot.message_handler(content_types=['text', 'photo', 'video', 'document', 'audio', 'animation', 'voice'])
 def handle_inputs(message):
     uid = message.from_user.id
     if is_banned(uid): return
 
+    # 1. Conversation state: ek lookup (expired states store khud drop karta hai)
     state = user_states.get(uid)
-    
-    # 3-Minute Timeout Auto-Cancel (No Response)
-    if isinstance(state, dict) and state.get('state') in ['waiting_user_reply', 'reply_ticket']:
-        if 'time' in state and (datetime.now() - state['time']).total_seconds() > 180:
-            del user_states[uid]
-            state = None # Let it process as a normal message
-
-    # 1. USER REPLY TO ADMIN (Button Triggered)
-    if isinstance(state, dict) and state.get('state') == 'waiting_user_reply':
-        tid = state['tid']
-        content_summary = message.text or "[Media]"
-        
-        # Save to Thread in DB
-        tickets_col.update_one({"_id": tid}, {"$push": {"thread": {"role": "user", "msg": content_summary, "time": datetime.now()}}})
-
-        # Calculate Page Number for Admin Notification
-        all_tickets = list(tickets_col.find().sort("created_at", -1))
-        ticket_index = next((i for i, t in enumerate(all_tickets) if t['_id'] == tid), 0)
-        page_num = (ticket_index // 10) + 1
-
-        # Notify Admin concisely
-        kb = types.InlineKeyboardMarkup()
-        kb.add(types.InlineKeyboardButton("👁 View Report", callback_data=f"view_rep|{tid}|{page_num}"))
-        bot.send_message(ADMIN_ID, f"📩 *New Reply for Report #{tid}*\nLocated on Page: {page_num}", reply_markup=kb)
-        
-        # Smooth edit: Success message for user
-        success_msg = f"✔️ *Reply successfully sent to Admin for Report #{tid}*"
-        smart_edit(state['chat_id'], state['msg_id'], success_msg, reply_markup=None)
-        
-        del user_states[uid]
+    if state:
+        route = input_handlers.get(state.get('state') if isinstance(state, dict) else state)
+        if route and (not route[1] or uid == ADMIN_ID): route[0](message, uid, state)
         return
 
     # 2. SUPPORT REQUEST (Initial Ticket)
     if uid in user_support_state:
-        # --- USERNAME CHECK ---
-        username = message.from_user.username
-        if not username:
-            bot.send_message(uid, "🚫 *Access Denied*\n\nReport bhejne ke liye aapka *Telegram Username* set hona zaroori hai.\n\nSettings mein jaakar ek username banayein aur phir try karein.")
-            del user_support_state[uid]
-            return
+        handle_support_request(message, uid)
+        return
 
-        del user_support_state[uid]
-        
-        # --- RATE LIMIT CHECK (3 reports per 24h) ---
-        u = users_col.find_one({"_id": uid})
-        today_str = datetime.now().strftime("%Y-%m-%d")
-        sr = u.get("support_reports", {"date": None, "count": 0})
-        
-        if sr["date"] == today_str:
-            if sr["count"] >= 3:
-                bot.send_message(uid, "🚫 *Daily Limit Reached*\n\nYou have already sent 3 reports today.")
-                return
-            new_count = sr["count"] + 1
-        else:
-            new_count = 1
-            
-        users_col.update_one({"_id": uid}, {"$set": {"support_reports": {"date": today_str, "count": new_count}}})
+    # 3. Process pending payments email (Strict Logic: Only if PENDING)
+    session = active_user_code.get(uid)
+    if not session: return
+    # CHECK: Sirf tab andar jao jab 'PENDING' state ho (VIEWING ho to ignore karo)
+    if "PENDING" in session and message.text:
+        handle_payment_email(message, uid)
+    # 4. PROOF UPLOAD (Only for Pro users selling to other users now)
+    elif message.photo:
+        handle_payment_proof(message, uid, session)
 
-        # --- PERSISTENT ALL-TIME COUNTER ---
-        stats = settings_col.find_one_and_update(
-            {"_id": "report_stats"},
-            {"$inc": {"total_ever": 1}},
-            upsert=True,
-            return_document=pymongo.ReturnDocument.AFTER
-        )
-        total_ever = stats.get("total_ever", 1)
+# USER REPLY TO ADMIN (Button Triggered)
+@input_state('waiting_user_reply', timeout=180)
+def input_user_reply(message, uid, state):
+    tid = state['tid']
+    content_summary = message.text or "[Media]"
 
-        # --- GENERATE READABLE TID ---
-        # Sanitize username (Remove symbols like _, keep first 10 chars)
-        clean_name = re.sub(r'[^a-zA-Z0-9]', '', username)[:10].lower()
-        tid = f"{clean_name}{total_ever}"
-        
-        txt = message.caption or message.text or "No Text"
-        pid = message.photo[-1].file_id if message.photo else None
-        
-        now = datetime.now()
-        # Find next Sunday 23:59:59
-        days_ahead = 6 - now.weekday()
-        if days_ahead < 0: days_ahead += 7
-        next_sunday = now + timedelta(days=days_ahead)
-        expire_at = datetime.combine(next_sunday, datetime.max.time())
-        
-        # Save to DB
-        tickets_col.insert_one({
-            '_id': tid, 
-            'user_id': uid, 
-            'text': txt, 
-            'photo': pid, 
-            'status': 'open',
-            'thread': [],
-            'created_at': now,
-            'expire_at': expire_at
-        })
-        
-        # Notify Admin
-        bot.send_message(ADMIN_ID, f"⚠️ *New Report #{tid}* from @{username}\nCheck Admin Panel -> Reports", parse_mode="Markdown")
-        
-        # Confirm to User
-        bot.send_message(uid, f"✅ *Report #{tid} Submitted!*\n\nOur team will get back to you soon.", parse_mode="Markdown")
-        return
+    # Save to Thread in DB
+    tickets_col.update_one({"_id": tid}, {"$push": {"thread": {"role": "user", "msg": content_summary, "time": datetime.now()}}})
 
-     # Text Input Logic (Admin Link Update - Ye same rahega)
-    if user_states.get(uid) == "WAIT_PAYMENT_LINK" and uid == ADMIN_ID:
-        global PAYMENT_LINK
-        PAYMENT_LINK = message.text
-        save_setting("payment_link", message.text)
-        user_states[uid] = None
-        kb = types.InlineKeyboardMarkup()
-        kb.add(types.InlineKeyboardButton("🔙 Back", callback_data="panel_settings"))
-        bot.send_message(uid, f"✅ *Payment Link Updated:*\n`{message.text}`", reply_markup=kb)
-        return
+    # Calculate Page Number for Admin Notification
+    page_num = ticket_page_of(tid)
 
-            # Process pending payments email (Strict Logic: Only if PENDING)
-    session = active_user_code.get(uid)
-    text = message.text
-    
-    # CHECK: Sirf tab andar jao jab 'PENDING' state ho (VIEWING ho to ignore karo)
-    if session and "PENDING" in session and text:
-
-        # --- EMAIL VALIDATION ---
-        if "@" not in text or "." not in text or len(text) < 5:
-            # Error Message with Back Button
-            kb = types.InlineKeyboardMarkup()
-            kb.add(types.InlineKeyboardButton("🔙 Back / Cancel", callback_data="cancel_input_process"))
-            bot.send_message(message.chat.id, "⚠️ *Invalid Email!*\nPlease enter a valid email address (e.g. name@gmail.com).", reply_markup=kb)
-            return
+    # Notify Admin concisely
+    kb = types.InlineKeyboardMarkup()
+    kb.add(types.InlineKeyboardButton("👁 View Report", callback_data=f"view_rep|{tid}|{page_num}"))
+    bot.send_message(ADMIN_ID, f"📩 *New Reply for Report #{tid}*\nLocated on Page: {page_num}", reply_markup=kb)
+
+    # Smooth edit: Success message for user
+    success_msg = f"✔️ *Reply successfully sent to Admin for Report #{tid}*"
+    smart_edit(state['chat_id'], state['msg_id'], success_msg, reply_markup=None)
+
+    del user_states[uid]
+
+@input_state('batch_collect', timeout=DRAFT_TTL)
+def input_batch_collect(message, uid, state):
+    # Gen Link (Pro/Admin) - SMART ID COLLECTOR
+    ftype = 'text' if message.text else 'photo' if message.photo else 'video' if message.video else 'document' if message.document else 'audio'
+
+    # ID safe tarike se nikalo
+    fid = None
+    if message.text: fid = message.text
+    elif message.photo: fid = message.photo[-1].file_id
+    elif message.video: fid = message.video.file_id
+    elif message.document: fid = message.document.file_id
+    elif message.audio: fid = message.audio.file_id
+    elif message.voice: fid = message.voice.file_id
+    elif message.animation: fid = message.animation.file_id
+
+    if not fid: return # Agar sticker ya kuch aur hai to ignore karo
+
+    # 1. Draft mein add karo (state har file pe dobara nahi likhte)
+    count = add_draft_file(state['draft_id'], {'type': ftype, 'id': fid})
+    if count is None:
+        user_states.pop(uid, None)
+        clear_batch_status(uid)
+        bot.send_message(uid, "❌ Session Expired! Start again.")
+        return
 
-        # --- PAYMENT CHECK ---
-        email = text.strip().lower()
+    # 2. Pehli file pe ek status message, uske baad sirf debounced edit
+    if state.get('status_msg_id'):
+        push_batch_status(uid, message.chat.id, state['status_msg_id'], count)
+    else:
+        state['status_msg_id'] = begin_batch_status(uid, message.chat.id, count)
+        user_states[uid] = state
 
-        existing_payment = unclaimed_payments_col.find_one({"email": email})
+@input_state('waiting_price')
+def input_price(message, uid, state):
+    try:
+        # FIX: Use regex to extract first number found in string (handles "100rs", "price 50", etc)
+        nums = re.findall(r'\d+', message.text)
+        if not nums: raise ValueError
+        val_input = int(nums[0])
 
-        # Scenario A: Payment Pehle se aayi hui hai
-        if existing_payment:
-            paid_amount = float(existing_payment['amount'])
+        owner_id = state.get('owner', uid)
+        if owner_id == ADMIN_ID:
             credit_val = CREDIT_CONFIG.get("value", 1.0)
-            credits_added = paid_amount / credit_val
-            
-            add_credits(uid, credits_added)
-            
-            bot.send_message(uid, f"✅ *Payment Found!*\n₹{paid_amount} received. {credits_added} Credits added.", reply_markup=types.ReplyKeyboardRemove())
-            unclaimed_payments_col.delete_one({"_id": existing_payment['_id']})
-            del active_user_code[uid]
-            return
-        
-        # Scenario B: Payment abhi nahi aayi (Tracking Start)
+            price_rs = val_input * credit_val
+            start_batch_draft(uid, state.get('type'), owner_id, price_rs)
+            bot.send_message(uid, f"✅ Price: {val_input} Credits (₹{price_rs})\n*Send content now.*", reply_markup=done_kb())
         else:
-            pending_payments_col.insert_one({
-                "user_id": uid, "email": email, "type": "credit", 
-                "created_at": datetime.now()
-            })
-            
-            # Message sent WITHOUT Buttons (User confuse na ho)
-            bot.send_message(uid, f"✅ *Payment Tracking Started*\nEmail: `{email}`\nWaiting for confirmation...")
-            
-            # State Delete taaki user dobara 'Invalid Email' na face kare
-            del active_user_code[uid] 
-            return
- # 4. ADMIN INPUTS
-    if isinstance(state, dict) and uid == ADMIN_ID:
-        st = state['state']
-
-        if st == 'reply_ticket':
-            tid = state['tid']
-            page = int(state.get('page', 1))
-            t = tickets_col.find_one({"_id": tid})
-            
-            if t:
-                content_summary = message.text or "[Media]"
-                # Save to Thread in DB
-                tickets_col.update_one({"_id": tid}, {"$push": {"thread": {"role": "admin", "msg": content_summary, "time": datetime.now()}}})
-                
-                target_uid = t['user_id']
-                kb = types.InlineKeyboardMarkup()
-                kb.add(types.InlineKeyboardButton("↩️ Reply to Admin", callback_data=f"usr_reply|{tid}"))
-                reply_text = f"📩 *Admin Response (Report #{tid}):*\n\n{content_summary}"
-                bot.send_message(target_uid, reply_text, reply_markup=kb, parse_mode="Markdown")
-                if message.content_type != 'text': bot.copy_message(target_uid, uid, message.message_id, reply_markup=kb)
-
-            smart_edit(state['chat_id'], state['msg_id'], f"✅ *Reply Sent to User for Report #{tid}*", reply_markup=None)
-            time.sleep(1)
-            render_panel_reports(state['chat_id'], state['msg_id'], page)
-            del user_states[uid]
-            return
+            start_batch_draft(uid, state.get('type'), owner_id, val_input)
+            bot.send_message(uid, f"✅ Price: ₹{val_input}\n*Send content now.*", reply_markup=done_kb())
+    except: bot.send_message(uid, "Invalid Number. Send numbers only.")
+
+@input_state('waiting_upi')
+def input_upi(message, uid, state):
+    update_user_upi(uid, message.text)
+    bot.send_message(uid, "✅ UPI Set!")
+    del user_states[uid]
+
+@input_state('waiting_user_short_api')
+def input_user_short_api(message, uid, state):
+    state['api'] = message.text
+    state['state'] = 'waiting_user_short_url'
+    user_states[uid] = state
+    bot.send_message(uid, "✅ API Saved. Now Send Domain (e.g. mdiskshortner.link):")
+
+@input_state('waiting_user_short_url')
+def input_user_short_url(message, uid, state):
+    api = state['api']
+    url = message.text
+    update_user(uid, {"$set": {"personal_shortener": {"api": api, "url": url}}})
+    bot.send_message(uid, "✅ Personal Shortener Configured!")
+    del user_states[uid]
+
+# ADMIN INPUTS
+@input_state('WAIT_PAYMENT_LINK', admin=True)
+def input_payment_link(message, uid, state):
+    global PAYMENT_LINK
+    PAYMENT_LINK = message.text
+    save_setting("payment_link", message.text)
+    user_states[uid] = None
+    kb = types.InlineKeyboardMarkup()
+    kb.add(types.InlineKeyboardButton("🔙 Back", callback_data="panel_settings"))
+    bot.send_message(uid, f"✅ *Payment Link Updated:*\n`{message.text}`", reply_markup=kb)
 
-        if st == 'broadcast_input':
-            target = state.get('target')
+@input_state('reply_ticket', timeout=180, admin=True)
+def input_reply_ticket(message, uid, state):
+    tid = state['tid']
+    page = int(state.get('page', 1))
+    t = tickets_col.find_one({"_id": tid})
 
-            # Count users
-            total_users = users_col.count_documents({})
-            if target == 'prem':
-                users = users_col.find({"premium_expiry": {"$gt": datetime.now()}})
-            else:
-                users = users_col.find({})
+    if t:
+        content_summary = message.text or "[Media]"
+        # Save to Thread in DB
+        tickets_col.update_one({"_id": tid}, {"$push": {"thread": {"role": "admin", "msg": content_summary, "time": datetime.now()}}})
 
-            sent_msg = bot.send_message(ADMIN_ID, f"🚀 Broadcasting to ~{total_users} users...")
-            count = 0
+        target_uid = t['user_id']
+        kb = types.InlineKeyboardMarkup()
+        kb.add(types.InlineKeyboardButton("↩️ Reply to Admin", callback_data=f"usr_reply|{tid}"))
+        reply_text = f"📩 *Admin Response (Report #{tid}):*\n\n{content_summary}"
+        bot.send_message(target_uid, reply_text, reply_markup=kb, parse_mode="Markdown")
+        if message.content_type != 'text': bot.copy_message(target_uid, uid, message.message_id, reply_markup=kb)
+
+    smart_edit(state['chat_id'], state['msg_id'], f"✅ *Reply Sent to User for Report #{tid}*", reply_markup=None)
+    run_later(1, render_panel_reports, state['chat_id'], state['msg_id'], page)
+    del user_states[uid]
+
+@input_state('broadcast_input', admin=True)
+def input_broadcast(message, uid, state):
+    # Background job chalega, admin handler turant free
+    start_broadcast(ADMIN_ID, state.get('target'), message)
+    del user_states[uid]
+
+@input_state('waiting_fj_forward', admin=True)
+def input_fj_forward(message, uid, state):
+    if message.forward_from_chat:
+        new_ch = {'id': message.forward_from_chat.id, 'title': message.forward_from_chat.title, 'username': message.forward_from_chat.username}
+        cl = CHANNEL_CONFIG.get("channels", [])
+        cl.append(new_ch)
+        CHANNEL_CONFIG["channels"] = cl
+        save_setting("channel", CHANNEL_CONFIG)
+        bot.send_message(uid, f"✅ Added: {new_ch['title']}")
+    else:
+        bot.send_message(uid, "❌ Forward from a channel please.")
+    del user_states[uid]
+
+@input_state('waiting_custom_btn', admin=True)
+def input_custom_btn(message, uid, state):
+    CUSTOM_BTN_CONFIG["text"] = message.text
+    save_setting("custom_btn", CUSTOM_BTN_CONFIG)
+    bot.send_message(uid, "✅ Button Set.")
+    del user_states[uid]
+
+@input_state('waiting_ban_id', admin=True)
+def input_ban_id(message, uid, state):
+    try: set_banned(int(message.text), True); bot.send_message(uid, "Banned.")
+    except: pass
+    del user_states[uid]
 
-            for u in users:
-                try:
-                    m = None
-                    if message.content_type == 'text': m = bot.send_message(u["_id"], message.text)
-                    elif message.content_type == 'photo': m = bot.send_photo(u["_id"], message.photo[-1].file_id, caption=message.caption)
-                    elif message.content_type == 'video': m = bot.send_video(u["_id"], message.video.file_id, caption=message.caption)
-                    elif message.content_type == 'document': m = bot.send_document(u["_id"], message.document.file_id, caption=message.caption)
-
-                    if m: last_broadcast_ids.append((u["_id"], m.message_id, datetime.now()))
-                    count += 1
-                    time.sleep(0.04) # Rate limit
-                except: pass
+@input_state('waiting_unban_id', admin=True)
+def input_unban_id(message, uid, state):
+    try: set_banned(int(message.text), False); bot.send_message(uid, "Unbanned.")
+    except: pass
+    del user_states[uid]
 
-            bot.edit_message_text(f"✅ Broadcast Complete: {count} users.", ADMIN_ID, sent_msg.message_id)
-            del user_states[uid]
+@input_state('waiting_log_data', 'waiting_log_user', admin=True)
+def input_log_channel(message, uid, state):
+    try:
+        cid = message.forward_from_chat.id if message.forward_from_chat else int(message.text)
+        key = 'data' if state['state'] == 'waiting_log_data' else 'user'
+        LOG_CHANNELS[key] = cid
+        save_setting("logs", LOG_CHANNELS)
+        bot.send_message(uid, f"✅ Log Channel Set: `{cid}`")
+    except: pass
+    del user_states[uid]
+
+@input_state('waiting_tok_api_multi', admin=True)
+def input_tok_api(message, uid, state):
+    idx = state['idx']
+    # Temp save in state
+    state['api'] = message.text
+    state['state'] = 'waiting_tok_url_multi'
+    user_states[uid] = state
+    bot.send_message(uid, f"✅ API Saved for Slot {idx+1}. Now Send Domain (e.g. mdiskshortner.link):")
+
+@input_state('waiting_tok_url_multi', admin=True)
+def input_tok_url(message, uid, state):
+    idx = state['idx']
+    api = state['api']
+    url = message.text
+
+    shorteners = SHORTNER_CONFIG.get("shorteners", [])
+    # If index is beyond current list, append. Otherwise update.
+    new_s = {"api": api, "url": url}
+    if idx < len(shorteners):
+        shorteners[idx] = new_s
+    else:
+        # Add placeholders if needed
+        while len(shorteners) < idx:
+            shorteners.append({"api": None, "url": None})
+        shorteners.append(new_s)
+
+    SHORTNER_CONFIG["shorteners"] = shorteners
+    save_setting("shortner", SHORTNER_CONFIG)
+    reset_link_pool()
+    bot.send_message(uid, f"✅ Shortener Slot {idx+1} Configured!")
+    del user_states[uid]
+
+@input_state('waiting_tok_tut', admin=True)
+def input_tok_tut(message, uid, state):
+    SHORTNER_CONFIG["tutorial"] = message.text
+    save_setting("shortner", SHORTNER_CONFIG)
+    bot.send_message(uid, "✅ Tutorial Set!")
+    del user_states[uid]
+
+@input_state('waiting_start_text', admin=True)
+def input_start_text(message, uid, state):
+    START_CONFIG["text"] = message.text; save_setting("start", START_CONFIG); bot.send_message(uid, "Updated."); del user_states[uid]
+
+@input_state('waiting_start_pic', admin=True)
+def input_start_pic(message, uid, state):
+    if message.photo: START_CONFIG["pic"] = message.photo[-1].file_id; save_setting("start", START_CONFIG); bot.send_message(uid, "Updated.")
+    del user_states[uid]
+
+@input_state('edit_plan_price', admin=True)
+def input_plan_price(message, uid, state):
+    try: 
+        credit_val = CREDIT_CONFIG.get("value", 1.0)
+        price_rs = float(message.text) * credit_val
+        PLANS[state['plan']] = price_rs
+        save_setting("plans", PLANS)
+        bot.send_message(uid, f"✅ Updated to {message.text} Credits (₹{price_rs}).")
+    except: bot.send_message(uid, "Invalid Number.")
+    del user_states[uid]
+
+@input_state('waiting_credit_val', admin=True)
+def input_credit_val(message, uid, state):
+    try:
+        val = float(message.text)
+        if val <= 0:
+            bot.send_message(uid, "❌ *Error:* Credit value must be greater than 0.")
             return
+        CREDIT_CONFIG["value"] = val
+        save_setting("credit", CREDIT_CONFIG)
+        bot.send_message(uid, f"✅ 1 Credit = ₹{val} Set.")
+    except: bot.send_message(uid, "Invalid Number.")
+    del user_states[uid]
+
+@input_state('waiting_credit_user', admin=True)
+def input_credit_user(message, uid, state):
+    try:
+        target_uid = int(message.text)
+        user_states[uid] = {'state': 'waiting_credit_amount', 'target': target_uid}
+        bot.send_message(uid, "Send amount of Credits to add:")
+    except: 
+        bot.send_message(uid, "Invalid User ID.")
+        del user_states[uid]
 
-        if st == 'waiting_fj_forward':
-            if message.forward_from_chat:
-                new_ch = {'id': message.forward_from_chat.id, 'title': message.forward_from_chat.title, 'username': message.forward_from_chat.username}
-                cl = CHANNEL_CONFIG.get("channels", [])
-                cl.append(new_ch)
-                CHANNEL_CONFIG["channels"] = cl
-                save_setting("channel", CHANNEL_CONFIG)
-                bot.send_message(uid, f"✅ Added: {new_ch['title']}")
-            else:
-                bot.send_message(uid, "❌ Forward from a channel please.")
-            del user_states[uid]
-            return
+@input_state('waiting_credit_amount', admin=True)
+def input_credit_amount(message, uid, state):
+    try:
+        credit_val = CREDIT_CONFIG.get("value", 1.0)
+        amt_credits = float(message.text)
+        amt_rs = amt_credits * credit_val
+        add_credits(state['target'], amt_rs, "admin")
+        bot.send_message(uid, f"✅ Added {amt_credits} Credits (₹{amt_rs}) to User {state['target']}.")
+        try: bot.send_message(state['target'], f"🎁 Admin added {amt_credits} Credits to your wallet!")
+        except: pass
+    except: bot.send_message(uid, "Invalid Amount.")
+    del user_states[uid]
 
-        if st == 'waiting_custom_btn':
-            CUSTOM_BTN_CONFIG["text"] = message.text
-            save_setting("custom_btn", CUSTOM_BTN_CONFIG)
-            bot.send_message(uid, "✅ Button Set.")
-            del user_states[uid]
-            return
+@input_state('waiting_redeem_name', admin=True)
+def input_redeem_name(message, uid, state):
+    code = message.text.strip().upper()
+    try: bot.delete_message(uid, message.message_id) # Cleanup admin text
+    except: pass
 
-        if st == 'waiting_ban_id':
-            try: users_col.update_one({"_id": int(message.text)}, {"$set": {"is_banned": True}}); bot.send_message(uid, "Banned.")
-            except: pass
-            del user_states[uid]; return
-        if st == 'waiting_unban_id':
-            try: users_col.update_one({"_id": int(message.text)}, {"$set": {"is_banned": False}}); bot.send_message(uid, "Unbanned.")
-            except: pass
-            del user_states[uid]; return
-        if st in ['waiting_log_data', 'waiting_log_user']:
-            try:
-                cid = message.forward_from_chat.id if message.forward_from_chat else int(message.text)
-                key = 'data' if st == 'waiting_log_data' else 'user'
-                LOG_CHANNELS[key] = cid
-                save_setting("logs", LOG_CHANNELS)
-                bot.send_message(uid, f"✅ Log Channel Set: `{cid}`")
-            except: pass
-            del user_states[uid]; return
-        if st == 'waiting_tok_api_multi':
-            idx = state['idx']
-            # Temp save in state
-            state['api'] = message.text
-            state['state'] = 'waiting_tok_url_multi'
-            bot.send_message(uid, f"✅ API Saved for Slot {idx+1}. Now Send Domain (e.g. mdiskshortner.link):")
-            return
-        if st == 'waiting_tok_url_multi':
-            idx = state['idx']
-            api = state['api']
-            url = message.text
-            
-            shorteners = SHORTNER_CONFIG.get("shorteners", [])
-            # If index is beyond current list, append. Otherwise update.
-            new_s = {"api": api, "url": url}
-            if idx < len(shorteners):
-                shorteners[idx] = new_s
-            else:
-                # Add placeholders if needed
-                while len(shorteners) < idx:
-                    shorteners.append({"api": None, "url": None})
-                shorteners.append(new_s)
-            
-            SHORTNER_CONFIG["shorteners"] = shorteners
-            save_setting("shortner", SHORTNER_CONFIG)
-            bot.send_message(uid, f"✅ Shortener Slot {idx+1} Configured!")
-            del user_states[uid]; return
-        if st == 'waiting_tok_tut':
-            SHORTNER_CONFIG["tutorial"] = message.text
-            save_setting("shortner", SHORTNER_CONFIG)
-            bot.send_message(uid, "✅ Tutorial Set!")
-            del user_states[uid]; return
-        if st == 'waiting_start_text':
-            START_CONFIG["text"] = message.text; save_setting("start", START_CONFIG); bot.send_message(uid, "Updated."); del user_states[uid]; return
-        if st == 'waiting_start_pic':
-            if message.photo: START_CONFIG["pic"] = message.photo[-1].file_id; save_setting("start", START_CONFIG); bot.send_message(uid, "Updated.")
-            del user_states[uid]; return
-        if st == 'edit_plan_price':
-            try: 
-                credit_val = CREDIT_CONFIG.get("value", 1.0)
-                price_rs = float(message.text) * credit_val
-                PLANS[state['plan']] = price_rs
-                save_setting("plans", PLANS)
-                bot.send_message(uid, f"✅ Updated to {message.text} Credits (₹{price_rs}).")
-            except: bot.send_message(uid, "Invalid Number.")
-            del user_states[uid]; return
-
-        if st == 'waiting_credit_val':
-            try:
-                val = float(message.text)
-                if val <= 0:
-                    bot.send_message(uid, "❌ *Error:* Credit value must be greater than 0.")
-                    return
-                CREDIT_CONFIG["value"] = val
-                save_setting("credit", CREDIT_CONFIG)
-                bot.send_message(uid, f"✅ 1 Credit = ₹{val} Set.")
-            except: bot.send_message(uid, "Invalid Number.")
-            del user_states[uid]; return
-            
-        if st == 'waiting_credit_user':
-            try:
-                target_uid = int(message.text)
-                user_states[uid] = {'state': 'waiting_credit_amount', 'target': target_uid}
-                bot.send_message(uid, "Send amount of Credits to add:")
-            except: 
-                bot.send_message(uid, "Invalid User ID.")
-                del user_states[uid]
-            return
-            
-        if st == 'waiting_credit_amount':
-            try:
-                credit_val = CREDIT_CONFIG.get("value", 1.0)
-                amt_credits = float(message.text)
-                amt_rs = amt_credits * credit_val
-                add_credits(state['target'], amt_rs)
-                bot.send_message(uid, f"✅ Added {amt_credits} Credits (₹{amt_rs}) to User {state['target']}.")
-                try: bot.send_message(state['target'], f"🎁 Admin added {amt_credits} Credits to your wallet!")
-                except: pass
-            except: bot.send_message(uid, "Invalid Amount.")
-            del user_states[uid]; return
+    if redeems_col.find_one({"_id": code}):
+        bot.send_message(uid, "❌ This code already exists! Try another.")
+        return
 
-        if st == 'waiting_redeem_name':
-            code = message.text.strip().upper()
-            try: bot.delete_message(uid, message.message_id) # Cleanup admin text
-            except: pass
-            
-            if redeems_col.find_one({"_id": code}):
-                bot.send_message(uid, "❌ This code already exists! Try another.")
-                return
-            
-            user_states[uid]['code'] = code
-            user_states[uid]['state'] = 'waiting_redeem_credits'
-            
-            kb = types.InlineKeyboardMarkup()
-            kb.add(types.InlineKeyboardButton("❌ Cancel", callback_data="cancel_admin_redeem"))
-            bot.edit_message_text(f"Code: `{code}`\n\n💰 *Step 2:* How many CREDITS should it give? (0 for none):", uid, state['msg_id'], reply_markup=kb, parse_mode="Markdown")
-            return
+    state['code'] = code
+    state['state'] = 'waiting_redeem_credits'
+    user_states[uid] = state
 
-        if st == 'waiting_redeem_credits':
-            try:
-                cr = float(message.text)
-                try: bot.delete_message(uid, message.message_id) # Cleanup
-                except: pass
-                
-                user_states[uid]['credits'] = cr
-                user_states[uid]['state'] = 'waiting_redeem_bonus'
-                
-                kb = types.InlineKeyboardMarkup()
-                kb.add(types.InlineKeyboardButton("❌ Cancel", callback_data="cancel_admin_redeem"))
-                bot.edit_message_text(f"Code: `{state['code']}`\nCredits: `{cr}`\n\n🎁 *Step 3:* Percentage Bonus for future purchases? (0 for none):", uid, state['msg_id'], reply_markup=kb, parse_mode="Markdown")
-            except: bot.send_message(uid, "Invalid Number. Try again.")
-            return
+    kb = types.InlineKeyboardMarkup()
+    kb.add(types.InlineKeyboardButton("❌ Cancel", callback_data="cancel_admin_redeem"))
+    bot.edit_message_text(f"Code: `{code}`\n\n💰 *Step 2:* How many CREDITS should it give? (0 for none):", uid, state['msg_id'], reply_markup=kb, parse_mode="Markdown")
 
-        if st == 'waiting_redeem_bonus':
-            try:
-                bonus = float(message.text)
-                try: bot.delete_message(uid, message.message_id) # Cleanup
-                except: pass
-                
-                user_states[uid]['bonus'] = bonus
-                user_states[uid]['state'] = 'waiting_redeem_time'
-                
-                kb = types.InlineKeyboardMarkup()
-                kb.add(types.InlineKeyboardButton("❌ Cancel", callback_data="cancel_admin_redeem"))
-                bot.edit_message_text(f"Code: `{state['code']}`\nCredits: `{state['credits']}`\nBonus: `{bonus}%`\n\n⏳ *Step 4:* Valid for how many HOURS? (e.g. 24):", uid, state['msg_id'], reply_markup=kb, parse_mode="Markdown")
-            except: bot.send_message(uid, "Invalid Number. Try again.")
-            return
+@input_state('waiting_redeem_credits', admin=True)
+def input_redeem_credits(message, uid, state):
+    try:
+        cr = float(message.text)
+        try: bot.delete_message(uid, message.message_id) # Cleanup
+        except: pass
 
-        if st == 'waiting_redeem_time':
-            try:
-                hours = int(message.text)
-                try: bot.delete_message(uid, message.message_id) # Cleanup
-                except: pass
-                
-                code = state['code']
-                credits = state['credits']
-                bonus = state['bonus']
-                expiry = datetime.now() + timedelta(hours=hours)
-                
-                redeems_col.insert_one({
-                    '_id': code,
-                    'credits': credits,
-                    'bonus': bonus,
-                    'expiry': expiry,
-                    'created_at': datetime.now()
-                })
-                
-                msg = (f"✅ *Redeem Code Created!*\n\n"
-                       f"🔹 Code: `{code}`\n"
-                       f"💰 Credits: {credits}\n"
-                       f"🎁 Bonus: {bonus}%\n"
-                       f"⌛ Exp: {hours} hours")
-                
-                kb = types.InlineKeyboardMarkup()
-                kb.add(types.InlineKeyboardButton("🔙 Back to Redeem Menu", callback_data="panel_redeem"))
-                bot.edit_message_text(msg, uid, state['msg_id'], reply_markup=kb, parse_mode="Markdown")
-                del user_states[uid]
-            except: bot.send_message(uid, "Invalid Number. Try again.")
-            return
+        state['credits'] = cr
+        state['state'] = 'waiting_redeem_bonus'
+        user_states[uid] = state
 
-        if st == 'waiting_redeem_del':
-            code = message.text.strip().upper()
-            if redeems_col.delete_one({"_id": code}).deleted_count > 0:
-                bot.send_message(uid, f"✅ Code `{code}` deleted.")
-            else:
-                bot.send_message(uid, "❌ Code not found!")
-            del user_states[uid]; return
-
-            # Gen Link (Pro/Admin) - SMART ID COLLECTOR
-    if state and state.get('state') == 'batch_collect':
-        # File Type & ID Nikalo
-        ftype = 'text' if message.text else 'photo' if message.photo else 'video' if message.video else 'document' if message.document else 'audio'
-        
-        # ID safe tarike se nikalo
-        fid = None
-        if message.text: fid = message.text
-        elif message.photo: fid = message.photo[-1].file_id
-        elif message.video: fid = message.video.file_id
-        elif message.document: fid = message.document.file_id
-        elif message.audio: fid = message.audio.file_id
-        elif message.voice: fid = message.voice.file_id
-        elif message.animation: fid = message.animation.file_id
-        
-        if not fid: return # Agar sticker ya kuch aur hai to ignore karo
+        kb = types.InlineKeyboardMarkup()
+        kb.add(types.InlineKeyboardButton("❌ Cancel", callback_data="cancel_admin_redeem"))
+        bot.edit_message_text(f"Code: `{state['code']}`\nCredits: `{cr}`\n\n🎁 *Step 3:* Percentage Bonus for future purchases? (0 for none):", uid, state['msg_id'], reply_markup=kb, parse_mode="Markdown")
+    except: bot.send_message(uid, "Invalid Number. Try again.")
 
-        # 1. File List mein add karo
-        state['files'].append({'type': ftype, 'id': fid})
+@input_state('waiting_redeem_bonus', admin=True)
+def input_redeem_bonus(message, uid, state):
+    try:
+        bonus = float(message.text)
+        try: bot.delete_message(uid, message.message_id) # Cleanup
+        except: pass
 
-        # 2. Button List check karo (Agar nahi hai to nayi banao)
-        if 'btn_ids' not in state: state['btn_ids'] = []
+        state['bonus'] = bonus
+        state['state'] = 'waiting_redeem_time'
+        user_states[uid] = state
 
-        # 3. Koshish karo purana delete karne ki (Agar load kam ho)
-        last_mid = state.get('last_msg_id')
-        if last_mid:
-            try: bot.delete_message(message.chat.id, last_mid)
-            except: pass 
+        kb = types.InlineKeyboardMarkup()
+        kb.add(types.InlineKeyboardButton("❌ Cancel", callback_data="cancel_admin_redeem"))
+        bot.edit_message_text(f"Code: `{state['code']}`\nCredits: `{state['credits']}`\nBonus: `{bonus}%`\n\n⏳ *Step 4:* Valid for how many HOURS? (e.g. 24):", uid, state['msg_id'], reply_markup=kb, parse_mode="Markdown")
+    except: bot.send_message(uid, "Invalid Number. Try again.")
 
-        # 4. Naya Button Bhejo
-        msg = bot.send_message(message.chat.id, f"✅ Added ({len(state['files'])}) files.", reply_markup=done_kb())
-        
-        # 5. ID Save karo (List mein bhi, aur Last ID mein bhi)
-        state['last_msg_id'] = msg.message_id
-        state['btn_ids'].append(msg.message_id) # <--- Ye zaroori line hai
-        return
-    if state and state.get('state') == 'waiting_price':
-        try:
-            # FIX: Use regex to extract first number found in string (handles "100rs", "price 50", etc)
-            nums = re.findall(r'\d+', message.text)
-            if not nums: raise ValueError
-            val_input = int(nums[0])
+@input_state('waiting_redeem_time', admin=True)
+def input_redeem_time(message, uid, state):
+    try:
+        hours = int(message.text)
+        try: bot.delete_message(uid, message.message_id) # Cleanup
+        except: pass
 
-            user_states[uid]['state'] = 'batch_collect'
-            user_states[uid]['files'] = []
-            
-            if state.get('owner') == ADMIN_ID:
-                credit_val = CREDIT_CONFIG.get("value", 1.0)
-                price_rs = val_input * credit_val
-                user_states[uid]['price'] = price_rs
-                bot.send_message(uid, f"✅ Price: {val_input} Credits (₹{price_rs})\n*Send content now.*", reply_markup=done_kb())
-            else:
-                user_states[uid]['price'] = val_input
-                bot.send_message(uid, f"✅ Price: ₹{val_input}\n*Send content now.*", reply_markup=done_kb())
-        except: bot.send_message(uid, "Invalid Number. Send numbers only.")
-        return
+        code = state['code']
+        credits = state['credits']
+        bonus = state['bonus']
+        expiry = datetime.now() + timedelta(hours=hours)
+
+        redeems_col.insert_one({
+            '_id': code,
+            'credits': credits,
+            'bonus': bonus,
+            'expiry': expiry,
+            'created_at': datetime.now()
+        })
+
+        msg = (f"✅ *Redeem Code Created!*\n\n"
+               f"🔹 Code: `{code}`\n"
+               f"💰 Credits: {credits}\n"
+               f"🎁 Bonus: {bonus}%\n"
+               f"⌛ Exp: {hours} hours")
 
-    if state and state.get('state') == 'waiting_upi':
-        update_user_upi(uid, message.text)
-        bot.send_message(uid, "✅ UPI Set!")
+        kb = types.InlineKeyboardMarkup()
+        kb.add(types.InlineKeyboardButton("🔙 Back to Redeem Menu", callback_data="panel_redeem"))
+        bot.edit_message_text(msg, uid, state['msg_id'], reply_markup=kb, parse_mode="Markdown")
         del user_states[uid]
+    except: bot.send_message(uid, "Invalid Number. Try again.")
+
+@input_state('waiting_redeem_del', admin=True)
+def input_redeem_del(message, uid, state):
+    code = message.text.strip().upper()
+    if redeems_col.delete_one({"_id": code}).deleted_count > 0:
+        redeem_usage_col.delete_many({"code": code}) # Same naam ka naya code ban sake
+        bot.send_message(uid, f"✅ Code `{code}` deleted.")
+    else:
+        bot.send_message(uid, "❌ Code not found!")
+    del user_states[uid]
+
+# SUPPORT REQUEST (Initial Ticket)
+def handle_support_request(message, uid):
+    # --- USERNAME CHECK ---
+    username = message.from_user.username
+    if not username:
+        bot.send_message(uid, "🚫 *Access Denied*\n\nReport bhejne ke liye aapka *Telegram Username* set hona zaroori hai.\n\nSettings mein jaakar ek username banayein aur phir try karein.")
+        del user_support_state[uid]
         return
 
-    if state and state.get('state') == 'waiting_user_short_api':
-        user_states[uid]['api'] = message.text
-        user_states[uid]['state'] = 'waiting_user_short_url'
-        bot.send_message(uid, "✅ API Saved. Now Send Domain (e.g. mdiskshortner.link):")
+    del user_support_state[uid]
+
+    # --- RATE LIMIT CHECK (3 reports per 24h) ---
+    u = get_user(uid)
+    today_str = datetime.now().strftime("%Y-%m-%d")
+    sr = u.get("support_reports", {"date": None, "count": 0})
+
+    if sr["date"] == today_str:
+        if sr["count"] >= 3:
+            bot.send_message(uid, "🚫 *Daily Limit Reached*\n\nYou have already sent 3 reports today.")
+            return
+        new_count = sr["count"] + 1
+    else:
+        new_count = 1
+
+    update_user(uid, {"$set": {"support_reports": {"date": today_str, "count": new_count}}})
+
+    # --- PERSISTENT ALL-TIME COUNTER ---
+    stats = settings_col.find_one_and_update(
+        {"_id": "report_stats"},
+        {"$inc": {"total_ever": 1}},
+        upsert=True,
+        return_document=pymongo.ReturnDocument.AFTER
+    )
+    total_ever = stats.get("total_ever", 1)
+
+    # --- GENERATE READABLE TID ---
+    # Sanitize username (Remove symbols like _, keep first 10 chars)
+    clean_name = re.sub(r'[^a-zA-Z0-9]', '', username)[:10].lower()
+    tid = f"{clean_name}{total_ever}"
+
+    txt = message.caption or message.text or "No Text"
+    pid = message.photo[-1].file_id if message.photo else None
+
+    now = datetime.now()
+    # Find next Sunday 23:59:59
+    days_ahead = 6 - now.weekday()
+    if days_ahead < 0: days_ahead += 7
+    next_sunday = now + timedelta(days=days_ahead)
+    expire_at = datetime.combine(next_sunday, datetime.max.time())
+
+    # Save to DB
+    tickets_col.insert_one({
+        '_id': tid, 
+        'user_id': uid, 
+        'text': txt, 
+        'photo': pid, 
+        'status': 'open',
+        'thread': [],
+        'created_at': now,
+        'expire_at': expire_at
+    })
+    invalidate_ticket_pages()
+    bump_stats(reports=1)
+
+    # Notify Admin
+    bot.send_message(ADMIN_ID, f"⚠️ *New Report #{tid}* from @{username}\nCheck Admin Panel -> Reports", parse_mode="Markdown")
+
+    # Confirm to User
+    bot.send_message(uid, f"✅ *Report #{tid} Submitted!*\n\nOur team will get back to you soon.", parse_mode="Markdown")
+
+def handle_payment_email(message, uid):
+    text = message.text
+    # --- EMAIL VALIDATION ---
+    if "@" not in text or "." not in text or len(text) < 5:
+        # Error Message with Back Button
+        kb = types.InlineKeyboardMarkup()
+        kb.add(types.InlineKeyboardButton("🔙 Back / Cancel", callback_data="cancel_input_process"))
+        bot.send_message(message.chat.id, "⚠️ *Invalid Email!*\nPlease enter a valid email address (e.g. name@gmail.com).", reply_markup=kb)
         return
 
-    if state and state.get('state') == 'waiting_user_short_url':
-        api = user_states[uid]['api']
-        url = message.text
-        users_col.update_one({"_id": uid}, {"$set": {"personal_shortener": {"api": api, "url": url}}})
-        bot.send_message(uid, "✅ Personal Shortener Configured!")
-        del user_states[uid]
+    # --- PAYMENT CHECK ---
+    email = text.strip().lower()
+
+    existing_payment = unclaimed_payments_col.find_one({"email": email})
+
+    # Scenario A: Payment Pehle se aayi hui hai
+    if existing_payment:
+        paid_amount = float(existing_payment['amount'])
+        credit_val = CREDIT_CONFIG.get("value", 1.0)
+        credits_added = paid_amount / credit_val
+
+        # Event wala hi ref, taaki same payment webhook path se bhi lagi ho to dobara na lage
+        ref = f"payment:{existing_payment['event_id']}" if existing_payment.get("event_id") else f"unclaimed:{existing_payment['_id']}"
+        add_credits(uid, credits_added, "payment", ref=ref)
+
+        bot.send_message(uid, f"✅ *Payment Found!*\n₹{paid_amount} received. {credits_added} Credits added.", reply_markup=types.ReplyKeyboardRemove())
+        unclaimed_payments_col.delete_one({"_id": existing_payment['_id']})
+        del active_user_code[uid]
         return
 
-    # PROOF UPLOAD (Only for Pro users selling to other users now)
-    if message.photo and not state:
-        session = active_user_code.get(uid)
-        if session:
-            # Admin wale automated process ko ignore karein (SALE_... ya PLAN_...)
-            if not session.startswith("PLAN_") and not session.startswith("SALE_"):
-                code = session
-                batch = batches_col.find_one({"_id": code})
-                if batch:
-                    owner_id = batch.get('owner_id')
-
-                    # Agar Owner ADMIN nahi hai (Matlab Premium User hai)
-                    if owner_id != ADMIN_ID:
-                        price = batch.get('price', 0) # <--- Ye line IMPORTANT hai (Price nikalna)
-
-                        pid = f"pro_{uid}_{gen_code(3)}"
-
-                        # Data save karte waqt 'price' zaroor save karein
-                        pro_proofs_col.insert_one({
-                            '_id': pid, 
-                            'owner_id': owner_id, 
-                            'user_id': uid, 
-                            'username': message.from_user.username, 
-                            'code': code, 
-                            'price': price, # <--- Yahan price database me ja raha hai
-                            'photo': message.photo[-1].file_id,
-                            'timestamp': datetime.now()
-                        })
-
-                        bot.send_message(uid, "✅ *Proof Sent!*\nSeller verify karke file bhej dega.")
-                        try:
-                            bot.send_message(owner_id, "🔔 *New Payment Proof!*\nCheck -> /proof 📸")
-                        except: pass
-
-            # Code use hone ke baad session clear karein
-            del active_user_code[uid]
-            return
+    # Scenario B: Payment abhi nahi aayi (Tracking Start)
+    else:
+        pending_payments_col.insert_one({
+            "user_id": uid, "email": email, "type": "credit", 
+            "created_at": datetime.now()
+        })
+
+        # Message sent WITHOUT Buttons (User confuse na ho)
+        bot.send_message(uid, f"✅ *Payment Tracking Started*\nEmail: `{email}`\nWaiting for confirmation...")
+
+        # State Delete taaki user dobara 'Invalid Email' na face kare
+        del active_user_code[uid] 
+
+def handle_payment_proof(message, uid, session):
+    # Admin wale automated process ko ignore karein (SALE_... ya PLAN_...)
+    if not session.startswith("PLAN_") and not session.startswith("SALE_"):
+        code = session
+        batch = batches_col.find_one({"_id": code}, {"files": 0})
+        if batch:
+            owner_id = batch.get('owner_id')
+
+            # Agar Owner ADMIN nahi hai (Matlab Premium User hai)
+            if owner_id != ADMIN_ID:
+                price = batch.get('price', 0) # <--- Ye line IMPORTANT hai (Price nikalna)
+
+                pid = f"pro_{uid}_{gen_code(3)}"
+
+                # Data save karte waqt 'price' zaroor save karein
+                pro_proofs_col.insert_one({
+                    '_id': pid, 
+                    'owner_id': owner_id, 
+                    'user_id': uid, 
+                    'username': message.from_user.username, 
+                    'code': code, 
+                    'price': price, # <--- Yahan price database me ja raha hai
+                    'photo': message.photo[-1].file_id,
+                    'timestamp': datetime.now()
+                })
+
+                bot.send_message(uid, "✅ *Proof Sent!*\nSeller verify karke file bhej dega.")
+                try:
+                    bot.send_message(owner_id, "🔔 *New Payment Proof!*\nCheck -> /proof 📸")
+                except: pass
+
+    # Code use hone ke baad session clear karein
+    del active_user_code[uid]
 
 def done_kb():
     kb = types.InlineKeyboardMarkup()
@@ -2583,27 +4092,245 @@ def done_kb():
     kb.add(types.InlineKeyboardButton("❌ Cancel Process", callback_data="cancel_gen_process"))
     return kb
 
+BROADCAST_DELETE_CHUNK = 500
+
 def perform_broadcast_delete(admin_id, action):
-    cutoff = datetime.now()
-    if "1h" in action: cutoff -= timedelta(hours=1)
-    elif "12h" in action: cutoff -= timedelta(hours=12)
-    else: cutoff -= timedelta(days=365) 
+    if "1h" in action: query = {"sent_at": {"$gte": datetime.now() - timedelta(hours=1)}}
+    elif "12h" in action: query = {"sent_at": {"$gte": datetime.now() - timedelta(hours=12)}}
+    else: query = {}
+    delete_broadcast_messages(admin_id, query)
+
+def delete_broadcast_ledger_msg(doc):
+    with bulk_traffic():
+        try:
+            bot.delete_message(doc['chat_id'], doc['message_id'])
+            return True
+        except Exception: return False
+
+def delete_broadcast_messages(admin_id, query):
+    # Ledger index se stream karo, chunk-wise concurrent delete, phir ledger se hatao
     count = 0
-    # Copy list to iterate safely
-    for i, (uid, mid, ts) in enumerate(list(last_broadcast_ids)):
-        if ts > cutoff:
-            try: bot.delete_message(uid, mid); count += 1
-            except: pass
-            # Remove from original list (using value, not index to be safe)
-            try: last_broadcast_ids.remove((uid, mid, ts))
-            except: pass
+    cursor = broadcast_msgs_col.find(query, {"chat_id": 1, "message_id": 1}).sort("sent_at", 1).batch_size(BROADCAST_DELETE_CHUNK)
+    chunk = []
+    for doc in cursor:
+        chunk.append(doc)
+        if len(chunk) >= BROADCAST_DELETE_CHUNK:
+            count += sum(broadcast_pool.map(delete_broadcast_ledger_msg, chunk))
+            broadcast_msgs_col.delete_many({"_id": {"$in": [d['_id'] for d in chunk]}})
+            chunk = []
+    if chunk:
+        count += sum(broadcast_pool.map(delete_broadcast_ledger_msg, chunk))
+        broadcast_msgs_col.delete_many({"_id": {"$in": [d['_id'] for d in chunk]}})
 
     bot.send_message(admin_id, f"🗑 Deleted {count} messages.")
 
+# ---------------- BROADCAST ENGINE ----------------
+BROADCAST_WORKERS = int(os.getenv("BROADCAST_WORKERS", "8"))
+BROADCAST_PAGE = 200          # Itne users ke baad cursor checkpoint hota hai
+BROADCAST_PROGRESS_SECS = 5   # Admin status message kitni der mein update ho
+broadcast_pool = ThreadPoolExecutor(max_workers=BROADCAST_WORKERS, thread_name_prefix="broadcast")
+active_broadcasts = set()
+active_broadcasts_lock = threading.Lock()
+
+def broadcast_filter(target):
+    # Jinhone bot block kiya hai unhe skip karo
+    query = {"bc_blocked": {"$ne": True}}
+    if target == 'prem': query["premium_expiry"] = {"$gt": datetime.now()}
+    return query
+
+def broadcast_status_text(bc):
+    labels = {"running": "🚀 Running", "paused": "⏸ Paused", "cancelled": "🛑 Cancelled", "done": "✅ Complete"}
+    done_count = bc.get("sent", 0) + bc.get("failed", 0) + bc.get("blocked", 0)
+    return (f"📢 *Broadcast* `{bc['_id']}`\n"
+            f"Status: {labels.get(bc['status'], bc['status'])}\n\n"
+            f"📊 Progress: {done_count}/{bc.get('total', 0)}\n"
+            f"✅ Sent: {bc.get('sent', 0)}\n"
+            f"🚫 Blocked: {bc.get('blocked', 0)}\n"
+            f"❌ Failed: {bc.get('failed', 0)}")
+
+def broadcast_control_kb(bc):
+    kb = types.InlineKeyboardMarkup(row_width=2)
+    if bc['status'] == 'running':
+        kb.add(types.InlineKeyboardButton("⏸ Pause", callback_data=f"bcj|pause|{bc['_id']}"),
+               types.InlineKeyboardButton("🛑 Cancel", callback_data=f"bcj|cancel|{bc['_id']}"))
+    elif bc['status'] == 'paused':
+        kb.add(types.InlineKeyboardButton("▶️ Resume", callback_data=f"bcj|resume|{bc['_id']}"),
+               types.InlineKeyboardButton("🛑 Cancel", callback_data=f"bcj|cancel|{bc['_id']}"))
+    else:
+        kb.add(types.InlineKeyboardButton("🗑 Delete Sent Messages", callback_data=f"bcj|delete|{bc['_id']}"))
+    return kb
+
+def update_broadcast_status(bc_id):
+    bc = broadcasts_col.find_one({"_id": bc_id})
+    if not bc: return
+    try: bot.edit_message_text(broadcast_status_text(bc), bc['admin_chat'], bc['status_msg_id'], reply_markup=broadcast_control_kb(bc))
+    except Exception: pass # "message is not modified" waghera
+
+def start_broadcast(admin_id, target, message):
+    bc_id = f"bc{uuid.uuid4().hex}" # Same second ke do broadcasts ka bookkeeping alag rahe
+    total = users_col.count_documents(broadcast_filter(target))
+    status_msg = bot.send_message(admin_id, f"🚀 Broadcasting to ~{total} users...")
+    broadcasts_col.insert_one({
+        "_id": bc_id,
+        "target": target,
+        "from_chat_id": message.chat.id,
+        "source_msg_id": message.message_id,
+        "admin_chat": admin_id,
+        "status_msg_id": status_msg.message_id,
+        "status": "running",
+        "cursor": None,
+        "total": total,
+        "sent": 0, "failed": 0, "blocked": 0,
+        "created_at": datetime.now()
+    })
+    launch_broadcast(bc_id)
+
+def launch_broadcast(bc_id):
+    with active_broadcasts_lock:
+        if bc_id in active_broadcasts: return
+        active_broadcasts.add(bc_id)
+    threading.Thread(target=run_broadcast, args=(bc_id,), daemon=True).start()
+
+def send_broadcast_copy(bc, user_id):
+    with bulk_traffic():
+        try:
+            m = bot.copy_message(user_id, bc['from_chat_id'], bc['source_msg_id'])
+            return "sent", m.message_id
+        except Exception as e:
+            return ("blocked" if is_permanent_error(e) else "failed"), None
+
+def run_broadcast(bc_id):
+    last_edit, crashed = 0, False
+    try:
+        while True:
+            bc = broadcasts_col.find_one({"_id": bc_id})
+            if not bc or bc['status'] != 'running': break
+
+            query = broadcast_filter(bc['target'])
+            if bc.get('cursor') is not None: query["_id"] = {"$gt": bc['cursor']}
+            page = [u['_id'] for u in users_col.find(query, {"_id": 1}).sort("_id", 1).limit(BROADCAST_PAGE)]
+            if not page:
+                broadcasts_col.update_one({"_id": bc_id}, {"$set": {"status": "done", "finished_at": datetime.now()}})
+                break
+
+            results = list(broadcast_pool.map(lambda u: send_broadcast_copy(bc, u), page))
+            now = datetime.now()
+            sent = [(u, mid) for u, (res, mid) in zip(page, results) if res == "sent"]
+            blocked = [u for u, (res, _) in zip(page, results) if res == "blocked"]
+            if sent:
+                broadcast_msgs_col.insert_many([{"bc_id": bc_id, "chat_id": u, "message_id": mid, "sent_at": now} for u, mid in sent], ordered=False)
+
+            # Checkpoint: restart ke baad yahin se continue hoga
+            broadcasts_col.update_one({"_id": bc_id}, {
+                "$set": {"cursor": page[-1], "updated_at": now},
+                "$inc": {"sent": len(sent), "blocked": len(blocked), "failed": len(page) - len(sent) - len(blocked)}
+            })
+            if blocked:
+                users_col.update_many({"_id": {"$in": blocked}}, {"$set": {"bc_blocked": True}})
+                for u in blocked: user_cache.invalidate(u)
+
+            if time.monotonic() - last_edit >= BROADCAST_PROGRESS_SECS:
+                update_broadcast_status(bc_id)
+                last_edit = time.monotonic()
+    except Exception as e:
+        crashed = True
+        print(f"❌ Broadcast Error ({bc_id}): {e}")
+    finally:
+        with active_broadcasts_lock: active_broadcasts.discard(bc_id)
+    # Pause ke break aur discard ke beech resume aaya ho to launch_broadcast ne skip kiya tha: ab relaunch
+    if not crashed and broadcasts_col.find_one({"_id": bc_id, "status": "running"}, {"_id": 1}):
+        launch_broadcast(bc_id)
+        return
+    update_broadcast_status(bc_id)
+
+def control_broadcast(op, bc_id):
+    if op == "pause":
+        broadcasts_col.update_one({"_id": bc_id, "status": "running"}, {"$set": {"status": "paused"}})
+    elif op == "resume":
+        if broadcasts_col.update_one({"_id": bc_id, "status": "paused"}, {"$set": {"status": "running"}}).modified_count:
+            launch_broadcast(bc_id)
+    elif op == "cancel":
+        broadcasts_col.update_one({"_id": bc_id, "status": {"$in": ["running", "paused"]}}, {"$set": {"status": "cancelled", "finished_at": datetime.now()}})
+    elif op == "delete":
+        bc = broadcasts_col.find_one({"_id": bc_id}, {"admin_chat": 1})
+        if bc: threading.Thread(target=delete_broadcast_messages, args=(bc['admin_chat'], {"bc_id": bc_id}), daemon=True).start()
+        return
+    update_broadcast_status(bc_id)
+
+def resume_broadcasts():
+    # Restart se pehle jo broadcasts chal rahe the unhe checkpoint se dobara shuru karo
+    for bc in broadcasts_col.find({"status": "running"}, {"_id": 1}):
+        launch_broadcast(bc["_id"])
+
+# ---------------- MIGRATIONS ----------------
+def run_migration_once(name, func):
+    if settings_col.find_one({"_id": f"migration_{name}"}): return
+    try:
+        func()
+        settings_col.insert_one({"_id": f"migration_{name}", "done_at": datetime.now()})
+        print(f"✅ Migration Done: {name}")
+    except Exception as e:
+        print(f"❌ Migration Failed ({name}): {e}")
+
+def migrate_redeem_usage():
+    # Purane users.used_redeems arrays -> redeem_usage collection
+    now = datetime.now()
+    for r in redeems_col.find({"expiry": {"$gt": now}}):
+        docs = [{"user_id": u["_id"], "code": r["_id"], "expire_at": r["expiry"], "used_at": now}
+                for u in users_col.find({"used_redeems": r["_id"]}, {"_id": 1})]
+        if not docs: continue
+        try: redeem_usage_col.insert_many(docs, ordered=False)
+        except BulkWriteError: pass # Already migrated entries
+    users_col.update_many({"used_redeems": {"$exists": True}}, {"$unset": {"used_redeems": ""}})
+
+def migrate_bonuses():
+    # Purane users.bonus_percent/bonus_expiry -> bonuses collection
+    now = datetime.now()
+    for u in users_col.find({"bonus_expiry": {"$gt": now}}, {"bonus_percent": 1, "bonus_expiry": 1}):
+        if u.get("bonus_percent"): set_bonus(u["_id"], u["bonus_percent"], u["bonus_expiry"])
+    users_col.update_many({"bonus_percent": {"$exists": True}}, {"$unset": {"bonus_percent": "", "bonus_expiry": ""}})
+
+def migrate_batch_chunks():
+    # Legacy batches ko background mein chunk karo (delivery pe lazy migration bhi hoti hai)
+    for b in batches_col.find({"files": {"$exists": True}}, {"_id": 1}):
+        chunk_legacy_batch(b["_id"])
+
+def run_blocking_migrations():
+    # Updates lene se pehle: inke bina purane used codes dobara redeem ho sakte / purane bonus miss hote
+    run_migration_once("redeem_usage", migrate_redeem_usage)
+    run_migration_once("bonuses", migrate_bonuses)
+
+def run_migrations():
+    # Background wale: delivery pe lazy fallback already hai
+    run_migration_once("batch_chunks", migrate_batch_chunks)
+
 # ---------------- RUN ----------------
-print("🤖 Bot Started...")
+if "--bench-router" in sys.argv:
+    bench_callback_dispatch()
+    sys.exit(0)
+
+run_blocking_migrations()
+threading.Thread(target=background_worker, daemon=True).start()
+threading.Thread(target=run_migrations, daemon=True).start()
+threading.Thread(target=auto_delete_worker, daemon=True).start()
+threading.Thread(target=link_pool_worker, daemon=True).start()
+threading.Thread(target=payment_worker, daemon=True).start()
+threading.Thread(target=stats_worker, daemon=True).start()
+for _ in range(OUTBOX_WORKERS):
+    threading.Thread(target=outbox_worker, daemon=True).start()
+for _ in range(DELIVERY_WORKERS):
+    threading.Thread(target=delivery_worker, daemon=True).start()
+resume_broadcasts()
+
+dispatcher.start()
+
+print(f"🤖 Bot Started ({BOT_MODE})...")
 try:
-    bot.infinity_polling(timeout=20, long_polling_timeout=10)
+    if BOT_MODE == "webhook":
+        start_webhook_mode()
+        flask_thread.join()
+    else:
+        poll_updates()
 except Exception as e:
     print(f"Error: {e}")
     traceback.print_exc()